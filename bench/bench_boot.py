@@ -0,0 +1,133 @@
+# Compares booting a node from the older JSON data file with booting from the
+# binary snapshot: time from construction to answering QNN, and the heap the
+# node data holds once booted.
+#
+# Run on the Pico with the lib folder on the board:
+#   mpremote run bench/bench_boot.py
+# or on the host:
+#   python3 bench/bench_boot.py
+
+import gc
+import json
+import os
+import sys
+
+HOST = sys.implementation.name != 'micropython'
+if HOST:  # CPython, use the host stand ins
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'host'))
+    import emulator
+    emulator.install()
+    import tracemalloc
+
+from time import ticks_us, ticks_diff
+import CbusFlimNode
+from cbus_frame import CbusFrame
+
+EVENTS = 200
+EVENT_VARIABLES = 8
+DATA_FILE = 'bench_boot.json'
+
+config = {
+    "manufacturer": 165,
+    "cpuManufId": 3,
+    "module": 58,
+    "name": "BENCH",
+    "major_version": 1,
+    "minor_version": "A",
+    "beta": 1,
+    "consumer": True,
+    "producer": True,
+    "flim": True,
+    "bootloader": False,
+    "consume_own_events": False,
+    "node_variables": 16,
+    "event_variables": EVENT_VARIABLES,
+    "data_file": DATA_FILE
+}
+
+
+class BenchNode(CbusFlimNode.CbusNode):
+    def __init__(self):
+        CbusFlimNode.CbusNode.__init__(self, config)
+        self.sent = 0
+
+    def send(self, msg):
+        self.sent += 1
+
+    def send_frame(self, frame, wait_ms=0):
+        self.sent += 1
+
+
+def remove():
+    for name in (DATA_FILE, DATA_FILE + '.jnl', 'bench_boot.bin', 'bench_boot.bin.tmp', DATA_FILE + '.tmp'):
+        try:
+            os.remove(name)
+        except OSError:
+            pass
+
+
+def write_json():
+    events = []
+    for i in range(EVENTS):
+        events.append({'event_identifier': '%08X' % ((256 << 16) | i), 'variables': [i & 0xFF] * (EVENT_VARIABLES + 1)})
+    data = {'parameters': ['14', 'a5', '41', '3a', 'ff', '08', '10', '01', '07', '00', '01', '00', '00', '00', '00',
+                           '00', '00', '00', '00', '03', '01'],
+            'variables': [0] * 17, 'events': events, 'manufId': 165, 'cpuManufId': 3, 'moduleId': 58,
+            'name': 'BENCH', 'minorVersion': 'A', 'numEvents': 255, 'numEventVariables': EVENT_VARIABLES,
+            'numNodeVariables': 16, 'majorVersion': 1, 'beta': 1, 'consumer': True, 'producer': True,
+            'flim': True, 'bootloader': False, 'coe': False, 'nodeId': 256, 'generation': 1}
+    with open(DATA_FILE, 'w') as f:
+        json.dump(data, f)
+
+
+def heap_start():
+    gc.collect()
+    if HOST:
+        tracemalloc.start()
+        return 0
+    return gc.mem_alloc()
+
+
+def heap_used(before):
+    gc.collect()
+    if HOST:
+        used = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        return used
+    return gc.mem_alloc() - before
+
+
+def boot(name):
+    qnn = CbusFrame()
+    qnn.from_gc(":SB020N0D;")
+    before = heap_start()
+    start = ticks_us()
+    node = BenchNode()
+    node.execute_frame(qnn)
+    elapsed = ticks_diff(ticks_us(), start)
+    used = heap_used(before)
+    print(name)
+    print("  events          : " + str(len(node.events)))
+    print("  boot to PNN us  : " + str(elapsed))
+    print("  node heap bytes : " + str(used))
+    return node
+
+
+def json_layout_heap():
+    before = heap_start()
+    with open('bench_boot.export.json') as f:
+        data = json.load(f)
+    used = heap_used(before)
+    del data
+    print("JSON data layout held in RAM")
+    print("  heap bytes      : " + str(used))
+
+
+remove()
+write_json()
+boot("first boot, migrating the JSON data file")
+node = boot("boot from the binary snapshot")
+node.export_data('bench_boot.export.json')
+json_layout_heap()
+os.remove('bench_boot.export.json')
+remove()
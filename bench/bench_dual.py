@@ -0,0 +1,155 @@
+# Single core against dual core CAN I/O, run under CPython on the host emulator
+#
+#   python3 bench/bench_dual.py
+#
+# A bus thread puts numbered frames on the virtual bus while the main thread
+# runs the node's process() loop, once single core and once with a
+# cbus_dual.CanWorker on its own thread standing in for core 1. For each
+# mode it reports:
+#   - frames handled, lost and out of order with a fast handler and frames
+#     as close together as the host keeps up with
+#   - frames lost and the worst bus to handler latency when every
+#     SLOW_EVERY'th frame takes SLOW_HANDLER_US to handle, frames one bus
+#     frame time apart
+#
+# Single core, the main thread services the MCP2515 between handlers with
+# Cbus2515.poll(), as the Pico does when a handler holds core 0 in a long
+# native call and the interrupt has to wait. The emulated SPI is far slower
+# than the Pico's, so the frame spacing and handler times are scaled up
+# about ten times. Host figures are for checking the worker and comparing
+# changes, not for the Pico's absolute speed.
+
+import os
+import sys
+import tempfile
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'host'))
+import emulator
+emulator.install()
+
+from time import perf_counter
+import pico02
+
+FAST_FRAMES = 2000
+FAST_INTERVAL_US = 2000
+SLOW_FRAMES = 400
+SLOW_EVERY = 20
+SLOW_HANDLER_US = 50000
+SLOW_INTERVAL_US = 10000  # One 8 byte frame time at 125 kbit/s, scaled
+OPCODE = 0xB0  # ACON1, not used by the node itself
+
+config = {
+    "manufacturer": 165,
+    "cpuManufId": 3,
+    "module": 58,
+    "name": "BENCH",
+    "major_version": 1,
+    "minor_version": "A",
+    "beta": 1,
+    "consumer": True,
+    "producer": True,
+    "flim": True,
+    "bootloader": False,
+    "consume_own_events": False,
+    "node_variables": 8,
+    "event_variables": 8,
+    "data_file": "bench_dual.json"
+}
+os.chdir(tempfile.mkdtemp())  # The driver keeps CAN_ID.ini in the working directory
+sys.setswitchinterval(0.0001)  # Let the threads interleave about as often as the cores would
+
+
+class BenchNode(pico02.can_pico):
+    def __init__(self, dual_core):
+        config['dual_core'] = dual_core
+        pico02.can_pico.__init__(self, config)
+        self.debug = False
+        self.can.debug = False
+        if self.worker:
+            self.worker.idle_us = 20  # A spinning thread would hold the GIL
+        else:
+            self.can.irq_enable(False)  # Serviced from process() below
+        self.register_opcode(OPCODE, self.numbered)
+        self.slow_every = 0
+        self.numbers = []
+        self.latency_max = 0
+        self.sent_at = {}
+
+    def process(self):
+        if not self.worker:
+            self.can.poll()
+        pico02.can_pico.process(self)
+
+    def numbered(self, frame):
+        self.numbers.append(frame.en)
+        sent_at = self.sent_at.get(frame.en)
+        if sent_at is not None:
+            self.latency_max = max(self.latency_max, perf_counter() - sent_at)
+        if self.slow_every and frame.en % self.slow_every == 0:
+            end = perf_counter() + SLOW_HANDLER_US / 1000000
+            while perf_counter() < end:
+                pass
+
+
+def report(name, value, unit=""):
+    print("  " + (name + " ").ljust(34, '.') + " " + str(value) + " " + unit)
+
+
+def bus_thread(board, node, count, interval_us):
+    msgs = [":SB040N%02X0100%04X00;" % (OPCODE, i) for i in range(count)]
+    next_at = perf_counter()
+    for i in range(count):
+        next_at += interval_us / 1000000
+        wait = next_at - perf_counter()
+        if wait > 0:
+            emulator._sleep(wait)  # Without running the machine.Timer callbacks on this thread
+        node.sent_at[i] = perf_counter()
+        board.inject(msgs[i])
+
+
+def run(dual_core, count, interval_us, slow_every):
+    board = emulator.Board()
+    node = BenchNode(dual_core)
+    node.slow_every = slow_every
+    node.process()  # Starts the worker
+    bus = threading.Thread(target=bus_thread, args=(board, node, count, interval_us))
+    start = perf_counter()
+    bus.start()
+    idle_since = None
+    while True:
+        handled = len(node.numbers)
+        node.process()
+        if len(node.numbers) == handled and not bus.is_alive():
+            idle_since = idle_since or perf_counter()
+            if perf_counter() - idle_since > 0.05:
+                break
+        else:
+            idle_since = None
+    elapsed = perf_counter() - start - 0.05
+    if node.worker:
+        node.worker.stop()
+    numbers = node.numbers
+    disorder = sum(1 for a, b in zip(numbers, numbers[1:]) if b <= a)
+    return node, count - len(numbers), disorder, elapsed
+
+
+def bench(dual_core):
+    print("dual core" if dual_core else "single core")
+    node, lost, disorder, elapsed = run(dual_core, FAST_FRAMES, FAST_INTERVAL_US, 0)
+    report("fast frames handled", len(node.numbers))
+    report("fast frames lost", lost)
+    report("fast frames out of order", disorder)
+    report("fast frames per second", int(len(node.numbers) / elapsed))
+    node, lost, disorder, elapsed = run(dual_core, SLOW_FRAMES, SLOW_INTERVAL_US, SLOW_EVERY)
+    report("slow handler frames lost", lost)
+    report("slow handler frames out of order", disorder)
+    report("slow handler worst latency", int(node.latency_max * 1000), "ms")
+    if node.worker:
+        stats = node.worker.stats()
+        report("worker receive ring high water", stats['rx_high_water'])
+    report("driver stack high water", node.can.rx_high)
+
+
+bench(False)
+bench(True)
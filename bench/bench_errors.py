@@ -0,0 +1,128 @@
+# CAN error states and bus-off recovery, run under CPython on the host emulator
+#
+#   python3 bench/bench_errors.py
+#
+# Drives the emulated MCP2515's error counters through the host only hooks:
+# set_error_counts() for the warning and passive levels, tx_fault to make
+# every transmission fail until TEC passes 255 and the controller is
+# bus-off, and bus_idle() for the 128 x 11 recessive bits that end it. Checks
+# that the driver follows the states, pauses transmission at bus-off with
+# the frames kept queued, recovers by itself when the controller does, falls
+# back to resetting the controller after the backoff when it does not, and
+# that the counters in error_stats() and the node metrics snapshot agree.
+# Reports the time from the bus going idle, or from the reset, to the queued
+# frames being back on the bus. Exits non zero if a check fails.
+
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'host'))
+import emulator
+emulator.install()
+
+from time import perf_counter, sleep_ms
+import machine
+import cbus2515
+from cbus_frame import CbusFrame
+from cbus_metrics import Metrics
+
+FRAMES = 5
+
+os.chdir(tempfile.mkdtemp())  # The driver keeps CAN_ID.ini in the working directory
+failed = 0
+
+
+def report(name, value, unit=""):
+    print("  " + (name + " ").ljust(34, '.') + " " + str(value) + " " + unit)
+
+
+def check(name, ok):
+    global failed
+    report(name, "ok" if ok else "FAILED")
+    if not ok:
+        failed += 1
+
+
+def queue_frames(can, frame, first):
+    for i in range(FRAMES):
+        can.send_frame(frame.build(0x90, 1, first + i))
+
+
+board = emulator.Board()
+mcp = board.mcp2515
+can = cbus2515.Cbus2515(machine.SPI(1), machine.Pin(13), machine.Pin(14))
+can.change_mode(0)
+can.set_filters([1], [0x90])
+filters = bytes(can.read_regs(0x00, 12))
+metrics = Metrics(can)
+frame = CbusFrame()
+
+print("error levels")
+mcp.set_error_counts(100, 0)
+check("TEC 100 is error warning", can.error_state == cbus2515.ERROR_WARNING)
+mcp.set_error_counts(130, 0)
+check("TEC 130 is error passive", can.error_state == cbus2515.ERROR_PASSIVE)
+mcp.set_error_counts(0, 100)
+check("REC 100 is error warning", can.error_state == cbus2515.ERROR_WARNING)
+mcp.set_error_counts(0, 0)
+check("both 0 is error active", can.error_state == cbus2515.ERROR_ACTIVE)
+
+print("bus-off, the controller recovers by itself")
+mcp.tx_fault = True
+queue_frames(can, frame, 0)
+board.run()
+can.tx_service()  # Samples TEC and REC
+stats = can.error_stats()
+check("TEC past 255 is bus-off", can.error_state == cbus2515.BUS_OFF and mcp.tec > 255)
+check("transmission paused", can.tx_paused)
+check("frames kept queued", can.tx_waiting() == FRAMES and can.tx_failed == 0)
+check("bus errors counted", stats['bus_errors'] == 32)  # Each failed attempt adds 8 to TEC
+check("TEC high water sampled", stats['tec_max'] == 255)
+check("queued while paused, not sent", can.send_frame(frame.build(0x90, 1, 99)) == 0 and not mcp.tx_frames)
+mcp.tx_fault = False
+start = perf_counter()
+mcp.bus_idle()
+board.run()
+elapsed = perf_counter() - start
+check("back to error active", can.error_state == cbus2515.ERROR_ACTIVE and not can.tx_paused)
+check("queued frames sent", can.tx_waiting() == 0 and mcp.tx_frames == FRAMES + 1)
+check("no reset needed", can.recoveries == 0)
+report("bus idle to frames sent", int(elapsed * 1000000), "us")
+
+print("bus-off, the driver resets the controller")
+mcp.tx_fault = True
+queue_frames(can, frame, 100)
+board.run()
+mcp.tx_fault = False  # The fault is gone but the bus never goes idle for the controller
+check("bus-off again", can.error_state == cbus2515.BUS_OFF)
+can.tx_service()
+check("no reset inside the backoff", can.recoveries == 0 and can.tx_paused)
+sleep_ms(cbus2515.BACKOFF_MS + 10)
+sent = mcp.tx_frames
+start = perf_counter()
+can.tx_service()
+board.run()
+elapsed = perf_counter() - start
+check("controller reset", can.recoveries == 1 and can.error_state == cbus2515.ERROR_ACTIVE)
+check("backoff doubled", can.backoff == 2 * cbus2515.BACKOFF_MS)
+check("normal mode and filters restored", mcp.mode() == 0 and bytes(can.read_regs(0x00, 12)) == filters)
+check("queued frames sent", can.tx_waiting() == 0 and mcp.tx_frames == sent + FRAMES)
+report("reset to frames sent", int(elapsed * 1000000), "us")
+
+print("counters")
+can.tx_service()
+errors = metrics.snapshot()['errors']
+check("warning entered 4 times", errors['warning'] == 4)  # TEC 100, REC 100, TEC 96 on the way to each bus-off
+check("passive entered 3 times", errors['passive'] == 3)
+check("bus-off entered twice", errors['bus_off'] == 2)
+check("one reset", errors['recoveries'] == 1)
+check("metrics match error_stats", errors == can.error_stats())
+print(errors)
+metrics.nv_write(0xFF, 1)
+errors = metrics.snapshot()['errors']
+check("NVSET 0xFF clears them", not errors['bus_off'] and not errors['recoveries'] and not errors['bus_errors'])
+
+if failed:
+    print(str(failed) + " checks failed")
+    sys.exit(1)
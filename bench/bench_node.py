@@ -0,0 +1,169 @@
+# Node throughput benchmarks, run under CPython on the host emulator
+#
+#   python3 bench/bench_node.py
+#
+# Runs can_pico unmodified against an emulated MCP2515 on a virtual CAN bus
+# and reports:
+#   - frames per second through execute() and execute_frame()
+#   - latency from a frame arriving on the bus to the event handler
+#   - time to answer RQNPN 0, NVRD 0 and NERD and get every reply on the bus
+#   - heap retained per received frame by the lib code and the transient peak
+#     (tracemalloc, so CPython's own int and str objects are included)
+#
+# Host figures are for comparing changes, not for the Pico's absolute speed.
+
+import os
+import sys
+import tempfile
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'host'))
+import emulator
+emulator.install()
+
+from time import perf_counter
+import pico02
+from cbus_frame import CbusFrame
+
+FRAMES = 5000
+LATENCY_FRAMES = 500
+ALLOC_FRAMES = 500
+EVENTS = 20
+NODE_ID = 256
+
+config = {
+    "manufacturer": 165,
+    "cpuManufId": 3,
+    "module": 58,
+    "name": "BENCH",
+    "major_version": 1,
+    "minor_version": "A",
+    "beta": 1,
+    "consumer": True,
+    "producer": True,
+    "flim": True,
+    "bootloader": False,
+    "consume_own_events": False,
+    "node_variables": 8,
+    "event_variables": 8,
+    "data_file": "bench_node.json"
+}
+os.chdir(tempfile.mkdtemp())  # The driver keeps CAN_ID.ini in the working directory
+
+
+class BenchNode(pico02.can_pico):
+    def __init__(self):
+        pico02.can_pico.__init__(self, config)
+        self.debug = False
+        self.can.debug = False
+        self.handled = 0
+        self.handled_at = 0
+
+    def my_function(self, event):
+        self.handled += 1
+        self.handled_at = perf_counter()
+
+
+def make_node():
+    board = emulator.Board()
+    node = BenchNode()
+    node.nodeId = NODE_ID
+    node.store.compact_at = 1 << 30
+    for i in range(EVENTS):
+        node.teach_event((NODE_ID << 16) | i, [1, 2, 3, 4, 5, 6, 7, 8, 9])
+    board.run()
+    board.sent = []
+    return board, node
+
+
+def report(name, value, unit):
+    print("  " + (name + " ").ljust(34, '.') + " " + str(value) + " " + unit)
+
+
+def bench_execute(node):
+    print("execute")
+    msg = ":SB040N90%04X0001;" % NODE_ID  # ACON for a taught event
+    start = perf_counter()
+    for i in range(FRAMES):
+        node.execute(msg)
+    elapsed = perf_counter() - start
+    report("execute() frames per second", int(FRAMES / elapsed), "")
+    frame = CbusFrame()
+    frame.from_gc(msg)
+    start = perf_counter()
+    for i in range(FRAMES):
+        node.execute_frame(frame)
+    elapsed = perf_counter() - start
+    report("execute_frame() frames per second", int(FRAMES / elapsed), "")
+
+
+def bench_latency(board, node):
+    print("receive latency")
+    msg = ":SB040N90%04X0002;" % NODE_ID
+    total = 0
+    worst = 0
+    for i in range(LATENCY_FRAMES):
+        handled = node.handled
+        start = perf_counter()
+        board.inject(msg)
+        node.process()
+        if node.handled == handled:
+            print("  frame not handled")
+            return
+        latency = node.handled_at - start
+        total += latency
+        worst = max(worst, latency)
+    report("mean bus to handler", int(total * 1000000 / LATENCY_FRAMES), "us")
+    report("worst bus to handler", int(worst * 1000000), "us")
+
+
+def bench_burst(board, node, name, msg):
+    board.sent = []
+    dropped = node.can.tx_dropped
+    start = perf_counter()
+    node.execute(msg)
+    queued = perf_counter() - start
+    board.run()
+    elapsed = perf_counter() - start
+    report(name + " frames", len(board.sent), "")
+    report(name + " dropped", node.can.tx_dropped - dropped, "")
+    report(name + " queued in", int(queued * 1000000), "us")
+    report(name + " on the bus in", int(elapsed * 1000000), "us")
+
+
+def bench_alloc(board, node):
+    print("allocation")
+    msg = ":SB040N90%04X0003;" % NODE_ID
+    for i in range(10):  # Warm up
+        board.inject(msg)
+        node.process()
+    lib = tracemalloc.Filter(True, os.path.join(emulator.LIB_DIR, '*'))
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot().filter_traces((lib,))
+    current = tracemalloc.get_traced_memory()[0]
+    tracemalloc.reset_peak()
+    for i in range(ALLOC_FRAMES):
+        board.inject(msg)
+        node.process()
+    peak = tracemalloc.get_traced_memory()[1] - current
+    after = tracemalloc.take_snapshot().filter_traces((lib,))
+    tracemalloc.stop()
+    grown = 0
+    blocks = 0
+    for stat in after.compare_to(before, 'lineno'):
+        if stat.size_diff > 0:
+            grown += stat.size_diff
+            blocks += stat.count_diff
+    report("bytes retained per frame", grown // ALLOC_FRAMES, "")
+    report("blocks retained per frame", blocks // ALLOC_FRAMES, "")
+    report("peak transient heap", peak, "bytes")
+
+
+board, node = make_node()
+bench_execute(node)
+bench_latency(board, node)
+print("transmit bursts")
+bench_burst(board, node, "RQNPN 0", ":SB040N73%04X00;" % NODE_ID)
+bench_burst(board, node, "NVRD 0", ":SB040N71%04X00;" % NODE_ID)
+bench_burst(board, node, "NERD", ":SB040N57%04X;" % NODE_ID)
+bench_alloc(board, node)
@@ -0,0 +1,121 @@
+# Frame routing with several logical nodes on one board, run under CPython on
+# the host emulator
+#
+#   python3 bench/bench_nodes.py
+#
+# NODES hosted nodes with EVENTS taught events each share one emulated
+# MCP2515 through a cbus_nodes.NodeHost. Reports frames per second for
+# NodeHost.execute_frame and for offering the same frames to every node in
+# turn, for node addressed frames (NVRD), taught events (ACON) and events
+# no hosted node consumes.
+#
+# Host figures are for comparing changes, not for the Pico's absolute speed.
+
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'host'))
+import emulator
+emulator.install()
+
+from time import perf_counter
+import machine
+import cbus2515
+import cbus_nodes
+from cbus_frame import CbusFrame
+
+NODES = 16
+EVENTS = 20
+FRAMES = 2000
+FIRST_NODE = 256
+
+config = {
+    "manufacturer": 165,
+    "cpuManufId": 3,
+    "module": 58,
+    "name": "BENCH",
+    "major_version": 1,
+    "minor_version": "A",
+    "beta": 1,
+    "consumer": True,
+    "producer": True,
+    "flim": True,
+    "bootloader": False,
+    "consume_own_events": False,
+    "node_variables": 8,
+    "event_variables": 8
+}
+os.chdir(tempfile.mkdtemp())  # The driver keeps CAN_ID.ini and the nodes their data files in the working directory
+
+
+class BenchNode(cbus_nodes.HostedNode):
+    def __init__(self, number):
+        node_config = dict(config)
+        node_config['data_file'] = 'bench_node_%d.json' % number
+        cbus_nodes.HostedNode.__init__(self, node_config)
+        self.handled = 0
+
+    def send(self, msg):
+        pass
+
+    def send_frame(self, frame, wait_ms=0):
+        pass
+
+    def my_function(self, event):
+        self.handled += 1
+
+
+def report(name, value, unit=""):
+    print("  " + (name + " ").ljust(34, '.') + " " + str(value) + " " + unit)
+
+
+def make_host():
+    emulator.Board()
+    can = cbus2515.Cbus2515(machine.SPI(1), machine.Pin(13), machine.Pin(14))
+    host = cbus_nodes.NodeHost(can)
+    for i in range(NODES):
+        node = host.add(BenchNode(i))
+        node.nodeId = FIRST_NODE + i
+        node.store.compact_at = 1 << 30
+        for event in range(EVENTS):
+            node.teach_event(((FIRST_NODE + NODES + i) << 16) | event, [0, 1, 2, 3, 4, 5, 6, 7, 8])
+    return host
+
+
+def frames(msg_format):
+    result = []
+    for i in range(FRAMES):
+        frame = CbusFrame()
+        frame.from_gc(msg_format(i))
+        result.append(frame)
+    return result
+
+
+def rate(func, frame_list):
+    start = perf_counter()
+    for frame in frame_list:
+        func(frame)
+    return int(len(frame_list) / (perf_counter() - start))
+
+
+def every_node(host):
+    nodes = host.nodes
+
+    def execute(frame):
+        for node in nodes:
+            node.execute_frame(frame)
+    return execute
+
+
+host = make_host()
+host.execute_frame(frames(lambda i: ":SB040N9001000000;")[0])  # Builds the event index
+print("%d hosted nodes, %d events each" % (NODES, EVENTS))
+for name, msg_format in (
+        ("NVRD", lambda i: ":SB040N71%04X01;" % (FIRST_NODE + i % NODES)),
+        ("ACON taught", lambda i: ":SB040N90%04X%04X;" % (FIRST_NODE + NODES + i % NODES, i % EVENTS)),
+        ("ACON not taught", lambda i: ":SB040N90%04X%04X;" % (FIRST_NODE + 2 * NODES, i % EVENTS))):
+    frame_list = frames(msg_format)
+    print(name)
+    report("routed frames per second", rate(host.execute_frame, frame_list))
+    report("every node frames per second", rate(every_node(host), frame_list))
@@ -0,0 +1,95 @@
+# SPI register layer micro-benchmark
+#
+# Measures register reads per second and the heap allocated for each frame
+# sent and received. The MCP2515 is put in loopback mode, so no bus is needed.
+# Target: 0 bytes allocated per frame.
+#
+# Run on the Pico with the lib folder on the board:
+#   mpremote run bench/bench_spi.py
+# or on the host, against the emulated MCP2515:
+#   python3 bench/bench_spi.py
+#
+# On the host only the allocations are reported, from tracemalloc filtered to
+# the lib code, as its timings say nothing about the Pico's SPI.
+
+import gc
+import os
+import sys
+
+PICO = sys.implementation.name == 'micropython'
+if not PICO:  # CPython, use the host stand ins
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'host'))
+    import emulator
+    import tempfile
+    import tracemalloc
+    emulator.install()
+    os.chdir(tempfile.mkdtemp())  # The driver keeps CAN_ID.ini in the working directory
+
+from machine import Pin, SPI
+from time import ticks_us, ticks_diff
+import cbus2515
+from cbus_frame import CbusFrame
+
+READS = 2000
+FRAMES = 200
+
+board = None if PICO else emulator.Board()
+spi = SPI(1, sck=Pin(10), mosi=Pin(11), miso=Pin(12), baudrate=10000000)
+can = cbus2515.Cbus2515(spi, Pin(13), Pin(14))
+can.debug = False
+can.change_mode(2)  # Loopback
+
+if PICO:
+    start = ticks_us()
+    for i in range(READS):
+        can.read_reg(cbus2515.CANSTAT)
+    elapsed = ticks_diff(ticks_us(), start)
+    print("SPI transactions per second : " + str(READS * 1000000 // elapsed))
+
+tx = CbusFrame()
+tx.from_gc(":X00000000N9001010002;")  # Extended, so the looped back frame is not our CAN ID
+rx = CbusFrame()
+
+
+def loop_frames():
+    received = 0
+    for i in range(FRAMES):
+        can.send_frame(tx)
+        while not can.in_waiting():
+            if board is not None:
+                board.run()  # The emulated bus only moves when run
+        can.read_frame(rx)
+        received += 1
+    return received
+
+
+loop_frames()  # Warm up, so buffers made once are not counted per frame
+gc.collect()
+if PICO:
+    gc.disable()
+    before = gc.mem_alloc()
+    start = ticks_us()
+    received = loop_frames()
+    elapsed = ticks_diff(ticks_us(), start)
+    allocated = gc.mem_alloc() - before
+    gc.enable()
+    print("Frames looped back          : " + str(received))
+    print("us per frame (TX + RX)      : " + str(elapsed // FRAMES))
+    print("Bytes allocated per frame   : " + str(allocated // FRAMES))
+else:
+    lib = tracemalloc.Filter(True, os.path.join(emulator.LIB_DIR, '*'))
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot().filter_traces((lib,))
+    current = tracemalloc.get_traced_memory()[0]
+    tracemalloc.reset_peak()
+    received = loop_frames()
+    peak = tracemalloc.get_traced_memory()[1] - current
+    after = tracemalloc.take_snapshot().filter_traces((lib,))
+    tracemalloc.stop()
+    retained = 0
+    for stat in after.compare_to(before, 'lineno'):
+        if stat.size_diff > 0:
+            retained += stat.size_diff
+    print("Frames looped back          : " + str(received))
+    print("Bytes retained per frame    : " + str(retained // FRAMES))
+    print("Transient peak bytes        : " + str(peak) + " (emulator included)")
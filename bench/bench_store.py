@@ -0,0 +1,116 @@
+# Compares writing one event variable change with the old full json.dump of
+# the data file against the journaled NodeStore.
+#
+# Run on the Pico with the lib folder on the board:
+#   mpremote run bench/bench_store.py
+# or on the host:
+#   python3 bench/bench_store.py
+
+import json
+import os
+import sys
+
+if sys.implementation.name != 'micropython':  # CPython, use the host stand ins
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'host'))
+    import emulator
+    emulator.install()
+
+from time import ticks_us, ticks_diff
+from cbus_events import EventTable
+import cbus_store
+
+EVENTS = 100
+EVENT_VARIABLES = 8
+DATA_FILE = 'bench_store.json'
+
+
+def make_data():
+    """
+    Node data in the JSON data file layout, every key a node keeps
+    """
+    return {'parameters': ['00'] * 21,
+            'variables': [0] * 9,
+            'manufId': 165,
+            'cpuManufId': 3,
+            'moduleId': 58,
+            'name': 'BENCH',
+            'minorVersion': 'A',
+            'numEvents': 255,
+            'numEventVariables': EVENT_VARIABLES,
+            'numNodeVariables': 8,
+            'majorVersion': 1,
+            'beta': 1,
+            'consumer': True,
+            'producer': True,
+            'flim': True,
+            'bootloader': False,
+            'coe': False,
+            'nodeId': 256}
+
+
+def remove(file_name):
+    binary_file = file_name[:-5] + '.bin'
+    for name in (file_name, file_name + '.jnl', file_name + '.tmp', file_name + '.jnl.tmp',
+                 binary_file, binary_file + '.tmp'):
+        try:
+            os.remove(name)
+        except OSError:
+            pass
+
+
+def report(name, changes, elapsed, written):
+    print(name)
+    print("  changes         : " + str(changes))
+    print("  us per change   : " + str(elapsed // changes))
+    print("  bytes per change: " + str(written // changes))
+
+
+def bench_json():
+    data = make_data()
+    events = EventTable(EVENT_VARIABLES, 255)
+    written = 0
+    start = ticks_us()
+    for event in range(EVENTS):
+        index = events.add((256 << 16) | event)
+        for ev in range(1, EVENT_VARIABLES + 1):
+            events.set(index, ev, ev)
+            data['events'] = events.export()
+            with open(DATA_FILE, 'w') as f:
+                json.dump(data, f)
+            del data['events']
+            written += os.stat(DATA_FILE)[6]
+    report("json.dump per change", EVENTS * EVENT_VARIABLES, ticks_diff(ticks_us(), start), written)
+    remove(DATA_FILE)
+
+
+def bench_journal(policy):
+    data = make_data()
+    data['parameters'] = bytearray(21)  # As NodeStore.load_json leaves them
+    data['variables'] = bytearray(9)
+    events = EventTable(EVENT_VARIABLES, 255)
+
+    def snapshot():
+        full = dict(data)
+        full['events'] = events
+        return full
+
+    store = cbus_store.NodeStore(DATA_FILE, snapshot, policy=policy)
+    store.compact()
+    store.bytes_written = 0
+    start = ticks_us()
+    for event in range(EVENTS):
+        event_identifier = (256 << 16) | event
+        index = events.add(event_identifier)
+        for ev in range(1, EVENT_VARIABLES + 1):
+            events.set(index, ev, ev)
+            store.log(cbus_store.REC_EV, ev, ev, event_identifier)
+    store.flush()
+    report("journal, policy " + str(policy), EVENTS * EVENT_VARIABLES, ticks_diff(ticks_us(), start),
+           store.bytes_written)
+    remove(DATA_FILE)
+
+
+remove(DATA_FILE)
+bench_json()
+bench_journal(cbus_store.FLUSH_IMMEDIATE)
+bench_journal(cbus_store.FLUSH_LEARN)
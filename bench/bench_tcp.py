@@ -0,0 +1,126 @@
+# GridConnect over TCP on the loopback interface, run under CPython
+#
+#   python3 bench/bench_tcp.py
+#
+# A cbus_tcp.GcTransport serves CLIENTS clients on 127.0.0.1. FRAMES frames
+# are sent BATCH at a time, as a bridge's rx_task would after a read, with
+# a yield between batches, while one more client sends frames for the
+# transport to relay. Reports the frames per second every client received,
+# drops, and frames per socket write. A 125 kbit/s CAN bus carries at most
+# about 2600 frames per second (no data bytes) and about 1100 of the 8 data
+# byte frames used here.
+#
+# Then checks that a GcBridge relays a client's frame to the other clients
+# byte for byte, without the CAN ID and priority its controller puts on it.
+#
+# Host figures are for comparing changes, not for a Pico's absolute speed.
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'host'))
+import emulator
+emulator.install()
+
+import asyncio
+import tempfile
+from time import perf_counter
+import machine
+import cbus2515
+import cbus_tcp
+from cbus_frame import CbusFrame
+
+PORT = 15550
+CLIENTS = 8
+FRAMES = 20000
+BATCH = 8
+RELAYED = 2000
+
+
+def report(name, value, unit=""):
+    print("  " + (name + " ").ljust(34, '.') + " " + str(value) + " " + unit)
+
+
+async def count_frames(reader, expected, counts, index):
+    while counts[index] < expected:
+        data = await reader.read(65536)
+        if not data:
+            break
+        counts[index] += data.count(b';')
+
+
+async def send_relayed(writer):
+    msg = b":SB020N9000010002;"
+    for i in range(RELAYED // 10):
+        writer.write(msg * 10)
+        await writer.drain()
+        await asyncio.sleep(0)
+
+
+async def main():
+    transport = cbus_tcp.GcTransport(PORT, '127.0.0.1', max_clients=CLIENTS + 1)
+    received = [0]
+    transport.on_frame = lambda frame, connection: received.__setitem__(0, received[0] + 1) or 0
+    await transport.start()
+    clients = [await asyncio.open_connection('127.0.0.1', PORT) for i in range(CLIENTS + 1)]
+    await asyncio.sleep(0.1)
+    counts = [0] * CLIENTS
+    readers = [asyncio.create_task(count_frames(clients[i][0], FRAMES + RELAYED, counts, i))
+               for i in range(CLIENTS)]
+    frame = CbusFrame()
+    frame.from_gc(":SB020NF2010001000100FF;")
+    start = perf_counter()
+    relay = asyncio.create_task(send_relayed(clients[CLIENTS][1]))
+    for i in range(FRAMES // BATCH):
+        for j in range(BATCH):
+            frame.buf[12] = j
+            transport.send_frame(frame)
+        await asyncio.sleep(0)
+    await relay
+    try:
+        await asyncio.wait_for(asyncio.gather(*readers), 10)
+    except asyncio.TimeoutError:
+        pass
+    elapsed = perf_counter() - start
+    stats = transport.stats()
+    writes = sum(connection['writes'] for connection in stats['connections'])
+    frames_out = sum(connection['frames_out'] for connection in stats['connections'])
+    print("%d clients, %d frames sent in batches of %d, %d relayed" % (CLIENTS, FRAMES, BATCH, RELAYED))
+    report("frames per second per client", int(min(counts) / elapsed))
+    report("frames received by the slowest", min(counts))
+    report("frames relayed to on_frame", received[0])
+    report("frames dropped", sum(connection['dropped'] for connection in stats['connections']))
+    report("frames per socket write", round(frames_out / max(writes, 1), 1))
+    for reader, writer in clients:
+        writer.close()
+    await transport.stop()
+
+
+async def check_relay():
+    os.chdir(tempfile.mkdtemp())  # The driver keeps CAN_ID.ini in the working directory
+    board = emulator.Board()
+    can = cbus2515.Cbus2515(machine.SPI(1), machine.Pin(13), machine.Pin(14))
+    can.change_mode(0)
+    transport = cbus_tcp.GcTransport(PORT + 1, '127.0.0.1')
+    cbus_tcp.GcBridge(can, transport)
+    await transport.start()
+    sender = await asyncio.open_connection('127.0.0.1', PORT + 1)
+    receiver = await asyncio.open_connection('127.0.0.1', PORT + 1)
+    await asyncio.sleep(0.1)
+    msg = b":SB020N9000010002;"  # CAN ID 1 at normal priority, the bridge's CAN ID differs
+    sender[1].write(msg)
+    await sender[1].drain()
+    relayed = await asyncio.wait_for(receiver[0].readuntil(b';'), 5)
+    board.run()
+    print("relay through a GcBridge")
+    report("relayed frame unchanged", "ok" if relayed == msg else "FAILED " + relayed.decode())
+    report("frame sent on the bus", len(board.sent))
+    for reader, writer in (sender, receiver):
+        writer.close()
+    await transport.stop()
+    return relayed == msg
+
+
+asyncio.run(main())
+if not asyncio.run(check_relay()):
+    sys.exit(1)
@@ -0,0 +1,115 @@
+# Runs the node code under CPython
+#
+#   import sys
+#   sys.path.insert(0, 'host')
+#   import emulator
+#   emulator.install()
+#
+# install() puts the machine, micropython and uasyncio stand ins and the lib
+# folder on sys.path and adds the MicroPython ticks functions to time.
+# Board() then builds a virtual CAN bus with an emulated MCP2515 wired the way
+# can_pico expects (SPI 1, CS on GP13, INT on GP14). The bus only moves frames
+# when Board.run() is called, or on every sleep with Board(free_running=True),
+# which code that waits for the bus, such as a reply burst, needs.
+
+import os
+import sys
+import threading
+import time
+
+HOST_DIR = os.path.dirname(os.path.abspath(__file__))
+LIB_DIR = os.path.join(os.path.dirname(HOST_DIR), 'lib')
+
+_TICKS_PERIOD = 1 << 30
+_TICKS_HALF = _TICKS_PERIOD >> 1
+
+
+def ticks_ms():
+    return int(time.monotonic() * 1000) & (_TICKS_PERIOD - 1)
+
+
+def ticks_us():
+    return int(time.monotonic() * 1000000) & (_TICKS_PERIOD - 1)
+
+
+def ticks_cpu():
+    return time.perf_counter_ns() & (_TICKS_PERIOD - 1)
+
+
+def ticks_add(ticks, delta):
+    return (ticks + delta) & (_TICKS_PERIOD - 1)
+
+
+def ticks_diff(ticks1, ticks2):
+    return ((ticks1 - ticks2 + _TICKS_HALF) & (_TICKS_PERIOD - 1)) - _TICKS_HALF
+
+
+_sleep = time.sleep
+idle_hooks = []  # Called after every sleep
+
+
+def sleep(seconds):
+    _sleep(seconds)
+    import machine
+    machine.Timer.run_timers()
+    for hook in idle_hooks:
+        hook()
+
+
+def sleep_ms(ms):
+    sleep(ms / 1000)
+
+
+def sleep_us(us):
+    sleep(us / 1000000)
+
+
+def install():
+    for path in (LIB_DIR, HOST_DIR):
+        if path not in sys.path:
+            sys.path.insert(0, path)
+    time.ticks_ms = ticks_ms
+    time.ticks_us = ticks_us
+    time.ticks_cpu = ticks_cpu
+    time.ticks_add = ticks_add
+    time.ticks_diff = ticks_diff
+    time.sleep = sleep
+    time.sleep_ms = sleep_ms
+    time.sleep_us = sleep_us
+
+
+class Board():
+    """
+    A virtual CAN bus with one emulated MCP2515 on the pins can_pico uses
+    """
+    def __init__(self, bus=None, spi_id=1, cs=13, interrupt=14, free_running=False):
+        """
+        :param free_running: True to run the bus on every sleep
+        """
+        import machine
+        import mcp2515
+        machine.Pin.reset_all()
+        machine.SPI._devices = {}
+        machine.Timer.reset_all()
+        self.bus = bus or mcp2515.VirtualBus()
+        self.mcp2515 = mcp2515.MCP2515(self.bus, spi_id, cs, interrupt)
+        self.sent = []
+        self.lock = threading.Lock()  # A free running bus may be run from both cores' sleeps
+        self.bus.monitors.append(self._monitor)
+        del idle_hooks[:]
+        if free_running:
+            idle_hooks.append(self.run)
+
+    def _monitor(self, frame):
+        self.sent.append(frame)
+
+    def inject(self, msg):
+        self.bus.inject(msg)
+
+    def run(self, limit=-1):
+        with self.lock:
+            return self.bus.run(limit)
+
+    def sent_gc(self):
+        import mcp2515
+        return [mcp2515.frame_to_gc(frame) for frame in self.sent]
@@ -0,0 +1,243 @@
+# CPython stand in for the parts of the RP2040 machine module used by the node
+#
+# Pins are shared by number, so a Pin(14) created by the driver and the one
+# driven by an emulated MCP2515 are the same line. An edge on a pin with an
+# irq handler calls the handler straight away, the way an interrupt preempts
+# the main code on the Pico. Timers are not threads, they run when the code
+# sleeps or calls run_timers().
+
+import time
+
+
+def _ticks_ms():
+    return int(time.monotonic() * 1000)
+
+
+class _PinState():
+    def __init__(self):
+        self.value = 0
+        self.driven = False
+        self.handler = None
+        self.trigger = 0
+        self.pin = None
+        self.listeners = []
+
+
+class Pin():
+    IN = 0
+    OUT = 1
+    OPEN_DRAIN = 2
+    ALT = 3
+    PULL_UP = 1
+    PULL_DOWN = 2
+    IRQ_FALLING = 4
+    IRQ_RISING = 8
+
+    _states = {}
+
+    def __init__(self, id, mode=-1, pull=-1, value=None):
+        self.id = id
+        if id not in Pin._states:
+            Pin._states[id] = _PinState()
+        self._state = Pin._states[id]
+        self.init(mode, pull, value=value)
+
+    def init(self, mode=-1, pull=-1, value=None):
+        if pull == Pin.PULL_UP and not self._state.driven:
+            self._state.value = 1
+        if value is not None:
+            self.value(value)
+
+    def value(self, value=None):
+        state = self._state
+        if value is None:
+            return state.value
+        value = 1 if value else 0
+        old = state.value
+        state.value = value
+        if old == value:
+            return
+        for listener in state.listeners:
+            listener(value)
+        if state.handler is not None:
+            if (value == 0 and state.trigger & Pin.IRQ_FALLING) or (value == 1 and state.trigger & Pin.IRQ_RISING):
+                state.handler(state.pin)
+
+    def __call__(self, value=None):
+        return self.value(value)
+
+    def on(self):
+        self.value(1)
+
+    def off(self):
+        self.value(0)
+
+    high = on
+    low = off
+
+    def irq(self, handler=None, trigger=IRQ_FALLING | IRQ_RISING, hard=False):
+        self._state.handler = handler
+        self._state.trigger = trigger
+        self._state.pin = self
+
+    def drive(self, value):
+        """
+        Host only: an emulated device drives the pin, a pull up no longer sets it
+        """
+        self._state.driven = True
+        self.value(value)
+
+    def listen(self, listener):
+        """
+        Host only: calls listener(value) whenever the pin changes level
+        """
+        self._state.listeners.append(listener)
+
+    @classmethod
+    def reset_all(cls):
+        cls._states = {}
+
+
+class SPI():
+    _devices = {}
+    transactions = 0
+    bytes = 0
+
+    def __init__(self, id, baudrate=1000000, polarity=0, phase=0, bits=8, firstbit=0,
+                 sck=None, mosi=None, miso=None):
+        self.id = id
+        self.baudrate = baudrate
+
+    def __repr__(self):
+        return "SPI(" + str(self.id) + ", baudrate=" + str(self.baudrate) + ")"
+
+    def init(self, baudrate=None, **kwargs):
+        if baudrate is not None:
+            self.baudrate = baudrate
+
+    def deinit(self):
+        pass
+
+    @classmethod
+    def attach(cls, id, device):
+        """
+        Host only: attaches an emulated device, the device must have selected()
+        and transfer(byte)
+        """
+        cls._devices.setdefault(id, []).append(device)
+
+    def _transfer(self, byte):
+        SPI.bytes += 1
+        for device in SPI._devices.get(self.id, ()):
+            if device.selected():
+                return device.transfer(byte)
+        return 0xFF
+
+    def write(self, buf):
+        SPI.transactions += 1
+        for byte in buf:
+            self._transfer(byte)
+
+    def read(self, nbytes, write=0x00):
+        buf = bytearray(nbytes)
+        self.readinto(buf, write)
+        return bytes(buf)
+
+    def readinto(self, buf, write=0x00):
+        SPI.transactions += 1
+        for i in range(len(buf)):
+            buf[i] = self._transfer(write)
+
+    def write_readinto(self, write_buf, read_buf):
+        SPI.transactions += 1
+        for i in range(len(write_buf)):
+            read_buf[i] = self._transfer(write_buf[i])
+
+
+class Timer():
+    ONE_SHOT = 0
+    PERIODIC = 1
+
+    _active = []
+
+    def __init__(self, id=-1, mode=PERIODIC, period=-1, freq=-1, callback=None, tick_hz=1000):
+        self._callback = None
+        if callback is not None:
+            self.init(mode=mode, period=period, freq=freq, callback=callback)
+
+    def init(self, mode=PERIODIC, period=-1, freq=-1, callback=None, tick_hz=1000):
+        if freq > 0:
+            period = 1000 / freq
+        self._mode = mode
+        self._period = max(period, 0)
+        self._callback = callback
+        self._due = _ticks_ms() + self._period
+        if self not in Timer._active:
+            Timer._active.append(self)
+
+    def deinit(self):
+        if self in Timer._active:
+            Timer._active.remove(self)
+
+    @classmethod
+    def run_timers(cls):
+        """
+        Host only: calls the callbacks of timers that are due
+        """
+        now = _ticks_ms()
+        for timer in list(cls._active):
+            if timer._due <= now and timer in cls._active:
+                if timer._mode == Timer.ONE_SHOT:
+                    cls._active.remove(timer)
+                else:
+                    timer._due = now + timer._period
+                if timer._callback is not None:
+                    timer._callback(timer)
+
+    @classmethod
+    def reset_all(cls):
+        cls._active = []
+
+
+class PWM():
+    def __init__(self, pin, freq=None, duty_u16=None):
+        self.pin = pin
+        self._freq = freq or 0
+        self._duty = duty_u16 or 0
+
+    def freq(self, value=None):
+        if value is None:
+            return self._freq
+        self._freq = value
+
+    def duty_u16(self, value=None):
+        if value is None:
+            return self._duty
+        self._duty = value
+
+    def deinit(self):
+        pass
+
+
+def disable_irq():
+    return 0
+
+
+def enable_irq(state=0):
+    pass
+
+
+def idle():
+    Timer.run_timers()
+
+
+def freq(value=None):
+    return 125000000
+
+
+def unique_id():
+    return b'\xe6\x60\x58\x38\x83\x2b\x4b\x2c'
+
+
+def reset():
+    raise SystemExit
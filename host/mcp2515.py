@@ -0,0 +1,480 @@
+# Register level model of an MCP2515 attached to a virtual CAN bus
+#
+# The model answers the SPI instruction set the Cbus2515 driver uses (READ,
+# WRITE, BIT MODIFY, READ STATUS, RX STATUS, READ RX BUFFER, LOAD TX BUFFER,
+# RTS and RESET) on the same SPI bus and chip select pin as the driver, and
+# drives the interrupt pin from CANINTF & CANINTE. Frames move between
+# controllers when VirtualBus.run() is called; the bus arbitrates by CAN ID
+# and each controller offers its highest TXP pending buffer, as the chip does.
+#
+# Error counters follow the CAN rules loosely: with tx_fault set every
+# transmission attempt fails, adding 8 to TEC and raising MERRF, until TEC
+# passes 255 and the controller is bus-off; a sent frame takes 1 off. EFLG
+# and ERRIF follow TEC and REC. set_error_counts() sets them directly and
+# bus_idle() is the 128 x 11 recessive bits that end bus-off.
+#
+# Frames on the bus are 13 bytes in the transmit buffer layout: SIDH, SIDL
+# (EXIDE set for extended frames), EID8, EID0, DLC (RTR in bit 6), D0..D7.
+#
+# An SPI transaction, chip select low to high, holds the controller's lock,
+# and frames arriving from or leaving for the bus take it too, so the driver
+# may run on another thread than the bus, as it does with cbus_dual.
+
+import threading
+from machine import Pin, SPI
+
+CANSTAT = 0x0E
+CANCTRL = 0x0F
+TEC = 0x1C
+REC = 0x1D
+CNF3 = 0x28
+CANINTE = 0x2B
+CANINTF = 0x2C
+EFLG = 0x2D
+TXB0CTRL = 0x30
+RXB0CTRL = 0x60
+RXB1CTRL = 0x70
+
+RX0IF = 0x01
+RX1IF = 0x02
+TX0IF = 0x04
+ERRIF = 0x20
+MERRF = 0x80
+TXREQ = 0x08
+TXERR = 0x10
+ABTF = 0x40
+BUKT = 0x04
+EXIDE = 0x08
+SRR = 0x10
+RTR = 0x40
+RX0OVR = 0x40
+RX1OVR = 0x80
+EWARN = 0x01
+RXWAR = 0x02
+TXWAR = 0x04
+RXEP = 0x08
+TXEP = 0x10
+TXBO = 0x20
+
+MODE_NORMAL = 0
+MODE_SLEEP = 1
+MODE_LOOPBACK = 2
+MODE_LISTEN = 3
+MODE_CONFIG = 4
+
+FILTERS = (0x00, 0x04, 0x08, 0x10, 0x14, 0x18)
+MASKS = (0x20, 0x24)
+
+
+def arbitration_id(frame):
+    sid = (frame[0] << 3) | (frame[1] >> 5)
+    if frame[1] & EXIDE:
+        return (sid << 18) | ((frame[1] & 3) << 16) | (frame[2] << 8) | frame[3]
+    return sid << 18
+
+
+def frame_from_gc(msg):
+    """
+    Builds a bus frame from a GridConnect message, e.g. ":SB020N9001010002;"
+    """
+    frame = bytearray(13)
+    if msg[1] == 'S':
+        header = int(msg[2:6], 16)
+        frame[0] = header >> 8
+        frame[1] = header & 0xE0
+        rtr = msg[6] == 'R'
+        data = bytes.fromhex(msg[7:-1])
+    else:
+        header = int(msg[2:10], 16)
+        frame[0] = header >> 24
+        frame[1] = ((header >> 16) & 0xFF) | EXIDE
+        frame[2] = (header >> 8) & 0xFF
+        frame[3] = header & 0xFF
+        rtr = msg[10] == 'R'
+        data = bytes.fromhex(msg[11:-1])
+    frame[4] = len(data) | (RTR if rtr else 0)
+    frame[5:5 + len(data)] = data
+    return bytes(frame)
+
+
+def frame_to_gc(frame):
+    if frame[1] & EXIDE:
+        msg = ':X' + bytes(frame[0:4]).hex()
+    else:
+        msg = ':S' + bytes(frame[0:2]).hex()
+    msg += 'R' if frame[4] & RTR else 'N'
+    msg += bytes(frame[5:5 + (frame[4] & 15)]).hex()
+    return (msg + ';').upper()
+
+
+class VirtualBus():
+    def __init__(self):
+        self.controllers = []
+        self.monitors = []
+        self.frames = 0
+
+    def attach(self, controller):
+        self.controllers.append(controller)
+
+    def inject(self, frame, sender=None):
+        """
+        Puts a frame on the bus as if another node had sent it
+        :param frame: 13 byte bus frame or a GridConnect string
+        """
+        if isinstance(frame, str):
+            frame = frame_from_gc(frame)
+        self.frames += 1
+        for monitor in self.monitors:
+            monitor(frame)
+        for controller in self.controllers:
+            if controller is not sender:
+                controller.receive(frame)
+
+    def run(self, limit=-1):
+        """
+        Transmits pending frames, one arbitration round per frame
+        :param limit: maximum number of frames, -1 for all
+        :return: number of frames transmitted
+        """
+        sent = 0
+        while sent != limit:
+            winner = None
+            winner_id = 0
+            for controller in self.controllers:
+                n = controller.pending_tx()
+                if n < 0:
+                    continue
+                arb_id = arbitration_id(controller.tx_frame(n))
+                if winner is None or arb_id < winner_id:
+                    winner = (controller, n)
+                    winner_id = arb_id
+            if winner is None:
+                break
+            controller, n = winner
+            if controller.tx_fault:
+                controller.tx_error(n)  # Retried until it gets through or the controller is bus-off
+                continue
+            frame = controller.tx_complete(n)
+            if controller.mode() == MODE_LOOPBACK:
+                controller.receive(frame)
+            else:
+                self.inject(frame, controller)
+            sent += 1
+        return sent
+
+
+class MCP2515():
+    def __init__(self, bus, spi_id=1, cs=13, interrupt=14):
+        self.bus = bus
+        self.regs = bytearray(128)
+        self.lock = threading.RLock()
+        self.cs_pin = Pin(cs)
+        self.cs_pin.listen(self._chip_select)
+        self.int_pin = Pin(interrupt)
+        self.int_pin.drive(1)
+        self.selected_now = False
+        self.command = -1
+        self.phase = 0
+        self.address = 0
+        self.mask = 0
+        self.clear_on_end = 0
+        self.rx_frames = 0
+        self.rx_overflows = 0
+        self.tx_frames = 0
+        self.tx_fault = False
+        self.tec = 0
+        self.rec = 0
+        self.reset()
+        SPI.attach(spi_id, self)
+        bus.attach(self)
+
+    def reset(self):
+        for i in range(128):
+            self.regs[i] = 0
+        self.regs[CANCTRL] = 0x87
+        self.regs[CANSTAT] = 0x80
+        self.tec = 0
+        self.rec = 0
+        self._update_int()
+
+    def mode(self):
+        return self.regs[CANSTAT] >> 5
+
+    def selected(self):
+        return self.selected_now
+
+    def _chip_select(self, value):
+        if value == 0:
+            self.lock.acquire()
+            self.selected_now = True
+            self.command = -1
+            self.phase = 0
+        elif self.selected_now:
+            self.selected_now = False
+            if self.clear_on_end:
+                self.regs[CANINTF] &= ~self.clear_on_end
+                self.clear_on_end = 0
+            self.command = -1
+            self.lock.release()
+            self._update_int()
+
+    def _update_int(self):
+        self.int_pin.drive(0 if self.regs[CANINTF] & self.regs[CANINTE] else 1)
+
+    def status(self):
+        intf = self.regs[CANINTF]
+        status = intf & 3
+        for n in range(3):
+            if self.regs[TXB0CTRL + 16 * n] & TXREQ:
+                status |= 4 << (2 * n)
+            if intf & (TX0IF << n):
+                status |= 8 << (2 * n)
+        return status
+
+    def transfer(self, byte):
+        if self.command < 0:
+            self.command = byte
+            self.phase = 0
+            if byte == 0xC0:
+                self.reset()
+            elif 0x90 <= byte <= 0x96 and not byte & 1:
+                n = (byte >> 2) & 1
+                self.address = (RXB1CTRL if n else RXB0CTRL) + (6 if byte & 2 else 1)
+                self.clear_on_end = RX1IF if n else RX0IF
+            elif 0x40 <= byte <= 0x45:
+                self.address = TXB0CTRL + 16 * (byte >> 1 & 3) + (6 if byte & 1 else 1)
+            elif 0x81 <= byte <= 0x87:
+                for n in range(3):
+                    if byte & (1 << n):
+                        self._write(TXB0CTRL + 16 * n, self.regs[TXB0CTRL + 16 * n] | TXREQ)
+            return 0
+        command = self.command
+        self.phase += 1
+        if command == 0x03:  # READ
+            if self.phase == 1:
+                self.address = byte & 0x7F
+                return 0
+            value = self.regs[self.address]
+            self.address = (self.address + 1) & 0x7F
+            return value
+        if command == 0x02:  # WRITE
+            if self.phase == 1:
+                self.address = byte & 0x7F
+            else:
+                self._write(self.address, byte)
+                self.address = (self.address + 1) & 0x7F
+            return 0
+        if command == 0x05:  # BIT MODIFY
+            if self.phase == 1:
+                self.address = byte & 0x7F
+            elif self.phase == 2:
+                self.mask = byte
+            elif self.phase == 3:
+                value = self.regs[self.address]
+                self._write(self.address, (value & ~self.mask) | (byte & self.mask))
+            return 0
+        if command == 0xA0:  # READ STATUS
+            return self.status()
+        if command == 0xB0:  # RX STATUS
+            intf = self.regs[CANINTF]
+            return ((intf & RX0IF) << 6) | ((intf & RX1IF) << 6)
+        if 0x90 <= command <= 0x96:  # READ RX BUFFER
+            value = self.regs[self.address]
+            self.address = (self.address + 1) & 0x7F
+            return value
+        if 0x40 <= command <= 0x45:  # LOAD TX BUFFER
+            self._write(self.address, byte)
+            self.address = (self.address + 1) & 0x7F
+            return 0
+        return 0
+
+    def _write(self, address, value):
+        regs = self.regs
+        value &= 0xFF
+        if address < 0x28 and address & 0x0F < 0x0C or CNF3 <= address <= 0x2A:
+            if self.mode() != MODE_CONFIG:
+                return  # Filters, masks and timing only change in configuration mode
+        if address & 0x0F == 0x0E:
+            return  # CANSTAT is read only
+        if address & 0x0F == 0x0F:
+            regs[address] = value
+            regs[CANSTAT] = (regs[CANSTAT] & 0x1F) | (value & 0xE0)
+            if value & 0x10:  # ABAT
+                for n in range(3):
+                    self._abort(n)
+            return
+        if address in (TEC, REC):
+            return
+        if address == EFLG:
+            regs[EFLG] &= value | 0x3F  # Only the overflow flags can be cleared
+            return
+        if TXB0CTRL <= address <= 0x50 and address & 0x0F == 0:
+            n = (address - TXB0CTRL) >> 4
+            old = regs[address]
+
+            if value & TXREQ and not old & TXREQ:
+                regs[address] = value & 0x0B
+            elif old & TXREQ and not value & TXREQ:
+                self._abort(n)
+                regs[address] = (regs[address] & ~3) | (value & 3)
+            else:
+                regs[address] = (old & 0x70) | (value & 0x0B)
+            return
+        regs[address] = value
+
+    def _abort(self, n):
+        ctrl = TXB0CTRL + 16 * n
+        if self.regs[ctrl] & TXREQ:
+            self.regs[ctrl] = (self.regs[ctrl] & ~TXREQ) | ABTF
+
+    def pending_tx(self):
+        """
+        Returns the buffer the controller would transmit next, -1 if none
+        """
+        with self.lock:
+            return self._pending_tx()
+
+    def _pending_tx(self):
+        if self.mode() not in (MODE_NORMAL, MODE_LOOPBACK) or self.regs[EFLG] & TXBO:
+            return -1
+        best = -1
+        best_txp = -1
+        for n in range(3):
+            ctrl = self.regs[TXB0CTRL + 16 * n]
+            if ctrl & TXREQ and ctrl & 3 >= best_txp:
+                best = n
+                best_txp = ctrl & 3
+        return best
+
+    def tx_frame(self, n):
+        base = TXB0CTRL + 16 * n + 1
+        return self.regs[base:base + 13]
+
+    def tx_complete(self, n):
+        with self.lock:
+            frame = bytes(self.tx_frame(n))
+            self.regs[TXB0CTRL + 16 * n] &= ~(TXREQ | TXERR)
+            self.regs[CANINTF] |= TX0IF << n
+            self.tx_frames += 1
+            if self.tec:
+                self._errors(self.tec - 1, self.rec)
+        self._update_int()
+        return frame
+
+    def tx_error(self, n):
+        """
+        A failed transmission attempt, the buffer stays pending
+        """
+        with self.lock:
+            self.regs[TXB0CTRL + 16 * n] |= TXERR
+            self.regs[CANINTF] |= MERRF
+            self._errors(self.tec + 8, self.rec)
+        self._update_int()
+
+    def set_error_counts(self, tec, rec):
+        """
+        Host only: sets TEC and REC, a TEC over 255 is bus-off
+        """
+        with self.lock:
+            self._errors(tec, rec)
+        self._update_int()
+
+    def bus_idle(self):
+        """
+        Host only: the bus has been idle long enough for a bus-off controller to recover
+        """
+        if self.tec > 255:
+            self.set_error_counts(0, 0)
+
+    def _errors(self, tec, rec):
+        self.tec = tec
+        self.rec = rec
+        regs = self.regs
+        regs[TEC] = min(tec, 255)
+        regs[REC] = min(rec, 255)
+        flags = 0
+        if tec > 255:
+            flags |= TXBO
+        if tec >= 128:
+            flags |= TXEP
+        if rec >= 128:
+            flags |= RXEP
+        if tec >= 96:
+            flags |= TXWAR
+        if rec >= 96:
+            flags |= RXWAR
+        if flags & (TXWAR | RXWAR):
+            flags |= EWARN
+        old = regs[EFLG]
+        if flags != old & 0x3F:
+            regs[EFLG] = (old & 0xC0) | flags
+            regs[CANINTF] |= ERRIF
+
+    def _match(self, filter_base, mask_base, frame):
+        regs = self.regs
+        extended = frame[1] & EXIDE != 0
+        if (regs[filter_base + 1] & EXIDE != 0) != extended:
+            return False
+        if (frame[0] ^ regs[filter_base]) & regs[mask_base]:
+            return False
+        if (frame[1] ^ regs[filter_base + 1]) & regs[mask_base + 1] & 0xE3:
+            return False
+        if extended:
+            first, second = frame[2], frame[3]
+        else:
+            # Standard frames match EID8/EID0 against the first two data bytes
+            first = frame[5] if frame[4] & 15 > 0 else 0
+            second = frame[6] if frame[4] & 15 > 1 else 0
+        if (first ^ regs[filter_base + 2]) & regs[mask_base + 2]:
+            return False
+        if (second ^ regs[filter_base + 3]) & regs[mask_base + 3]:
+            return False
+        return True
+
+    def _accept(self, ctrl, mask_base, filters, frame):
+        if (self.regs[ctrl] >> 5) & 3 == 3:
+            return True
+        for filter_base in filters:
+            if self._match(filter_base, mask_base, frame):
+                return True
+        return False
+
+    def receive(self, frame):
+        with self.lock:
+            self._receive(frame)
+
+    def _receive(self, frame):
+        if self.mode() not in (MODE_NORMAL, MODE_LISTEN, MODE_LOOPBACK):
+            return
+        regs = self.regs
+        if self._accept(RXB0CTRL, MASKS[0], FILTERS[0:2], frame):
+            target = 0
+            if regs[CANINTF] & RX0IF:
+                if regs[RXB0CTRL] & BUKT:
+                    target = 1
+                else:
+                    self._overflow(RX0OVR)
+                    return
+        elif self._accept(RXB1CTRL, MASKS[1], FILTERS[2:], frame):
+            target = 1
+        else:
+            return
+        if target == 1 and regs[CANINTF] & RX1IF:
+            self._overflow(RX1OVR)
+            return
+        base = (RXB1CTRL if target else RXB0CTRL) + 1
+        regs[base:base + 13] = frame
+        if not frame[1] & EXIDE:
+            regs[base + 1] &= 0xE0
+            if frame[4] & RTR:
+                regs[base + 1] |= SRR
+            regs[base + 4] = frame[4] & 15
+        regs[CANINTF] |= RX1IF if target else RX0IF
+        self.rx_frames += 1
+        self._update_int()
+
+    def _overflow(self, flag):
+        self.rx_overflows += 1
+        self.regs[EFLG] |= flag
+        self.regs[CANINTF] |= ERRIF
+        self._update_int()
@@ -0,0 +1,26 @@
+# CPython stand in for the micropython module
+
+
+def const(value):
+    return value
+
+
+def native(func):
+    return func
+
+
+def viper(func):
+    return func
+
+
+def schedule(func, arg):
+    func(arg)
+    return True
+
+
+def alloc_emergency_exception_buf(size):
+    pass
+
+
+def mem_info(verbose=None):
+    pass
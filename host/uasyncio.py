@@ -0,0 +1,40 @@
+# CPython stand in for uasyncio
+
+from asyncio import *  # noqa: F401,F403
+import asyncio
+
+
+def sleep_ms(ms):
+    return asyncio.sleep(ms / 1000)
+
+
+class ThreadSafeFlag():
+    """
+    Flag that may be set from an interrupt handler or another thread and
+    waited on by a single task
+    """
+    def __init__(self):
+        self._loop = None
+        self._event = asyncio.Event()
+
+    def set(self):
+        loop = self._loop
+        if loop is None:
+            self._event.set()
+            return
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is loop:
+            self._event.set()
+        else:
+            loop.call_soon_threadsafe(self._event.set)
+
+    def clear(self):
+        self._event.clear()
+
+    async def wait(self):
+        self._loop = asyncio.get_running_loop()
+        await self._event.wait()
+        self._event.clear()
@@ -1,7 +1,18 @@
 # from machine import Pin, SPI, Timer
 # import time
 # import cbus2515
-import json
+from cbus_frame import CbusFrame
+from cbus_events import EventTable
+from cbus_actions import ActionEngine
+from cbus_metrics import Metrics, METRICS_NV
+import cbus_store
+from cbus_log import trace, TR_RX, TR_HANDLER, TR_EVENT, TR_NO_HANDLER, TR_BAD_LENGTH
+from micropython import const
+
+_TRACE = const(0)  # cbus_log levels: 0 off, 1 faults, 3 faults and every frame
+_TR_FAULTS = const(1)
+_TR_FRAMES = const(2)
+REPLY_WAIT_MS = const(500)  # How long a configuration reply waits for room in the transmit queue
 # import io
 # import os
 
@@ -20,23 +31,33 @@ class CbusNode:
         self.interface = 2  # 1 can, 2 ethernet
         self.intOut = 0
         self.chrOut = ""
+        self.rx_frame = CbusFrame()
+        self.tx_frame = CbusFrame()
+        self.metrics = Metrics()
+        self.header_key = -1
+        self.header = ""
+        self.can_filters = False  # Set once the handlers are registered
         
-        try:
-            with open(self.data_file) as f:
-                self.data = json.load(f)
-                self.nodeId = self.data['nodeId']
-        except OSError:
+        self.store = cbus_store.NodeStore(self.data_file, self.snapshot,
+                                          policy=config.get("flush_policy", cbus_store.FLUSH_IMMEDIATE),
+                                          delay=config.get("flush_delay", 500),
+                                          compact_at=config.get("journal_records", 256))
+        self.data = self.store.load()
+        new_node = self.data is None
+        if not new_node:
+            self.nodeId = self.data['nodeId']
+        else:
             print('Initialise Module')
             print('create flim_data_test.json')
-            self.data = {'parameters': [],
-                         'variables': [0] * (config["node_variables"] + 1),
-                         'events': {},
+            self.data = {'parameters': bytearray(),
+                         'variables': bytearray(config["node_variables"] + 1),
+                         'events': [],
                          'manufId': config["manufacturer"],
                          'cpuManufId':config["cpuManufId"],
                          'moduleId': config["module"],
                          'name': config["name"],
                          'minorVersion': config["minor_version"],
-                         'numEvents': 255,
+                         'numEvents': config.get("num_events", 255),
                          'numEventVariables': config["event_variables"],
                          'numNodeVariables': config["node_variables"],
                          'majorVersion': config["major_version"],
@@ -49,56 +70,130 @@ class CbusNode:
                          'nodeId': 0
                          }
 
-            self.data['parameters'].append(self.pad(20, 2))
-            self.data['parameters'].append(self.pad(self.data['manufId'], 2))
-            self.data['parameters'].append(self.pad(ord(self.data['minorVersion']), 2))  # Character
-            self.data['parameters'].append(self.pad(self.data['moduleId'], 2))
-            self.data['parameters'].append(self.pad(self.data['numEvents'], 2))
-            self.data['parameters'].append(self.pad(self.data['numEventVariables'], 2))            
-            self.data['parameters'].append(self.pad(self.data['numNodeVariables'], 2))
-            self.data['parameters'].append(self.pad(self.data['majorVersion'], 2))
-            self.data['parameters'].append(self.pad(self.flags(), 2))
-            self.data['parameters'].append(self.pad(0, 2))
-            self.data['parameters'].append(self.pad(self.interface, 2))
-            self.data['parameters'].append(self.pad(0, 2))
-            self.data['parameters'].append(self.pad(0, 2))
-            self.data['parameters'].append(self.pad(0, 2))
-            self.data['parameters'].append(self.pad(0, 2))
-            self.data['parameters'].append(self.pad(0, 2))
-            self.data['parameters'].append(self.pad(0, 2))
-            self.data['parameters'].append(self.pad(0, 2))
-            self.data['parameters'].append(self.pad(0, 2))
-            self.data['parameters'].append(self.pad(self.data['cpuManufId'], 2))
-            self.data['parameters'].append(self.pad(self.data['beta'], 2))
+            self.data['parameters'].append(20)
+            self.data['parameters'].append(self.data['manufId'])
+            self.data['parameters'].append(ord(self.data['minorVersion']))  # Character
+            self.data['parameters'].append(self.data['moduleId'])
+            self.data['parameters'].append(min(self.data['numEvents'], 255))
+            self.data['parameters'].append(self.data['numEventVariables'])            
+            self.data['parameters'].append(self.data['numNodeVariables'])
+            self.data['parameters'].append(self.data['majorVersion'])
+            self.data['parameters'].append(self.flags())
+            self.data['parameters'].append(0)
+            self.data['parameters'].append(self.interface)
+            self.data['parameters'].append(0)
+            self.data['parameters'].append(0)
+            self.data['parameters'].append(0)
+            self.data['parameters'].append(0)
+            self.data['parameters'].append(0)
+            self.data['parameters'].append(0)
+            self.data['parameters'].append(0)
+            self.data['parameters'].append(0)
+            self.data['parameters'].append(self.data['cpuManufId'])
+            self.data['parameters'].append(self.data['beta'])
 
             print("New Node")
             self.nodeId = self.data['nodeId']
+
+        # The config decides whether produced events are consumed, also for nodes created before it was set
+        if self.data['coe'] != config.get("consume_own_events", self.data['coe']):
+            self.data['coe'] = config["consume_own_events"]
+            self.data['parameters'][8] = self.flags()
+        self.events = EventTable(self.data['numEventVariables'], self.data['numEvents'])
+        # Encoded responses, cleared when the header or node number changes
+        self.cache_header = -1
+        self.cache_node = -1
+        self.parameter_cache = [None] * len(self.data['parameters'])
+        self.nvans_cache = [None] * len(self.data['variables'])
+        self.ensrp_cache = [None] * min(self.data['numEvents'], 255)
+        self.ensrp_changes = -1
+        self.events.load(self.data.pop('events'))
+        self.action_engine = ActionEngine(self.events)  # Not self.actions, subclasses use that name for their own tables
+        if new_node:
             self.save_data()
+        else:
+            self.store.replay(self.apply_record)
+            if self.store.migrated:  # First boot since the data was JSON
+                self.save_data()
 
-        self.actions = {
-            "53": self.learn_mode_on,
-            "54": self.learn_mode_off,
-            "57": self.send_all_events,
-            "58": self.send_number_of_events,
-            "71": self.read_nv,
-            "90": self.acc_on,
-            "91": self.acc_off,
-            "95": self.remove_event,
-            "96": self.write_nv,
-            "98": self.asc_on,
-            "99": self.asc_off,
-            "73": self.paran,
-            "0D": self.qnn,
-            "9C": self.read_ev,
-            "D2": self.write_ev,
-            "10": self.params,
-            "42": self.set_node_id
-            }
+        self.handlers = [None] * 256
+        self.any_node = []  # Opcodes wanted whatever node number they carry
+        for opcode, func, any_node in (
+                (0x53, self.learn_mode_on, False),
+                (0x54, self.learn_mode_off, False),
+                (0x57, self.send_all_events, False),
+                (0x58, self.send_number_of_events, False),
+                (0x71, self.read_nv, False),
+                (0x90, self.acc_on, False),
+                (0x91, self.acc_off, False),
+                (0x95, self.remove_event, False),
+                (0x96, self.write_nv, False),
+                (0x98, self.asc_on, True),
+                (0x99, self.asc_off, True),
+                (0x73, self.paran, False),
+                (0x0D, self.qnn, True),
+                (0x9C, self.read_ev, False),
+                (0xD2, self.write_ev, False),
+                (0x10, self.params, True),
+                (0x42, self.set_node_id, True),
+        ):
+            self.register_opcode(opcode, func, any_node)
+        self.can_filters = config.get("can_filters", False)
+
+    def register_action(self, action_type, func):
+        """
+        Registers the function for an action type taught in event variables,
+        see cbus_actions. Events with actions run them instead of my_function.
+        :param action_type: 1 - 255, e.g. cbus_actions.ACTION_LED
+        :param func: function(target, param, on)
+        """
+        self.action_engine.register(action_type, func)
+
+    def register_opcode(self, opcode, func, any_node=True):
+        """
+        Registers the handler for an opcode, replacing any existing handler
+        :param opcode: CBUS opcode 0x00 - 0xFF
+        :param func: function called with the received CbusFrame, None to ignore the opcode
+        :param any_node: False if the opcode is only wanted when it carries this node's
+                         number or a taught event's node number, so CAN filters can drop it
+        """
+        self.handlers[opcode] = func
+        if opcode in self.any_node:
+            self.any_node.remove(opcode)
+        if func is not None and any_node:
+            self.any_node.append(opcode)
+        self.update_filters()
+
+    def update_filters(self):
+        """
+        Works out which frames the node needs and passes them to set_filters.
+        Everything is received while learning or without a node number.
+        """
+        if not self.can_filters:
+            return
+        if self.learn or self.nodeId == 0:
+            self.set_filters(None, None)
+            return
+        node_numbers = [self.nodeId >> 8]
+        for index in range(len(self.events)):
+            event_identifier = self.events.event_id(index)
+            if event_identifier >> 16:  # Long event, node numbers 1 - 255 have high byte 0
+                node_number = event_identifier >> 24
+                if node_number not in node_numbers:
+                    node_numbers.append(node_number)
+        self.set_filters(node_numbers, self.any_node)
+
+    def set_filters(self, node_numbers, opcodes):
+        """
+        Overridden by nodes with a CAN controller that can filter frames
+        :param node_numbers: node number high bytes wanted in any opcode, None for all frames
+        :param opcodes: opcodes wanted from any node, None for all frames
+        """
+        pass
 
     @staticmethod
     def pad(num, length):
-        output = '0000000000' + hex(num)[2:]
-        return output[length * -1:]
+        return ('%010x' % num)[length * -1:]
 
     @staticmethod
     def get_int(msg, start, length):
@@ -108,11 +203,49 @@ class CbusNode:
     def get_str(msg, start, length):
         return msg[start: start + length]
 
+    def snapshot(self):
+        data = dict(self.data)
+        data['events'] = self.events
+        return data
+
     def save_data(self):
+        """
+        Writes a complete snapshot of the node data. Single changes are journaled
+        through self.store.log instead.
+        """
         if self.debug:
             print('save_data : '+self.data_file)
-        with open(self.data_file, 'w') as f:
-            json.dump(self.data, f)
+        self.store.compact()
+
+    def export_data(self, file_name=None):
+        """
+        Writes the node data as JSON for reading or editing by hand
+        :param file_name: defaults to the data_file from the config
+        """
+        self.store.export_json(file_name)
+
+    def apply_record(self, kind, a, b, event_identifier):
+        """
+        Applies a journal record, records with values out of range are skipped
+        """
+        if kind == cbus_store.REC_NV:
+            if a >= len(self.data['variables']) or b > 255:
+                if self.debug: print("Bad NV record", a, b)
+                return
+            self.data['variables'][a] = b
+            self.nvans_cache[a] = None
+        elif kind == cbus_store.REC_EV:
+            if a >= self.events.width or b > 255:
+                if self.debug: print("Bad EV record", a, b)
+                return
+            index = self.events.add(event_identifier)
+            if index >= 0:
+                self.events.set(index, a, b)
+        elif kind == cbus_store.REC_REMOVE:
+            self.events.remove(event_identifier)
+        elif kind == cbus_store.REC_NODE:
+            self.data['nodeId'] = b
+            self.nodeId = b
 
     def get_op_code(self, msg):
         return self.get_str(msg, 7, 2)
@@ -120,6 +253,7 @@ class CbusNode:
     def get_node_id(self, msg):
         return int(self.get_str(msg, 9, 4), 16)
 
+
     def get_header(self):
         output = 0
         output = output + self.priority1
@@ -127,13 +261,26 @@ class CbusNode:
         output = output + self.priority2
         output = output << 7
         output = output + self.canId
-        output = output << 5
-        # print(str(output))
-        # return str(output)
-        # print (":S"+format(output, '02x')+"N")
-        # return ":S"+format(output, '02x')+"N"
-        return ":S" + hex(output)[2:] + "N"
-        # return ":SB020N"
+        if output != self.header_key:  # Only rebuilt when the priority or CAN ID changes
+            self.header_key = output
+            self.header = ":S" + hex(output << 5)[2:] + "N"
+        return self.header
+
+    def priority(self):
+        return (self.priority1 << 2) + self.priority2
+
+    def check_cache(self):
+        """
+        Empties the response cache if the header or node number has changed
+        since the responses were encoded
+        """
+        self.get_header()
+        if self.header_key != self.cache_header or self.nodeId != self.cache_node:
+            self.cache_header = self.header_key
+            self.cache_node = self.nodeId
+            for cache in (self.parameter_cache, self.nvans_cache, self.ensrp_cache):
+                for i in range(len(cache)):
+                    cache[i] = None
 
     def flags(self):
         flags = 0
@@ -168,418 +315,461 @@ class CbusNode:
         """
         print("Merg LCB NODE Send : " + msg)
 
+    def send_frame(self, frame, wait_ms=0):
+        """
+        Sends a frame built with CbusFrame.build. Network classes that can
+        take the frame directly override this, otherwise it goes to send()
+        as GridConnect.
+        :param frame: CbusFrame
+        :param wait_ms: time to wait for room if the transmit queue is full
+        """
+        self.send(frame.to_gc())
+
+    def send_reply(self, frame):
+        """
+        Sends a reply to a configuration request. Replies come in bursts, a
+        NERD answers with one ENRSP per event, so they wait for room in the
+        transmit queue rather than being dropped.
+        :param frame: CbusFrame
+        :return: 0 if sent, non zero if the bus did not take it in time
+        """
+        return self.send_frame(frame, REPLY_WAIT_MS)
+
     def acon(self, event_id):
         """
         Sends a Accessory On Long Event to the CBUS Network
         :param event_id: Id for the event
         """
-        output = self.get_header() + "90" + self.pad(self.nodeId, 4) + self.pad(event_id, 4) + ";"
-        self.send(output)
-        if self.get_str(output, 9, 8) in self.data['events']:
-            print("Local Event is Known")
-            if self.debug:
-                print("Local Event is Known")
-            # self.execute({'task': 'on', 'variables': self.events[self.get_str(msg, 9, 8)]})
-            self.my_function({'task': 'on', 'variables': self.data['events'][self.get_str(output, 9, 8)]['variables']})
+        if self.data['coe']:
+            self.local_event(True, (self.nodeId << 16) | event_id)
+        self.send_frame(self.tx_frame.build(0x90, self.nodeId, event_id, self.priority()))
 
     def acof(self, event_id):
-        output = self.get_header() + "91" + self.pad(self.nodeId, 4) + self.pad(event_id, 4) + ";"
-        self.send(output)
-        if self.get_str(output, 9, 8) in self.data['events']:
-            print("Local Event is Known")
-            if self.debug:
-                print("Local Event is Known")
-            # self.execute({'task': 'on', 'variables': self.events[self.get_str(msg, 9, 8)]})
-            self.my_function({'task': 'off', 'variables': self.data['events'][self.get_str(output, 9, 8)]['variables']})
+        if self.data['coe']:
+            self.local_event(False, (self.nodeId << 16) | event_id)
+        self.send_frame(self.tx_frame.build(0x91, self.nodeId, event_id, self.priority()))
 
     def ason(self, event_id):
-        print("ASON :" + str(event_id))
-        output = self.get_header() + "98" + self.pad(self.nodeId, 4) + self.pad(event_id, 4) + ";"
-        self.send(output)
+        if self.data['coe']:
+            self.local_event(True, event_id)
+        self.send_frame(self.tx_frame.build(0x98, self.nodeId, event_id, self.priority()))
         if self.debug:
-            print('ASON : '+output)
+            print('ASON : ' + self.tx_frame.to_gc())
 
     def asof(self, event_id):
-        output = self.get_header() + "99" + self.pad(self.nodeId, 4) + self.pad(event_id, 4) + ";"
-        self.send(output)
+        if self.data['coe']:
+            self.local_event(False, event_id)
+        self.send_frame(self.tx_frame.build(0x99, self.nodeId, event_id, self.priority()))
+
+    def local_event(self, on, event_identifier):
+        """
+        Consumes an event this node produces, before it is queued for the bus.
+        Only called when consume_own_events is set, as the bus never returns
+        a node's own frames.
+        :param on: True for ACON/ASON
+        :param event_identifier: node number << 16 | event number, or the event number of a short event
+        """
+        index = self.events.find(event_identifier)
+        if index >= 0:
+            if self.debug:
+                print("Local Event is Known")
+            self.consume(index, on)
+
+    def consume(self, index, on):
+        """
+        Runs the actions of a taught event, or passes it to my_function if it has none,
+        with the event variables copied to bytes so my_function can keep them
+        :param index: event index
+        :param on: True for ACON/ASON
+        """
+        if not self.action_engine.run(index, on):
+            self.my_function({'task': 'on' if on else 'off', 'variables': bytes(self.events.variables(index))})
 
     def pnn(self):
-        output = self.get_header() + "B6" + self.pad(self.nodeId, 4) + self.pad(self.data['manufId'], 2) + self.pad(
-            self.data['moduleId'], 2) + self.pad(self.flags(), 2) + ";"
-        self.send(output)
+        frame = self.tx_frame.build(0xB6, self.nodeId, (self.data['manufId'] << 8) | self.data['moduleId'],
+                                    self.priority())
+        frame.put(5, self.flags())
+        self.send_reply(frame)
 
     # def heartb(self):
     #     output = self.get_header() + "AB" + self.pad(self.nodeId, 4) + '000000'+";"
     #     self.send(output)
         
     def rqnn(self):
-        output = self.get_header() + "50" + "0000;"
         self.learn = True
-        self.send(output)
+        self.update_filters()
+        self.send_frame(self.tx_frame.build(0x50, 0, 0, self.priority()))
 
     def set_parameter(self, param, value):
-        self.data['parameters'][param] = self.pad(value, 2)
+        self.data['parameters'][param] = value
+        self.parameter_cache[param] = None
 
     def parameter(self, param):
+        """
+        Returns PARAN for a parameter, from the response cache
+        :param param: parameter index
+        :return: the node's tx_frame
+        """
         if self.debug:
             print("parameter : " + str(self.nodeId) + " : " + str(param) + " : " + str(self.data['parameters'][param]))
-        output = self.get_header() + "9B" + self.pad(self.nodeId, 4) + self.pad(param, 2) + self.data['parameters'][param] + ";"
-        if self.debug:
-            print("parameter output : " + output)
-        return output
-    
+        self.check_cache()
+        cached = self.parameter_cache[param]
+        if cached is not None:
+            self.tx_frame.load(cached)
+            return self.tx_frame
+        frame = self.tx_frame.build(0x9B, self.nodeId, (param << 8) | self.data['parameters'][param], self.priority())
+        self.parameter_cache[param] = bytes(frame.buf)
+        return frame
+
     def parameters(self):
-        print('Parameters')
-        output = self.get_header() + "EF"
-        output = output + self.data['parameters'][1] 
-        output = output + self.data['parameters'][2]
-        output = output + self.data['parameters'][3]
-        output = output + self.data['parameters'][4]
-        output = output + self.data['parameters'][5]
-        output = output + self.data['parameters'][6]
-        output = output + self.data['parameters'][7]
-        output = output + ";"
-        self.send(output)
+        if self.debug:
+            print('Parameters')
+        parameters = self.data['parameters']
+        frame = self.tx_frame.build(0xEF, (parameters[1] << 8) | parameters[2], (parameters[3] << 8) | parameters[4],
+                                    self.priority())
+        frame.put(5, parameters[5])
+        frame.put(6, parameters[6])
+        frame.put(7, parameters[7])
+        self.send_reply(frame)
 
     def teach_long_event(self, node_id, event_id, variables):
         """
         Teaches a long CBUS event to the module
         :param node_id: node id of the event
         :param event_id: event od of the event
-        :param variables: Variable that will be sent to the function when event
-                is received. Can be String, number, list etc
+        :param variables: list of event variable values, variables[n] is EV n
         """
-        new_id = self.pad(node_id, 4) + self.pad(event_id, 4)
-        # self.events[new_id] = variables
-        self.data['events'][new_id.upper()] = variables
-        if self.debug:
-            print(self.events)
+        self.teach_event((node_id << 16) | event_id, variables)
 
     def teach_short_event(self, event_id, variables):
         """
         Teaches a short CBUS event to the module
         :param event_id: event of the short event
-        :param variables: Variable that will be sent to the function when event
-               is received. Can be String, number, list etc
+        :param variables: list of event variable values, variables[n] is EV n
         """
-        new_id = self.pad(0, 4) + self.pad(event_id, 4)
-        # self.events[new_id] = variables
-        self.data['events'][new_id.upper()] = variables
+        self.teach_event(event_id, variables)
+
+    def teach_event(self, event_identifier, variables):
+        index = self.events.add(event_identifier)
+        if index < 0:
+            return
+        for ev_index in range(min(len(variables), self.events.width)):
+            self.events.set(index, ev_index, variables[ev_index])
         if self.debug:
-            print(json.dumps(self.events, indent=4))
+            print('Teach Event : ' + '%08X' % event_identifier + ' : ' + str(list(self.events.variables(index))))
+        self.update_filters()
 
     def rloc(self, loco_id):
-        output = self.get_header() + "40" + self.pad(loco_id, 4) + ";"
-        self.send(output)
+        self.send_frame(self.tx_frame.build(0x40, loco_id, 0, self.priority()))
 
     def stmod(self, session_id, speed):
-        output = self.get_header() + "47" + self.pad(session_id, 2) + self.pad(spee2, 4) + ";"
-        self.send(output)
+        frame = self.tx_frame.build(0x47, 0, 0, self.priority())
+        frame.put(1, session_id)
+        frame.put(2, speed)
+        self.send_frame(frame)
 
     def nvans(self, nv_index):
+        """
+        Returns NVANS for a node variable, from the response cache
+        :return: the node's tx_frame
+        """
         if self.debug:
             print("NVANS : " + str(self.nodeId) + " : " + str(nv_index) + " : " + str(self.data['variables'][nv_index]))
-        output = self.get_header() + "97" + self.pad(self.nodeId, 4) + self.pad(nv_index, 2) + self.pad(
-            self.data['variables'][nv_index], 2) + ";"
-        if self.debug:
-            print("NVANS output : " + output)
-        return output
+        self.check_cache()
+        cached = self.nvans_cache[nv_index]
+        if cached is not None:
+            self.tx_frame.load(cached)
+            return self.tx_frame
+        frame = self.tx_frame.build(0x97, self.nodeId, (nv_index << 8) | self.data['variables'][nv_index],
+                                    self.priority())
+        self.nvans_cache[nv_index] = bytes(frame.buf)
+        return frame
 
     def neval(self, event_index, event_variable_index):
-        print("NEVAL : " + str(self.nodeId) + " : " + str(event_index) + " : " + str(event_variable_index))
-        # print("NEVAL : " + str(self.data['events'][event_index-1]['variables'][event_variable_index]))
-        events = list(self.data['events'].values())
         if self.debug:
-            print('NEVAL events : '+str(events))
-            print("NEVAL : " + str(self.nodeId) + " : " + self.pad(event_index, 2) + " : " + str(
-                events[event_index - 1]['variables']))
-        output = self.get_header() \
-                 + "B5" + self.pad(self.nodeId, 4) \
-                 + self.pad(event_index, 2) \
-                 + self.pad(event_variable_index, 2) \
-                 + self.pad(events[event_index - 1]['variables'][event_variable_index], 2) \
-                 + ";"
-        if self.debug:
-            print("NEVAL output : " + output)
-        return output
+            print("NEVAL : " + str(self.nodeId) + " : " + str(event_index) + " : " + str(event_variable_index))
+        frame = self.tx_frame.build(0xB5, self.nodeId, (event_index << 8) | event_variable_index, self.priority())
+        frame.put(5, self.events.get(event_index - 1, event_variable_index))
+        return frame
+
+    def event_response(self, index):
+        """
+        Returns the ENRSP for a taught event from the response cache
+        :param index: 0 based event index
+        :return: the node's tx_frame
+        """
+        self.check_cache()
+        cache = self.ensrp_cache
+        if self.events.changes != self.ensrp_changes:  # Events taught or removed
+            self.ensrp_changes = self.events.changes
+            for i in range(len(cache)):
+                cache[i] = None
+        if index >= len(cache):
+            return self.ensrp(index + 1, self.events.event_id(index))
+        cached = cache[index]
+        if cached is not None:
+            self.tx_frame.load(cached)
+            return self.tx_frame
+        frame = self.ensrp(index + 1, self.events.event_id(index))
+        cache[index] = bytes(frame.buf)
+        return frame
 
     def ensrp(self, event_index, event_identifier):
+        """
+        :param event_index: 1 based event index, sent as one byte
+        :param event_identifier: node number << 16 | event number
+        :return: the node's tx_frame
+        """
         if self.debug:
-            print("ENSRP : " + str(self.nodeId) + " : " + event_identifier + " : " + str(event_index))
-        output = self.get_header() + "F2" + self.pad(self.nodeId, 4) + event_identifier + self.pad(event_index, 2) + ";"
-        if self.debug:
-            print("ENSRP output : " + output)
-        return output
+            print("ENSRP : " + str(self.nodeId) + " : " + '%08X' % event_identifier + " : " + str(event_index))
+        frame = self.tx_frame.build(0xF2, self.nodeId, event_identifier >> 16, self.priority())
+        frame.put(5, (event_identifier >> 8) & 0xFF)
+        frame.put(6, event_identifier & 0xFF)
+        frame.put(7, event_index & 0xFF)
+        return frame
 
     def cmderror(self, error):
         if self.debug:
-            print("CMDERROR received: " + str(self.nodeId) + " : " + str(error))
-        output = self.get_header() + "6F" + self.pad(self.nodeId, 4) + self.pad(error, 2) + ";"
-        if self.debug:
-            print("CMDERROR Output: " + output)
-        return output
+            print("CMDERROR : " + str(self.nodeId) + " : " + str(error))
+        return self.tx_frame.build(0x6F, self.nodeId, error << 8, self.priority())
 
     def wrack(self):
         if self.debug:
             print("WRACK : " + str(self.nodeId))
-        output = self.get_header() + "59" + self.pad(self.nodeId, 4) + ";"
-        if self.debug:
-            print("WRACK : " + output)
-        return output
-    
+        return self.tx_frame.build(0x59, self.nodeId, 0, self.priority())
+
     def nnack(self):
-        print("NNACK : " + str(self.nodeId))
         if self.debug:
             print("NNACK : " + str(self.nodeId))
-        output = self.get_header() + "52" + self.pad(self.nodeId, 4) + ";"
-        if self.debug:
-            print("NNACK : " + output)
-        return output
+        return self.tx_frame.build(0x52, self.nodeId, 0, self.priority())
 
     def numev(self):
         if self.debug:
             print("NUMEV : " + str(self.nodeId))
-        output = self.get_header() + "74" + self.pad(self.nodeId, 4) + self.pad(len(self.data['events']), 2) + ";"
-        if self.debug:
-            print("NUMEV : " + output)
-        return output
-
-    def acc_on(self, msg):
-        if self.debug:
-            print("acc_on : " + msg + " Event : " + self.get_str(msg, 9, 8))
-        if self.get_str(msg, 9, 8) in self.data['events']:
-            if self.debug:
-                print("Event is Known")
-            # self.execute({'task': 'on', 'variables': self.events[self.get_str(msg, 9, 8)]})
-            self.my_function({'task': 'on', 'variables': self.data['events'][self.get_str(msg, 9, 8)]['variables']})
-        else:
-            if self.debug:
-                print("Event is Unknown")
-
-    def acc_off(self, msg):
-        if self.debug:
-            print("acc_off : " + msg)
-        if self.get_str(msg, 9, 8) in self.data['events']:
-            if self.debug:
-                print("Event is Known")
-            # self.execute({'task': 'off', 'variables': self.events[self.get_str(msg, 9, 8)]})
-            self.my_function({'task': 'off', 'variables': self.data['events'][self.get_str(msg, 9, 8)]['variables']})
-        else:
-            if self.debug:
-                print("Event is Unknown")
-
-    def asc_on(self, msg):
-        event_identifier = "0000" + self.get_str(msg, 13, 4)
-        if self.debug:
-            print("asc_on : " + msg + " Event : " + event_identifier)
-        if event_identifier in self.data['events']:
-            if self.debug:
-                print("Event is Known")
-            # self.execute({'task': 'on', 'variables': self.events[self.get_str(msg, 9, 8)]})
-            self.my_function({'task': 'on', 'variables': self.data['events'][self.get_str(msg, 9, 8)]['variables']})
-        else:
-            if self.debug:
-                print("Event is Unknown")
-
-    def asc_off(self, msg):
-        event_identifier = "0000" + self.get_str(msg, 13, 4)
-        if self.debug:
-            print("asc_off : " + msg + " Event : " + event_identifier)
-        if event_identifier in self.data['events']:
-            if self.debug:
-                print("Event is Known")
-            # self.execute({'task': 'on', 'variables': self.events[self.get_str(msg, 9, 8)]})
-            self.my_function({'task': 'off', 'variables': self.data['events'][self.get_str(msg, 9, 8)]['variables']})
-        else:
-            if self.debug:
-                print("Event is Unknown")
-
-    def paran(self, msg):
-        parameter_id = self.get_int(msg, 13, 2)
-        parameter_value = self.data['parameters'][parameter_id]
-        if self.debug:
-            print("paran : " + msg + " nodeId : " + str(self.get_node_id(msg)))
-        if self.get_node_id(msg) == self.nodeId:
+        return self.tx_frame.build(0x74, self.nodeId, min(len(self.events), 255) << 8, self.priority())
+
+    def acc_on(self, frame):
+        index = self.events.find((frame.nn << 16) | frame.en)
+        if _TRACE & _TR_FRAMES: trace.record(TR_EVENT, index, 1)
+        if index >= 0:
+            self.consume(index, True)
+
+    def acc_off(self, frame):
+        index = self.events.find((frame.nn << 16) | frame.en)
+        if _TRACE & _TR_FRAMES: trace.record(TR_EVENT, index, 0)
+        if index >= 0:
+            self.consume(index, False)
+
+    def asc_on(self, frame):
+        index = self.events.find(frame.en)
+        if _TRACE & _TR_FRAMES: trace.record(TR_EVENT, index, 1)
+        if index >= 0:
+            self.consume(index, True)
+
+    def asc_off(self, frame):
+        index = self.events.find(frame.en)
+        if _TRACE & _TR_FRAMES: trace.record(TR_EVENT, index, 0)
+        if index >= 0:
+            self.consume(index, False)
+
+    def paran(self, frame):
+        if frame.nn == self.nodeId:
+            parameter_id = frame.data(3)
             if self.debug:
                 print("paran for " + str(self.nodeId) +
                       " Parameter " + str(parameter_id) +
-                      " Value : " + str(parameter_value))
-            if self.debug:
-                print("Paran Output " + str(self.parameter(parameter_id)))
-            # time.sleep(1)
-            # self.parameter(parameter_id)
+                      " Value : " + str(self.data['parameters'][parameter_id]))
             if parameter_id == 0:
                 for i in range(21):
-                    self.send(str(self.parameter(i)))
+                    if self.send_reply(self.parameter(i)):
+                        break  # The bus is not taking frames, don't hold up the node for the rest
             else:
-                self.send(str(self.parameter(parameter_id)))
+                self.send_reply(self.parameter(parameter_id))
 
-    def qnn(self, msg):
+    def qnn(self, frame):
         if self.debug:
-            print("qnn : " + msg)
+            print("qnn : " + frame.to_gc())
         self.pnn()
 
-    def session_info(self, msg):
+    def session_info(self, frame):
         if self.debug:
-            print("E1 : PLOC - " + msg)
-        self.Function({'task': 'dcc',
-                       'sesson': self.get_str(msg, 9, 2),
-                       'loco_id': self.get_str(msg, 11, 2)})
+            print("E1 : PLOC - " + frame.to_gc())
+        self.my_function({'task': 'dcc',
+                          'session': frame.data(1),
+                          'loco_id': (frame.data(2) << 8) | frame.data(3)})
 
-    def read_nv(self, msg):
-        if self.get_node_id(msg) == self.nodeId:
+    def read_nv(self, frame):
+        if frame.nn == self.nodeId:
             if self.debug:
-                print("NVRD : " + msg)
-            nv_index = self.get_int(msg, 13, 2)
+                print("NVRD : " + frame.to_gc())
+            nv_index = frame.data(3)
             if nv_index == 0:
                 for i in range(self.data['numNodeVariables'] + 1):
-                    self.send(self.nvans(i))
+                    if self.send_reply(self.nvans(i)):
+                        break
             elif nv_index <= self.data['numNodeVariables']:
-                self.send(self.nvans(nv_index))
+                self.send_reply(self.nvans(nv_index))
+            elif nv_index >= METRICS_NV:
+                self.send_reply(self.tx_frame.build(0x97, self.nodeId, (nv_index << 8) | self.metrics.nv_read(nv_index),
+                                                    self.priority()))
             else:
-                self.send(self.cmderror(10))
+                self.send_reply(self.cmderror(10))
 
-    def read_ev(self, msg):
-        if self.get_node_id(msg) == self.nodeId:
+    def read_ev(self, frame):
+        if frame.nn == self.nodeId:
             if self.debug:
-                print("REVAL : " + msg)
-            ev_index = self.get_int(msg, 13, 2)
-            
-            ev_variable_index = self.get_int(msg, 15, 2)
-            if ev_variable_index == 0:
+                print("REVAL : " + frame.to_gc())
+            ev_index = frame.data(3)
+            ev_variable_index = frame.data(4)
+            if ev_index < 1 or ev_index > len(self.events):
+                self.send_reply(self.cmderror(7))
+            elif ev_variable_index == 0:
                 for i in range(self.data['numEventVariables'] + 1):
-                    self.send(self.neval(ev_index, i))
-            elif ev_index <= self.data["numEventVariables"]:
-                self.send(self.neval(ev_index, ev_variable_index))
+                    if self.send_reply(self.neval(ev_index, i)):
+                        break
+            elif ev_variable_index <= self.data["numEventVariables"]:
+                self.send_reply(self.neval(ev_index, ev_variable_index))
             else:
-                self.send(self.cmderror(6))
+                self.send_reply(self.cmderror(6))
 
-    def write_nv(self, msg):
-        if self.get_node_id(msg) == self.nodeId:
+    def write_nv(self, frame):
+        if frame.nn == self.nodeId:
             if self.debug:
-                print("NVSET : " + msg)
-            nv_index = self.get_int(msg, 13, 2)
-            nv_value = self.get_int(msg, 15, 2)
+                print("NVSET : " + frame.to_gc())
+            nv_index = frame.data(3)
+            nv_value = frame.data(4)
             if nv_index <= self.data["numNodeVariables"]:
                 if self.debug:
                     print("NVSET : " + str(nv_index) + ' : ' + str(nv_value))
                 self.data["variables"][nv_index] = nv_value
-                self.save_data()
-                self.send(self.wrack())
+                self.nvans_cache[nv_index] = None
+                self.store.log(cbus_store.REC_NV, nv_index, nv_value)
+                self.send_reply(self.wrack())
+            elif nv_index >= METRICS_NV:
+                self.metrics.nv_write(nv_index, nv_value)
+                self.send_reply(self.wrack())
             else:
-                self.send(self.cmderror(10))
+                self.send_reply(self.cmderror(10))
 
-    def write_ev(self, msg):
+    def write_ev(self, frame):
         if self.learn:
             if self.debug:
-                print("EVLRN : " + msg)
-            event_identifier = self.get_str(msg, 9, 8)
-            ev_index = self.get_int(msg, 17, 2)
-            ev_value = self.get_int(msg, 19, 2)
-            # event_list = [event for event in self.data['events'] if event['event_identifier'] == event_indentifier]
-            if (event_identifier in self.data['events']):
-                # event_id = next(index for (index, event) in enumerate(self.data['events']) if
-                #                 event['event_identifier'] == event_indentifier)
-                event_id = list(self.data['events']).index(event_identifier) + 1
-                # print('EVLRN : Update Event Variable ' + str(event_id) + ' : ' + str(event_list))
-                print('EVLRN : Update Event Variable ' + event_identifier + ' : ' + str(ev_index) + ' : ' + str(
-                    ev_value))
-                self.data['events'][event_identifier]['variables'][ev_index] = ev_value
-                self.save_data()
-            else:
-                print('EVLRN : Create New Event')
-                self.data['events'][event_identifier] = {}
-                self.data['events'][event_identifier]["event_identifier"] = event_identifier
-                self.data['events'][event_identifier]["variables"] = [0] * (self.data['numEventVariables'] + 1)
-                self.data['events'][event_identifier]['variables'][ev_index] = ev_value
-                self.save_data()
-                # self.send(self.cmderror(7))
+                print("EVLRN : " + frame.to_gc())
+            ev_index = frame.data(5)
+            ev_value = frame.data(6)
+            if ev_index > self.data['numEventVariables']:
+                self.send_reply(self.cmderror(6))
+                return
+            event_identifier = (frame.nn << 16) | frame.en
+            index = self.events.add(event_identifier)
+            if index < 0:
+                print('EVLRN : Too Many Events')
+                self.send_reply(self.cmderror(4))
+                return
+            if self.debug:
+                print('EVLRN : Event ' + str(index + 1) + ' : ' + str(ev_index) + ' : ' + str(ev_value))
+            self.events.set(index, ev_index, ev_value)
+            self.store.log(cbus_store.REC_EV, ev_index, ev_value, event_identifier)
 
-    def remove_event(self, msg):
+    def remove_event(self, frame):
         if self.learn:
             if self.debug:
-                print("EVULN : " + msg)
-            event_indentifier = self.get_str(msg, 9, 8)
-            event_list = [event for event in self.data['events'] if event['event_identifier'] == event_indentifier]
-            if len(event_list) > 0:
-                event_id = next(index for (index, event) in enumerate(self.data['events']) if
-                                    event['event_identifier'] == event_indentifier)
-                del self.data['events'][event_id]
-                self.save_data()
-            elif len(event_list) == 0:
-                print('EVULN : Too Many Events')
-                self.send(self.cmderror(7))
+                print("EVULN : " + frame.to_gc())
+            event_identifier = (frame.nn << 16) | frame.en
+            if self.events.remove(event_identifier):
+                self.store.log(cbus_store.REC_REMOVE, 0, 0, event_identifier)
             else:
-                print('EVULN : Too Many Events')
-                self.send(self.cmderror(4))
+                print('EVULN : Unknown Event')
+                self.send_reply(self.cmderror(7))
 
-    def learn_mode_on(self, msg):
-        if self.get_node_id(msg) == self.nodeId:
+    def learn_mode_on(self, frame):
+        if frame.nn == self.nodeId:
             if self.debug:
-                print("NNLRN : " + msg)
+                print("NNLRN : " + frame.to_gc())
             self.learn = True
+            self.update_filters()
 
-    def learn_mode_off(self, msg):
-        if self.get_node_id(msg) == self.nodeId:
+    def learn_mode_off(self, frame):
+        if frame.nn == self.nodeId:
             if self.debug:
-                print("NNLUN : " + msg)
+                print("NNLUN : " + frame.to_gc())
             self.learn = False
+            self.store.flush()
+            self.update_filters()
 
-    def send_all_events(self, msg):
-        if self.get_node_id(msg) == self.nodeId:
-            event_count = 1
+    def send_all_events(self, frame):
+        if frame.nn == self.nodeId:
             if self.debug:
-                print("NERD : " + msg)
-            for event in self.data['events']:
-                print('ENSRP ' + str(event_count) + ' : ' + str(event))
-                self.send(self.ensrp(event_count, str(event)))
-                event_count += 1
-
-    def send_number_of_events(self, msg):
-        if self.get_node_id(msg) == self.nodeId:
+                print("NERD : " + frame.to_gc())
+            for index in range(len(self.events)):
+                if self.send_reply(self.event_response(index)):
+                    break
+
+    def send_number_of_events(self, frame):
+        if frame.nn == self.nodeId:
             if self.debug:
-                print("RQEVN : " + msg)
-            self.send(self.numev())
+                print("RQEVN : " + frame.to_gc())
+            self.send_reply(self.numev())
 
-    def params(self, msg):
-        print('PARAMS')
+    def params(self, frame):
+        if self.debug:
+            print('PARAMS')
         if self.learn:
             self.parameters()
 
-    def set_node_id(self, msg):
+    def set_node_id(self, frame):
         if self.learn:
-            self.data['nodeId'] = self.get_node_id(msg)
+            self.data['nodeId'] = frame.nn
             self.nodeId = self.data['nodeId']
-            self.nnack()
+            self.send_reply(self.nnack())
             self.learn = False
-            self.save_data()
+            self.store.log(cbus_store.REC_NODE, 0, self.nodeId)
+            self.update_filters()
 
-    def action_opcode(self, msg):
-
-        opcode = self.get_op_code(msg)
-        if self.debug:
-            print("Opcode : " + opcode)
+    def action_opcode(self, frame):
+        """
+        Dispatches a frame to the handler registered for its opcode. The top three
+        bits of a CBUS opcode give the number of data bytes that follow it, frames
+        of any other length are dropped before the handler runs.
+        :param frame: CbusFrame with opcode decoded
+        """
+        opcode = frame.opcode
         self.count += 1
-        if self.debug:
-            print("Msg Count" + str(self.count))
-        if opcode in self.actions:
-            if self.debug:
-                print("Processing Opcode : " + opcode)
-            func = self.actions[opcode]
-            func(msg)
-        else:
-            if self.debug:
-                print("Unknown Opcode : " + opcode)
-            # self.Function(msg)
-            
+        self.metrics.frame(opcode)
+        func = self.handlers[opcode]
+        if func is None:
+            if _TRACE & _TR_FAULTS: trace.record(TR_NO_HANDLER, opcode)
+            return
+        if frame.dlc != (opcode >> 5) + 1:
+            if _TRACE & _TR_FAULTS: trace.record(TR_BAD_LENGTH, opcode, frame.dlc)
+            return
+        if _TRACE & _TR_FRAMES: trace.record(TR_RX, opcode, frame.nn)
+        self.metrics.handler_start()
+        func(frame)
+        self.metrics.handler_end(opcode)
+        if _TRACE & _TR_FRAMES: trace.record(TR_HANDLER, opcode)
+
     def my_function(self, event_variables):
         print('my_function ' + str(self.data['variables']) + ' : ' + str(event_variables))
 
     def execute(self, msg):
-        # self.Function(msg)
+        """
+        Executes a GridConnect message. Kept for transports that deliver text,
+        CAN frames go straight to execute_frame.
+        :param msg: GridConnect message
+        """
         if self.debug:
             print("Execute MSG : " + msg)
-        self.action_opcode(msg)
+        if self.rx_frame.from_gc(msg) == 0:
+            self.execute_frame(self.rx_frame)
+
+    def execute_frame(self, frame):
+        """
+        Executes a received frame
+        :param frame: CbusFrame with opcode, nn and en decoded
+        """
+        if frame.dlc:
+            self.action_opcode(frame)
 
     def send(self, msg):
         # print("Pico Node Send : " + msg)
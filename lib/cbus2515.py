@@ -1,6 +1,23 @@
 # MicroPython CBUS/MCP2515 CAN controller driver
 # (c)2021 Tony Witts
 
+# 221116 - A class may have more than one frame in the transmit buffers, so bursts go back to back
+# 221114 - tx_class_of() for cbus_dual's per class rings
+#        - send_frame can wait for room in a class queue, so reply bursts are not dropped
+# 221113 - Transmit queue split into DCC, event, normal and bulk classes, each with its own queue,
+#          minor priority and TXP, with aging so bulk replies still get through
+# 221111 - Error states from EFLG with counters, transmit paused at bus-off and the
+#          controller reset after a growing backoff, error_stats()
+# 221109 - Enumeration answers kept in a 128 bit map, every free ID 1 - 127 can be chosen,
+#          one Timer reused for the response window, CAN_ID.ini only written when the ID changes
+# 221107 - poll() and irq_enable() so another core can own the MCP2515, see cbus_dual
+# 221105 - Per frame debug prints replaced by trace records, see cbus_log
+# 221101 - Acceptance filters on the opcode and node number high byte, set_filters()
+# 221030 - rx_flag is set from the interrupt when frames are stacked, for uasyncio tasks
+# 221028 - Receive stack depth and drop policy set per instance, with statistics
+# 221026 - Preallocated SPI buffers, no allocation in the interrupt handler
+# 221024 - Both receive buffers with rollover, read with READ RX BUFFER
+# 221020 - Transmit queue serviced by the TXnIF interrupts on all three buffers
 # 220604 - First commit to GitHub.
 # 210322 - Handles Enumeration in and out
 #        - debug parameter to print debug messages
@@ -12,17 +29,75 @@
 
 from machine import Timer
 from micropython import const
-from time import ticks_us, ticks_ms, ticks_diff, sleep
-from binascii import hexlify, unhexlify
+from time import ticks_us, ticks_ms, ticks_diff, sleep_us
+from binascii import hexlify
+from random import getrandbits
 import uasyncio
+from cbus_frame import CbusFrame
+from cbus_log import trace, TR_TX, TR_TX_FULL, TR_TX_TIMEOUT, TR_RX_READ, TR_ZERO_LENGTH
+
+_TRACE = const(0)  # cbus_log levels: 0 off, 1 faults, 3 faults and every frame
+_TR_FAULTS = const(1)
+_TR_FRAMES = const(2)
 
 STACK_LEN = const(50)
-STACK_TOT = const(13 * STACK_LEN)
+TX_STACK_LEN = const(32)
 TX_TIMEOUT = const(100)
+TX_WAIT_US = const(100)  # Pause between checks while send_frame waits for room in a class queue
+AGE_MS = const(50)  # A class head waiting this long is ranked one class more urgent
+BACKOFF_MS = const(100)  # First wait for the MCP2515 to recover from bus-off by itself
+BACKOFF_MAX_MS = const(6400)
+ENUM_MS = const(100)  # Time allowed for other nodes to answer the enumeration RTR
+ENUM_SPREAD = const(2)  # Random bits choosing among the lowest free IDs, so nodes enumerating together differ
+
+# Receive stack drop policies, used when a frame arrives and the stack is full
+DROP_NEWEST = const(0)  # Discard the frame that has just arrived
+DROP_OLDEST = const(1)  # Discard the oldest unread frame
+DROP_PRIORITY = const(2)  # Discard the oldest frame if the new one has a more urgent major priority
+
+# Transmit classes, most urgent first. Each has its own queue and at most one
+# frame in the transmit buffers, at TXP 3 - class.
+TX_DCC = const(0)  # Loco control and track power, a throttle waits on these
+TX_EVENT = const(1)  # Accessory events
+TX_NORMAL = const(2)
+TX_BULK = const(3)  # Configuration replies, FCU reads produce these in bursts
+TX_CLASSES = const(4)
+CLASS_MINOR = b'\x01\x02\x03\x03'  # CAN ID minor priority for each class: above normal, normal, low, low
+
+# Transmit class of each opcode, sent frames are TX_NORMAL unless listed
+TX_CLASS = bytearray([TX_NORMAL] * 256)
+for _opcode in (0x04, 0x05, 0x06, 0x08, 0x09, 0x0A, 0x21, 0x22, 0x23, 0x40, 0x41, 0x44, 0x45, 0x46, 0x47,
+                0x48, 0x49, 0x4A, 0x60, 0x61, 0x63, 0xE1):
+    TX_CLASS[_opcode] = TX_DCC
+for _opcode in (0x10, 0x11, 0x13, 0x14, 0x18, 0x19, 0x1D, 0x1E):  # ACON, ACOF, ARON, AROF, ASON... by data length
+    for _length in (0x80, 0xA0, 0xC0, 0xE0):
+        TX_CLASS[_length | _opcode] = TX_EVENT
+for _opcode in (0x50, 0x52, 0x59, 0x6F, 0x74, 0x97, 0x9B, 0xB5, 0xB6, 0xE2, 0xEF, 0xF2):
+    TX_CLASS[_opcode] = TX_BULK
+
 
-HEXDIGITS = "0123456789abcdefABCDEF"
+def tx_class_of(buf):
+    """
+    The transmit class of a frame, from its opcode
+    :param buf: 13 byte frame in register layout
+    """
+    return TX_CLASS[buf[5]] if buf[4] & DLC and not buf[4] & RTR else TX_NORMAL
+
+# Error states, from EFLG
+ERROR_ACTIVE = const(0)
+ERROR_WARNING = const(1)  # TEC or REC 96 or more
+ERROR_PASSIVE = const(2)  # TEC or REC 128 or more
+BUS_OFF = const(3)  # TEC over 255, the controller no longer transmits
 
 # Register definitions
+RXF0SIDH = const(0x00)
+RXF1SIDH = const(0x04)
+RXF2SIDH = const(0x08)
+RXF3SIDH = const(0x10)
+RXF4SIDH = const(0x14)
+RXF5SIDH = const(0x18)
+RXM0SIDH = const(0x20)
+RXM1SIDH = const(0x24)
 CANSTAT = const(0x0E)
 CANCTRL = const(0x0F)
 TEC = const(0x1C)
@@ -48,6 +123,8 @@ TXB0D4 = const(0x3A)
 TXB0D5 = const(0x3B)
 TXB0D6 = const(0x3C)
 TXB0D7 = const(0x3D)
+TXB1CTRL = const(0x40)
+TXB2CTRL = const(0x50)
 
 RXB0CTRL = const(0x60)
 RXB0SIDH = const(0x61)
@@ -64,22 +141,25 @@ RXB0D5 = const(0x6B)
 RXB0D6 = const(0x6C)
 RXB0D7 = const(0x6D)
 
-RXB1CTRL = const(0x60)
-RXB1SIDH = const(0x61)
-RXB1SIDL = const(0x62)
-RXB1EID8 = const(0x63)
-RXB1EID0 = const(0x64)
-RXB1DLC = const(0x65)
-RXB1D0 = const(0x66)
-RXB1D1 = const(0x67)
-RXB1D2 = const(0x68)
-RXB1D3 = const(0x69)
-RXB1D4 = const(0x6A)
-RXB1D5 = const(0x6B)
-RXB1D6 = const(0x6C)
-RXB1D7 = const(0x6D)
+RXB1CTRL = const(0x70)
+RXB1SIDH = const(0x71)
+RXB1SIDL = const(0x72)
+RXB1EID8 = const(0x73)
+RXB1EID0 = const(0x74)
+RXB1DLC = const(0x75)
+RXB1D0 = const(0x76)
+RXB1D1 = const(0x77)
+RXB1D2 = const(0x78)
+RXB1D3 = const(0x79)
+RXB1D4 = const(0x7A)
+RXB1D5 = const(0x7B)
+RXB1D6 = const(0x7C)
+RXB1D7 = const(0x7D)
 
 # Bit definition masks
+RXM_ANY = const(0x60)  # RXBnCTRL, filters and masks off
+BUKT = const(4)
+ABTF = const(64)
 TXREQ = const(8)
 EXIDE = const(8)
 RXRTR = const(8)
@@ -87,11 +167,25 @@ IDE = const(8)
 SRR = const(16)
 RTR = const(64)
 DLC = const(15)
+RX0IF = const(0x01)
+RX1IF = const(0x02)
+ERRIF = const(0x20)
+MERRF = const(0x80)  # Also MERRE in CANINTE
+EWARN = const(0x01)
+RXEP = const(0x08)
+TXEP = const(0x10)
+TXBO = const(0x20)
+RX0OVR = const(0x40)
+RX1OVR = const(0x80)
+TX0IF = const(0x04)
+TXIF = const(0x1C)  # TX0IF | TX1IF | TX2IF
 
 # Command definitions
 CMD_WRITE = const(0x02)
 CMD_READ = const(0x03)
 CMD_MODIFY = const(0x05)
+CMD_LOAD_TX = const(0x40)  # | n << 1 writes TXBnSIDH onwards
+CMD_READ_RX = const(0x90)  # | n << 2 reads RXBnSIDH onwards and clears RXnIF
 CMD_READ_STATUS = const(0xA0)
 CMD_RX_STATUS = const(0xB0)
 CMD_RESET = const(0xC0)
@@ -103,39 +197,147 @@ CNF = {
 }
 
 
+# Lowest clear bit of each byte value, 8 for 0xFF
+LOWEST_ZERO = bytearray(256)
+for _value in range(256):
+    _bit = 0
+    while _bit < 8 and _value & (1 << _bit):
+        _bit += 1
+    LOWEST_ZERO[_value] = _bit
+
+
 # Cbus2515 Class
+def filter_cover(values, slots):
+    """
+    Chooses one mask and up to slots filter values that accept every value.
+    Mask bits are cleared one at a time, each time the bit that merges the
+    most values, until the values fit; the filters may then accept extras.
+    :param values: byte values to accept, at least one
+    :param slots: number of filters sharing the mask
+    :return: (mask, list of slots filter values)
+    """
+    mask = 0xFF
+    groups = sorted(set(v & mask for v in values)) or [0]
+    while len(groups) > slots:
+        best = None
+        for bit in range(8):
+            if mask & (1 << bit):
+                trial = sorted(set(v & mask & ~(1 << bit) for v in values))
+                if best is None or len(trial) < len(best[1]):
+                    best = (mask & ~(1 << bit), trial)
+        mask, groups = best
+    while len(groups) < slots:  # Unused filters repeat the first one
+        groups.append(groups[0])
+    return mask, groups
+
+
 class Cbus2515():
-    def __init__(self, spi, cs, interrupt, osc=16000000, debug=False):
+    def __init__(self, spi, cs, interrupt, osc=16000000, debug=False, tx_depth=TX_STACK_LEN, baudrate=None,
+                 rx_depth=STACK_LEN, rx_policy=DROP_OLDEST, enum_ms=ENUM_MS):
+        """
+        :param spi: machine.SPI the MCP2515 is on, it is not reinitialised unless baudrate is given
+        :param cs: chip select Pin
+        :param interrupt: Pin wired to the MCP2515 INT output
+        :param osc: MCP2515 crystal frequency
+        :param tx_depth: number of frames each transmit class queue holds
+        :param rx_depth: number of slots in the receive stack, it holds rx_depth - 1 frames
+        :param rx_policy: DROP_NEWEST, DROP_OLDEST or DROP_PRIORITY when the receive stack is full
+        :param baudrate: SPI clock to set, up to 10 MHz for the MCP2515
+        :param enum_ms: time other nodes have to answer when this node enumerates
+        """
         self.initialised = False
         self.debug = debug
-        self.buffer = bytearray(5)
-        self.tx_buffer = bytearray(13)
-        self.rx_stack = bytearray(STACK_TOT)
+        # Command buffers are allocated once so register access never allocates
+        self.buffer = bytearray(4)
+        buffer_mv = memoryview(self.buffer)
+        self.cmd1 = buffer_mv[0:1]
+        self.cmd2 = buffer_mv[0:2]
+        self.cmd3 = buffer_mv[0:3]
+        self.cmd4 = buffer_mv[0:4]
+        self.tx_frame = CbusFrame()
+        self.id_frame = CbusFrame()
+        self.rtr_frame = CbusFrame()
+        self.rtr_frame.from_gc(":SB020R;")
+        # One ring of tx_depth slots per transmit class, class c slot i is
+        # tx_slots[c * tx_depth + i]. A frame stays in its ring until TXnIF.
+        self.tx_depth = tx_depth
+        self.tx_stack = bytearray(13 * tx_depth * TX_CLASSES)
+        self.tx_stack_mv = memoryview(self.tx_stack)
+        self.tx_slots = [self.tx_stack_mv[i * 13:(i + 1) * 13] for i in range(tx_depth * TX_CLASSES)]
+        self.tx_queued_at = [0] * (tx_depth * TX_CLASSES)
+        self.tx_in = [0] * TX_CLASSES
+        self.tx_out = [0] * TX_CLASSES
+        self.tx_loaded = [0] * TX_CLASSES  # Frames of each class in the transmit buffers, from its head on
+        self.tx_class_sent = [0] * TX_CLASSES
+        self.tx_class_max = [0] * TX_CLASSES  # Longest queued to sent time of each class, us
+        self.tx_txp = [-1, -1, -1]  # TXP of the frame in each TXBn, -1 when free
+        self.tx_class = [0, 0, 0]  # Class of the frame in each TXBn
+        self.tx_slot = [0, 0, 0]  # Its position in the class ring
+        self.tx_start = [0, 0, 0]
+        self.tx_load_ms = [0, 0, 0]
+        self.tx_count = 0
+        self.tx_dropped = 0
+        self.tx_failed = 0
+        self.tx_high = 0
+        self.tx_time = 0
+        self.tx_time_max = 0
+        self.spi_lock = False
+        self.irq_pending = False
+        # Single producer (interrupt) single consumer (read_frame) ring of frame
+        # slots. stack_in is the slot the next frame is read into.
+        self.rx_depth = rx_depth
+        self.rx_policy = rx_policy
+        self.rx_stack = bytearray(13 * rx_depth)
         self.rx_stack_mv = memoryview(self.rx_stack)
+        self.rx_slots = [self.rx_stack_mv[i * 13:(i + 1) * 13] for i in range(rx_depth)]
         self.stack_in = 0
         self.stack_out = 0
-        self.id_stack = []
+        self.rx_flag = uasyncio.ThreadSafeFlag()  # Set whenever a frame is stacked
+        self.rx_count = 0
+        self.rx_dropped = 0
+        self.rx_high = 0
+        self.rx0_overflows = 0
+        self.rx1_overflows = 0
+        self.error_state = ERROR_ACTIVE
+        self.error_entered = [0, 0, 0, 0]  # Times each error state has been entered
+        self.bus_errors = 0  # MERRF, errors while sending or receiving a frame
+        self.tec = 0
+        self.rec = 0
+        self.tec_max = 0
+        self.rec_max = 0
+        self.tec_rises = 0  # Samples where TEC had gone up since the last one
+        self.tx_paused = False
+        self.bus_off_at = 0
+        self.backoff = BACKOFF_MS
+        self.recoveries = 0
+        self.run_mode = 0
+        self.filter_args = (None, None)
+        self.rx_frame = CbusFrame()
+        self.id_map = bytearray(16)  # Bit n set when CAN ID n answered the enumeration
         self.enumerate = False
+        self.enum_ms = enum_ms
+        self.enum_timer = Timer()
         self.data = [0 for i in range(8)]
-        self.rate = 1024 * 1024
+        self.rate = baudrate
         self.cs = cs
         self.cs.init(self.cs.OUT, value=1)
+        self.interrupt = interrupt
         interrupt.init(interrupt.IN, interrupt.PULL_UP)
         interrupt.irq(trigger=interrupt.IRQ_FALLING, handler=self.can_irq)
         self.spi = spi
-        self.cs(1)
+        if baudrate:
+            self.spi.init(baudrate=baudrate)
+        self.buffer[0] = CMD_RESET
         self.cs(0)
-        self.spi.write(bytearray([CMD_RESET]))
+        self.spi.write(self.cmd1)
         self.cs(1)
         if self.read_reg(CANCTRL) & 7 != 7:
             if self.debug: print("MCP2515 missing!")
             self.can_id_msg = ''
             return
-        self.can_id = self.get_can_id()
-        self.can_sid = bytearray([self.can_id >> 3, self.can_id << 5])
-        self.can_id_msg = ":S" + hexlify(self.can_sid).decode() + "N;"
+        self.set_can_id(self.get_can_id())
         if self.debug: print("ID:", self.can_id, self.can_sid, self.can_id_msg)
-        self.send_pause = False
+        self.osc = osc
         self.init_can(osc)
         self.initialised = True
 
@@ -146,13 +348,19 @@ class Cbus2515():
                 (CNF2, CNF[osc][1]),
                 (CNF3, CNF[osc][2]),
                 # Filters and Masks
-                (RXB0CTRL, 0x60),  # Do not use Filters or Masks
-                (RXB1CTRL, 0x60),  # Do not use Filters or Masks
+                (RXB0CTRL, RXM_ANY | BUKT),  # Do not use Filters or Masks, roll over into RXB1
+                (RXB1CTRL, RXM_ANY),  # Do not use Filters or Masks
                 # Interrupts
-                (CANINTE, 0x01),
+                (CANINTE, RX0IF | RX1IF | TXIF | ERRIF | MERRF),
         ):
             self.write_reg(reg, data)
 
+    def set_can_id(self, can_id):
+        self.can_id = can_id
+        self.can_sid = bytearray([can_id >> 3, (can_id << 5) & 0xFF])
+        self.can_id_msg = ":S" + hexlify(self.can_sid).decode() + "N;"
+        self.id_frame.from_gc(self.can_id_msg)
+
     def get_can_id(self):
         try:
             with open("CAN_ID.ini") as f:
@@ -174,199 +382,710 @@ class Cbus2515():
         except OSError:
             if self.debug: print("Can't write ID file!")
 
+    def start_enumeration(self):
+        """
+        Sends the enumeration RTR and notes the CAN IDs that answer for
+        enum_ms, then moves to a free one. Ignored while enumerating.
+        """
+        if self.enumerate:
+            return
+        id_map = self.id_map
+        for i in range(16):
+            id_map[i] = 0
+        id_map[0] = 1  # CAN ID 0 is not used
+        self.enumerate = True
+        self.send_frame(self.rtr_frame)
+        self.enum_timer.init(mode=Timer.ONE_SHOT, period=self.enum_ms, callback=self.can_enumerate)
+
     def can_enumerate(self, timer):
         self.enumerate = False
-        timer.deinit()
-        if self.debug: print("-can_enumerate: ", self.id_stack)
-        for idh in range(16):
-            for idl in range(32, 225, 32):
-                if (idh, idl) not in self.id_stack:
-                    self.can_id = int(idh * 8 + idl / 32)
-                    self.can_sid = bytearray([idh, idl])
-                    self.can_id_msg = ":S" + hexlify(self.can_sid).decode() + "N;"
-                    self.save_can_id(self.can_id)
-                    self.id_stack = []
-                    if self.debug: print("-Enum:", (idh, idl), self.can_id)
-                    return
-        self.id_stack = []
+        can_id = self.free_id(getrandbits(ENUM_SPREAD))
+        if self.debug: print("-can_enumerate: ", hexlify(self.id_map), can_id)
+        if can_id and can_id != self.can_id:
+            self.set_can_id(can_id)
+            self.save_can_id(can_id)
+
+    def free_id(self, skip=0):
+        """
+        Returns a CAN ID that did not answer the enumeration
+        :param skip: number of lower free IDs to pass over, fewer are passed if fewer are free
+        :return: CAN ID 1 - 127, or 0 if every ID answered
+        """
+        id_map = self.id_map
+        found = 0
+        for i in range(16):
+            bits = id_map[i]
+            while bits != 0xFF:
+                bit = LOWEST_ZERO[bits]
+                found = (i << 3) | bit
+                if not skip:
+                    return found
+                skip -= 1
+                bits |= 1 << bit
+        return found  # The highest free ID, or 0
 
     def can_irq(self, p):
-        rx = self.read_regs(RXB0SIDH, 0x0D)
-        rx[0] = rx[0] & 0x0F
+        if self.spi_lock:  # Main code is part way through an SPI transaction
+            self.irq_pending = True
+            return
+        self.spi_lock = True
+        flags = self.read_reg(CANINTF)
+        while flags & (RX0IF | RX1IF | TXIF | ERRIF | MERRF):  # Drain everything pending before returning
+            if flags & ERRIF:
+                self.error_irq()
+            if flags & MERRF:
+                self.bus_errors += 1
+                self.modify_reg(CANINTF, MERRF, 0)
+            if flags & TXIF:
+                self.tx_irq(flags)
+            if flags & RX0IF:
+                self.rx_irq(0)
+            if flags & RX1IF:
+                self.rx_irq(1)
+            flags = self.read_reg(CANINTF)
+        self.unlock()
+
+    def irq_enable(self, on):
+        """
+        Connects or disconnects can_irq from the INT pin, poll() services the
+        MCP2515 while it is disconnected
+        """
+        self.interrupt.irq(trigger=self.interrupt.IRQ_FALLING, handler=self.can_irq if on else None)
+
+    def poll(self):
+        """
+        Runs the interrupt handler if INT is low
+        :return: True if it ran
+        """
+        if self.interrupt.value():
+            return False
+        self.can_irq(None)
+        return True
+
+    def unlock(self):
+        self.spi_lock = False
+        if self.irq_pending:
+            self.irq_pending = False
+            self.can_irq(None)
+
+    def rx_irq(self, n):
+        rx = self.rx_slots[self.stack_in]  # Read straight into the stack
+        self.read_rx_buffer(n, rx)
         if rx[1] & SRR:  # Respond to Enumeration
-            self.modify_reg(CANINTF, 1, 0)
-            self.send(self.can_id_msg)  # Send our ID
+            self.send_frame(self.id_frame)  # Send our ID
             return
         if self.enumerate and rx[4] & 0x0F == 0:  # Stack zero length message IDs
-            if self.debug: print("-ZL", rx[0], rx[1])  # when Enumerating
-            self.id_stack.append((rx[0], rx[1]))
-            self.modify_reg(CANINTF, 1, 0)
+            if _TRACE & _TR_FRAMES: trace.record(TR_ZERO_LENGTH, rx[0], rx[1])  # when Enumerating
+            can_id = ((rx[0] & 0x0F) << 3) | (rx[1] >> 5)
+            self.id_map[can_id >> 3] |= 1 << (can_id & 7)
+            return
+        self.rx_count += 1
+        next_in = self.stack_in + 1
+        if next_in == self.rx_depth:
+            next_in = 0
+        if next_in == self.stack_out:  # Full
+            self.rx_dropped += 1
+            policy = self.rx_policy
+            if policy == DROP_PRIORITY:
+                policy = DROP_OLDEST if rx[0] >> 6 < self.rx_slots[self.stack_out][0] >> 6 else DROP_NEWEST
+            if policy == DROP_NEWEST:
+                return
+            next_out = self.stack_out + 1
+            self.stack_out = 0 if next_out == self.rx_depth else next_out
+        self.stack_in = next_in
+        self.rx_flag.set()
+        waiting = self.in_waiting()
+        if waiting > self.rx_high:
+            self.rx_high = waiting
+        if rx[0] & 0x0F == self.can_sid[0] and rx[1] & 0xE0 == self.can_sid[1]:  # CLASH! Our ID on Bus
+            self.start_enumeration()
+            self.id_map[self.can_id >> 3] |= 1 << (self.can_id & 7)  # Taken by the other node
+
+    def error_irq(self):
+        eflg = self.read_reg(EFLG)
+        if eflg & RX0OVR:
+            self.rx0_overflows += 1
+        if eflg & RX1OVR:
+            self.rx1_overflows += 1
+        if eflg & (RX0OVR | RX1OVR):
+            self.modify_reg(EFLG, RX0OVR | RX1OVR, 0)
+        self.modify_reg(CANINTF, ERRIF, 0)
+        self.error_update(eflg)
+
+    def error_update(self, eflg):
+        """
+        Follows the error state in EFLG. Transmission is paused at bus-off,
+        frames in the transmit buffers are aborted and left queued, and
+        nothing is loaded until tx_service sees the controller recover.
+        Call with spi_lock held.
+        """
+        if eflg & TXBO:
+            state = BUS_OFF
+        elif eflg & (TXEP | RXEP):
+            state = ERROR_PASSIVE
+        elif eflg & EWARN:
+            state = ERROR_WARNING
+        else:
+            state = ERROR_ACTIVE
+        if state == self.error_state:
             return
-        self.rx_stack_mv[self.stack_in:self.stack_in + 13] = rx
-        self.stack_in += 0x0D
-        if self.stack_in >= STACK_TOT:
-            self.stack_in = 0
-        self.modify_reg(CANINTF, 1, 0)
-        if rx[0:2] == self.can_sid:  # CLASH! Our ID on Bus
-            self.enumerate = True
-            self.send(":SB020R;")
-            _ = Timer(freq=10, mode=Timer.ONE_SHOT, callback=self.can_enumerate)
+        if self.debug: print("-Error state:", self.error_state, "->", state)
+        self.error_state = state
+        self.error_entered[state] += 1
+        if state == BUS_OFF:
+            self.tx_paused = True
+            now = ticks_ms()
+            if ticks_diff(now, self.bus_off_at) > BACKOFF_MAX_MS:  # Not bus-off for a while, start short again
+                self.backoff = BACKOFF_MS
+            self.bus_off_at = now
+            for n in range(3):
+                if self.tx_txp[n] >= 0:  # The frame is still in its queue, it is loaded again later
+                    self.modify_reg(TXB0CTRL + 16 * n, TXREQ, 0)
+                    self.tx_txp[n] = -1
+                    self.tx_loaded[self.tx_class[n]] = 0
+        elif self.tx_paused:
+            self.tx_paused = False
+            self.tx_kick()
+
+    def error_sample(self):
+        """
+        Reads TEC and REC for error_stats, call with spi_lock held
+        """
+        tec = self.read_reg(TEC)
+        rec = self.read_reg(REC)
+        if tec > self.tec:
+            self.tec_rises += 1
+        self.tec = tec
+        self.rec = rec
+        if tec > self.tec_max:
+            self.tec_max = tec
+        if rec > self.rec_max:
+            self.rec_max = rec
+
+    def bus_off_service(self, now):
+        """
+        The MCP2515 leaves bus-off by itself after seeing the bus idle, if it
+        has not after the backoff it is reset, which clears its error
+        counters, and set up again. The backoff doubles with each reset up
+        to BACKOFF_MAX_MS, so a segment that keeps failing is tried less
+        often, and starts again from BACKOFF_MS once the controller has not
+        been bus-off for BACKOFF_MAX_MS. Call with spi_lock held.
+        """
+        self.error_update(self.read_reg(EFLG))
+        if self.error_state != BUS_OFF or ticks_diff(now, self.bus_off_at) < self.backoff:
+            return
+        if self.debug: print("-Bus-off recovery, backoff", self.backoff)
+        self.recoveries += 1
+        self.bus_off_at = now
+        self.backoff = min(self.backoff * 2, BACKOFF_MAX_MS)
+        self.buffer[0] = CMD_RESET
+        self.cs(0)
+        self.spi.write(self.cmd1)
+        self.cs(1)
+        self.init_can(self.osc)
+        self.set_filters(*self.filter_args)
+        self.change_mode(self.run_mode)
+        self.error_update(self.read_reg(EFLG))
+
+    def error_stats(self):
+        return {'state': self.error_state,
+                'tec': self.tec,
+                'rec': self.rec,
+                'tec_max': self.tec_max,
+                'rec_max': self.rec_max,
+                'tec_rises': self.tec_rises,
+                'bus_errors': self.bus_errors,
+                'warning': self.error_entered[ERROR_WARNING],
+                'passive': self.error_entered[ERROR_PASSIVE],
+                'bus_off': self.error_entered[BUS_OFF],
+                'recoveries': self.recoveries,
+                'tx_paused': self.tx_paused}
 
     def in_waiting(self):
-        a = (self.stack_in - self.stack_out) // 13
-        if a < 0: a += STACK_LEN
+        a = self.stack_in - self.stack_out
+        if a < 0: a += self.rx_depth
         return a
 
+    def rx_stats(self):
+        return {'received': self.rx_count,
+                'dropped': self.rx_dropped,
+                'waiting': self.in_waiting(),
+                'high_water': self.rx_high,
+                'rx0_overflows': self.rx0_overflows,
+                'rx1_overflows': self.rx1_overflows}
+
+    def tx_stats(self):
+        return {'sent': self.tx_count,
+                'dropped': self.tx_dropped,
+                'failed': self.tx_failed,
+                'waiting': self.tx_waiting(),
+                'high_water': self.tx_high,
+                'last_us': self.tx_time,
+                'max_us': self.tx_time_max,
+                'class_waiting': [self.tx_class_waiting(c) for c in range(TX_CLASSES)],
+                'class_sent': list(self.tx_class_sent),
+                'class_max_us': list(self.tx_class_max)}
+
+    def reset_stats(self):
+        self.rx_count = 0
+        self.rx_dropped = 0
+        self.rx_high = 0
+        self.rx0_overflows = 0
+        self.rx1_overflows = 0
+        self.tx_count = 0
+        self.tx_dropped = 0
+        self.tx_failed = 0
+        self.tx_high = 0
+        self.tx_time = 0
+        self.tx_time_max = 0
+        for c in range(TX_CLASSES):
+            self.tx_class_sent[c] = 0
+            self.tx_class_max[c] = 0
+        for state in range(4):
+            self.error_entered[state] = 0
+        self.bus_errors = 0
+        self.tec_max = self.tec
+        self.rec_max = self.rec
+        self.tec_rises = 0
+        self.recoveries = 0
+
+    def read_frame(self, frame):
+        """
+        Copies the oldest received frame into frame and decodes it
+        :param frame: CbusFrame to fill
+        :return: True if a frame was read, False if the stack was empty
+        """
+        if not self.in_waiting():
+            return False
+        stack_out = self.stack_out
+        frame.load(self.rx_slots[stack_out])
+        stack_out += 1
+        self.stack_out = 0 if stack_out == self.rx_depth else stack_out
+        return True
+
     def receive(self):
-        if self.debug:
-            print("\n-Receive-", end='')
-            print(self.in_waiting(), end='')
-            print("--------------------------")
-        if self.in_waiting():
-            rx_buffer = self.rx_stack[self.stack_out:self.stack_out + 13]
-            self.stack_out += 13
-            if self.stack_out >= 13 * STACK_LEN:
-                self.stack_out = 0
-            if self.debug: print("-rx_buffer:", rx_buffer)
-            msg = ':'
-            if rx_buffer[1] & IDE:
-                msg += 'X'
-                msg += hexlify(rx_buffer[0:4]).decode()
-                if rx_buffer[4] & RTR:
-                    msg += 'R'
-                else:
-                    msg += 'N'
-            else:
-                msg += 'S'
-                msg += hexlify(rx_buffer[0:2]).decode()
-                if rx_buffer[1] & SRR:
-                    msg += 'R'
-                else:
-                    msg += 'N'
-            n = int(rx_buffer[4]) & DLC
-            rd = rx_buffer[5:5 + n]
-            if self.debug: print("-no of data, rx_data:", n, rd)
-            msg += hexlify(rd).decode()
-            msg += ';'
-            if self.debug: print("-msg:", msg.upper())
-            return msg.upper()
+        if self.read_frame(self.rx_frame):
+            if _TRACE & _TR_FRAMES: trace.record(TR_RX_READ, self.rx_frame.opcode, self.in_waiting())
+            return self.rx_frame.to_gc()
         else:
             return ""
 
     def write_reg(self, reg, data):
-        self.buffer = bytearray([CMD_WRITE, reg, data])
-        self.spi.init(baudrate=self.rate)
-        self.cs(1)
+        buffer = self.buffer
+        buffer[0] = CMD_WRITE
+        buffer[1] = reg
+        buffer[2] = data
         self.cs(0)
-        self.spi.write(self.buffer)
+        self.spi.write(self.cmd3)
         self.cs(1)
 
     def read_reg(self, reg):
-        self.buffer = bytearray([CMD_READ, reg, 0])
-        self.spi.init(baudrate=self.rate)
-        self.cs(1)
+        buffer = self.buffer
+        buffer[0] = CMD_READ
+        buffer[1] = reg
+        buffer[2] = 0
         self.cs(0)
-        self.spi.write_readinto(self.buffer, self.buffer)
+        self.spi.write_readinto(self.cmd3, self.cmd3)
         self.cs(1)
-        return self.buffer[2]
+        return buffer[2]
 
     def write_regs(self, reg, data):
-        self.buffer = bytearray([CMD_WRITE, reg])
-        self.spi.init(baudrate=self.rate)
-        self.cs(1)
+        self.buffer[0] = CMD_WRITE
+        self.buffer[1] = reg
         self.cs(0)
-        self.spi.write(self.buffer + data)
+        self.spi.write(self.cmd2)
+        self.spi.write(data)
         self.cs(1)
 
     def read_regs(self, reg, num):
-        self.buffer = bytearray([CMD_READ, reg]) + bytearray(num)
-        self.spi.init(baudrate=self.rate)
+        data = bytearray(num)
+        self.buffer[0] = CMD_READ
+        self.buffer[1] = reg
+        self.cs(0)
+        self.spi.write(self.cmd2)
+        self.spi.readinto(data)
         self.cs(1)
+        return data
+
+    def read_rx_buffer(self, n, data):
+        """
+        Reads RXBn with the READ RX BUFFER instruction, which also clears RXnIF
+        when CS goes high
+        :param n: receive buffer 0 or 1
+        :param data: 13 byte buffer for SIDH, SIDL, EID8, EID0, DLC, D0..D7
+        """
+        self.buffer[0] = CMD_READ_RX | (n << 2)
         self.cs(0)
-        self.spi.write_readinto(self.buffer, self.buffer)
+        self.spi.write(self.cmd1)
+        self.spi.readinto(data)
         self.cs(1)
-        return self.buffer[2:]
 
-    def modify_reg(self, reg, mask, data):
-        self.buffer = bytearray([CMD_MODIFY, reg, mask, data])
-        self.spi.init(baudrate=self.rate)
+    def load_tx_buffer(self, n, data):
+        """
+        Writes a frame to TXBn with the LOAD TX BUFFER instruction
+        :param n: transmit buffer 0, 1 or 2
+        :param data: 13 byte buffer for SIDH, SIDL, EID8, EID0, DLC, D0..D7
+        """
+        self.buffer[0] = CMD_LOAD_TX | (n << 1)
+        self.cs(0)
+        self.spi.write(self.cmd1)
+        self.spi.write(data)
         self.cs(1)
+
+    def modify_reg(self, reg, mask, data):
+        buffer = self.buffer
+        buffer[0] = CMD_MODIFY
+        buffer[1] = reg
+        buffer[2] = mask
+        buffer[3] = data
         self.cs(0)
-        self.spi.write(self.buffer)
+        self.spi.write(self.cmd4)
         self.cs(1)
 
     def change_mode(self, mode):
+        locked = self.spi_lock
+        self.spi_lock = True
+        if mode != 4:
+            self.run_mode = mode  # Restored after a bus-off reset
         self.write_reg(CANCTRL, (mode << 5))
         start = ticks_ms()
+        result = 0
         while self.read_reg(CANSTAT) >> 5 != mode:
             if ticks_diff(ticks_ms(), start) > TX_TIMEOUT:
                 if self.debug: print("Mode Timeout!")
-                return 1
+                result = 1
+                break
+        if not locked: self.unlock()
+        return result
+
+    def set_filters(self, node_numbers=None, opcodes=None):
+        """
+        Programs the acceptance filters. For standard frames the MCP2515 can
+        match the first two data bytes: RXB0 accepts frames whose second byte,
+        the node number high byte, is in node_numbers and RXB1 frames whose
+        opcode is in opcodes. Values that do not fit in the filters are merged
+        under a wider mask, so a wanted frame is never rejected. None for
+        either turns filtering off and every frame is received.
+        Frames with no data bytes (enumeration requests and replies) are kept
+        by an opcode 0x00 filter. That relies on the chip treating missing
+        data bytes as zero, and a frame from another node using our CAN ID is
+        only seen if it passes the filters, so clash detection is weaker.
+        Extended frames are not received while filtering.
+        :param node_numbers: node number high bytes to accept in any opcode
+        :param opcodes: opcodes to accept from any node
+        :return: 0, or 1 if the controller did not enter or leave configuration mode
+        """
+        locked = self.spi_lock
+        self.spi_lock = True
+        self.filter_args = (node_numbers, opcodes)
+        mode = self.read_reg(CANSTAT) >> 5
+        result = self.change_mode(4)  # Filters and masks are only writable in configuration mode
+        if node_numbers is None or opcodes is None:
+            self.write_reg(RXB0CTRL, RXM_ANY | BUKT)
+            self.write_reg(RXB1CTRL, RXM_ANY)
+        else:
+            opcodes = list(opcodes)
+            if 0 not in opcodes:
+                opcodes.append(0)
+            mask, values = filter_cover(node_numbers, 2)
+            self.write_regs(RXM0SIDH, bytes((0, 0, 0, mask)))
+            for reg, value in zip((RXF0SIDH, RXF1SIDH), values):
+                self.write_regs(reg, bytes((0, 0, 0, value)))
+            mask, values = filter_cover(opcodes, 4)
+            self.write_regs(RXM1SIDH, bytes((0, 0, mask, 0)))
+            for reg, value in zip((RXF2SIDH, RXF3SIDH, RXF4SIDH, RXF5SIDH), values):
+                self.write_regs(reg, bytes((0, 0, value, 0)))
+            self.write_reg(RXB0CTRL, BUKT)
+            self.write_reg(RXB1CTRL, 0)
+        result |= self.change_mode(mode)
+        if not locked: self.unlock()
+        return result
 
     def read_rx_status(self):
-        self.buffer = bytearray([CMD_RX_STATUS, 0])
-        self.spi.init(baudrate=self.rate)
-        self.cs(1)
+        self.buffer[0] = CMD_RX_STATUS
+        self.buffer[1] = 0
         self.cs(0)
-        self.spi.write_readinto(self.buffer, self.buffer)
+        self.spi.write_readinto(self.cmd2, self.cmd2)
         self.cs(1)
         return self.buffer[1]
 
     def send(self, msg=""):
-        tx_buffer = self.tx_buffer
-        if self.debug: print("\n-Send------------------------------")
-        if self.debug: print("-msg:", msg)
-        if len(msg) < 8:
-            if self.debug: print("Message too short!")
-            return 10
-        if msg[0] != ':' or msg[-1] != ';':
-            if self.debug: print("Message format wrong!")
-            return 11
-        if msg[1] == 'S':
-            if not all(c in HEXDIGITS for c in msg[2:6] + msg[7:-1]):
-                if self.debug: print("Non-Hex digits!")
-                return 12
-            tx_buffer[0] = (self.can_id >> 3)
-            tx_buffer[0] |= int.from_bytes(unhexlify(msg[2:4]), 'little') & 0b00110000
-            tx_buffer[1] = self.can_id << 5
-            self.data = unhexlify(msg[7:-1])
-            tx_buffer[4] = (msg[6] == 'R') * 64 + len(self.data)
-            tx_buffer[5:5 + len(self.data)] = self.data
-        elif msg[1] == 'X':
-            if not all(c in HEXDIGITS for c in msg[2:10] + msg[11:-1]):
-                if self.debug: print("Non-Hex digits!")
-                return 12
-            tx_buffer[0:4] = unhexlify(msg[2:10])
-            tx_buffer[1] |= 0b00001000
-            self.data = unhexlify(msg[11:-1])
-            tx_buffer[4] = (msg[10] == 'R') * 64 + len(self.data)
-            tx_buffer[5:5 + len(self.data)] = self.data
-        else:
-            if self.debug: print("Message not recognised!")
-            return 3
-        if self.debug: print("-Sending:", tx_buffer)
-        self.write_regs(0x31, tx_buffer)
-        self.write_reg(TXB0CTRL, 3)
-        if self.read_reg(TXB0CTRL) & 3 != 3:  # Check interface
-            if self.debug: print("MCP2515 missing!")
+        """
+        Queues a GridConnect message for transmission
+        :param msg: GridConnect message
+        :return: 0 if queued, otherwise an error code
+        """
+        error = self.tx_frame.from_gc(msg)
+        if error:
+            if self.debug: print("Message not recognised!", error)
+            return error
+        return self.send_frame(self.tx_frame)
+
+    def send_frame(self, frame, tx_class=-1, wait_ms=0):
+        """
+        Queues a frame for transmission without waiting for the bus. Standard
+        frames are sent with this node's CAN ID, the major priority in the
+        frame and the minor priority of their transmit class.
+        :param frame: CbusFrame
+        :param tx_class: TX_DCC, TX_EVENT, TX_NORMAL or TX_BULK, -1 for the class of the opcode
+        :param wait_ms: time to wait for room if the class queue is full, for
+               reply bursts that must not be dropped. Not while paused at bus-off
+               or when called with spi_lock held.
+        :return: 0 if queued, 2 if the class queue is full, 9 if the MCP2515 is missing
+        """
+        if not self.initialised:
             return 9
-        for MjPri in range(128, -1, -64):
-            if self.read_reg(TXB0CTRL) & TXREQ:
-                if self.debug: print("Tx buffer not available!")
+        buf = frame.buf
+        if tx_class < 0:
+            tx_class = tx_class_of(buf)
+        if not buf[1] & IDE:
+            buf[0] = (buf[0] & 0xC0) | (CLASS_MINOR[tx_class] << 4) | (self.can_id >> 3)
+            buf[1] = (self.can_id << 5) & 0xE0
+        locked = self.spi_lock
+        self.spi_lock = True
+        start = ticks_ms()
+        while True:
+            tx_in = self.tx_in[tx_class]
+            next_in = tx_in + 1
+            if next_in == self.tx_depth:
+                next_in = 0
+            if next_in != self.tx_out[tx_class]:
+                break
+            if locked or self.tx_paused or ticks_diff(ticks_ms(), start) >= wait_ms:
+                self.tx_dropped += 1
+                if not locked: self.unlock()
+                if _TRACE & _TR_FAULTS: trace.record(TR_TX_FULL, buf[5])
                 return 2
-            self.modify_reg(TXB0SIDH, 0b11000000, MjPri)
-            self.modify_reg(TXB0CTRL, TXREQ, TXREQ)  # Request transmisssion
-            self.start = ticks_ms()
-            while self.read_reg(TXB0CTRL) & TXREQ:
-                if ticks_diff(ticks_ms(), self.start) > TX_TIMEOUT:
-                    self.modify_reg(TXB0CTRL, TXREQ, 0)  # Abort transmisssion
-                    if MjPri == 0:
-                        if self.debug: print("Tx Timeout!")
-                        return 1
-            break
-        self.modify_reg(CANINTF, 4, 0)
+            self.unlock()  # Lets the interrupt, or poll() when it is disabled, free a transmit buffer
+            if not self.poll():
+                sleep_us(TX_WAIT_US)
+            self.spi_lock = True
+        slot = tx_class * self.tx_depth + tx_in
+        self.tx_slots[slot][:] = buf
+        self.tx_queued_at[slot] = ticks_us()
+        self.tx_in[tx_class] = next_in
+        waiting = self.tx_waiting()
+        if waiting > self.tx_high:
+            self.tx_high = waiting
+        if _TRACE & _TR_FRAMES: trace.record(TR_TX, buf[5], waiting)
+        self.tx_kick()
+        if not locked: self.unlock()
+        return 0
+
+    def tx_class_waiting(self, tx_class):
+        a = self.tx_in[tx_class] - self.tx_out[tx_class]
+        if a < 0: a += self.tx_depth
+        return a
+
+    def tx_waiting(self):
+        return (self.tx_class_waiting(TX_DCC) + self.tx_class_waiting(TX_EVENT) +
+                self.tx_class_waiting(TX_NORMAL) + self.tx_class_waiting(TX_BULK))
+
+    def tx_kick(self):
+        """
+        Loads queued frames into free transmit buffers, most urgent class
+        first. A class is ranked one class more urgent for every AGE_MS its
+        next frame has waited, and its first frame in the buffers gets TXP
+        3 - rank, so the MCP2515 sends an aged bulk reply ahead of fresh DCC
+        traffic rather than holding it back for ever.
+        A class with a frame in the buffers may load the next one as well, so
+        a burst goes out back to back instead of waiting for the interrupt
+        between frames, while one buffer stays free for another class. See
+        tx_follow for how the order within the class is kept, and tx_preempt
+        for a more urgent class finding every buffer taken.
+        Nothing is loaded while transmission is paused at bus-off.
+        Call with spi_lock held.
+        """
+        if self.tx_paused:
+            return
+        while True:
+            free = 0
+            for n in range(3):
+                if self.tx_txp[n] < 0:
+                    free += 1
+            if not free:
+                if self.tx_preempt():
+                    continue
+                return
+            now = ticks_us()
+            best = -1
+            best_rank = TX_CLASSES
+            for tx_class in range(TX_CLASSES):
+                loaded = self.tx_loaded[tx_class]
+                if loaded == self.tx_class_waiting(tx_class) or (loaded and free < 2):
+                    continue
+                position = self.tx_out[tx_class] + loaded
+                if position >= self.tx_depth:
+                    position -= self.tx_depth
+                slot = tx_class * self.tx_depth + position
+                rank = tx_class - ticks_diff(now, self.tx_queued_at[slot]) // (AGE_MS * 1000)
+                if rank >= best_rank:
+                    continue
+                if loaded:
+                    n, txp = self.tx_follow(tx_class)
+                    if n < 0:
+                        continue
+                else:
+                    for n in (2, 1, 0):  # The highest free buffer leaves the lower ones for the frames after it
+                        if self.tx_txp[n] < 0:
+                            break
+                    txp = 3 - rank if rank > 0 else 3
+                best = tx_class
+                best_rank = rank
+                best_n = n
+                best_txp = txp
+                best_position = position
+            if best < 0:
+                return
+            slot = best * self.tx_depth + best_position
+            self.load_tx_buffer(best_n, self.tx_slots[slot])
+            self.write_reg(TXB0CTRL + 16 * best_n, TXREQ | best_txp)
+            self.tx_txp[best_n] = best_txp
+            self.tx_class[best_n] = best
+            self.tx_slot[best_n] = best_position
+            self.tx_loaded[best] += 1
+            self.tx_start[best_n] = self.tx_queued_at[slot]
+            self.tx_load_ms[best_n] = ticks_ms()
+
+    def tx_follow(self, tx_class):
+        """
+        Picks the buffer and TXP for the next frame of a class that already
+        has frames in the buffers. The MCP2515 sends the pending buffer with
+        the highest TXP, the highest numbered buffer of those, so the frame
+        goes in a free buffer numbered below the class's last one at the same
+        TXP, or failing that at one TXP lower.
+        :return: buffer and TXP, buffer -1 if neither is possible
+        """
+        last = self.tx_last(tx_class)
+        txp = self.tx_txp[last]
+        for n in range(last - 1, -1, -1):
+            if self.tx_txp[n] < 0:
+                return n, txp
+        if txp:
+            for n in (2, 1, 0):
+                if self.tx_txp[n] < 0:
+                    return n, txp - 1
+        return -1, 0
+
+    def tx_last(self, tx_class):
+        """
+        The buffer holding the last frame of a class, the one with the lowest
+        TXP and then the lowest buffer number
+        """
+        last = -1
+        for n in range(3):
+            if self.tx_txp[n] >= 0 and self.tx_class[n] == tx_class and (
+                    last < 0 or self.tx_txp[n] < self.tx_txp[last]):
+                last = n
+        return last
+
+    def tx_preempt(self):
+        """
+        With every transmit buffer taken, frees one for the most urgent class
+        waiting with nothing in the buffers, by taking back the last frame of
+        a less urgent class that has more than one there. The frame stays
+        queued and is loaded again later. Call with spi_lock held.
+        :return: True if a buffer was freed
+        """
+        for tx_class in range(TX_CLASSES):
+            if self.tx_loaded[tx_class] or self.tx_in[tx_class] == self.tx_out[tx_class]:
+                continue
+            for victim in range(TX_CLASSES - 1, tx_class, -1):
+                if self.tx_loaded[victim] < 2:
+                    continue
+                n = self.tx_last(victim)
+                ctrl = TXB0CTRL + 16 * n
+                self.modify_reg(ctrl, TXREQ, 0)
+                status = self.read_reg(ctrl)
+                if status & TXREQ or not status & ABTF:
+                    return False  # On the bus, TXnIF will free the buffer
+                self.tx_txp[n] = -1
+                self.tx_loaded[victim] -= 1
+                return True
+            return False
         return False
 
+    def tx_done(self, n):
+        """
+        Frees transmit buffer n and takes its frame off the head of its class queue
+        """
+        tx_class = self.tx_class[n]
+        self.tx_txp[n] = -1
+        self.tx_loaded[tx_class] -= 1
+        tx_out = self.tx_out[tx_class] + 1
+        self.tx_out[tx_class] = 0 if tx_out == self.tx_depth else tx_out
+
+    def tx_irq(self, flags):
+        for n in range(3):
+            flag = TX0IF << n
+            if flags & flag:
+                self.modify_reg(CANINTF, flag, 0)
+                if self.tx_txp[n] >= 0:
+                    tx_class = self.tx_class[n]
+                    self.tx_done(n)
+                    self.tx_count += 1
+                    self.tx_class_sent[tx_class] += 1
+                    self.tx_time = ticks_diff(ticks_us(), self.tx_start[n])
+                    if self.tx_time > self.tx_time_max:
+                        self.tx_time_max = self.tx_time
+                    if self.tx_time > self.tx_class_max[tx_class]:
+                        self.tx_class_max[tx_class] = self.tx_time
+        self.tx_kick()
+
+    def tx_service(self):
+        """
+        Raises the major priority and TXP of frames that have waited more than
+        TX_TIMEOUT ms for the bus, dropping them once they have failed at major
+        priority 0. Samples the error counters and, at bus-off, waits for
+        recovery instead. Call regularly from the main loop.
+        """
+        locked = self.spi_lock
+        self.spi_lock = True
+        now = ticks_ms()
+        self.error_sample()
+        if self.tx_paused:
+            self.bus_off_service(now)
+            if not locked: self.unlock()
+            return
+        for n in range(3):
+            if self.tx_txp[n] < 0 or ticks_diff(now, self.tx_load_ms[n]) <= TX_TIMEOUT:
+                continue
+            tx_class = self.tx_class[n]
+            if self.tx_slot[n] != self.tx_out[tx_class]:
+                continue  # Behind the head of its class, which is retried instead
+            self.tx_hold(tx_class, n, 0)  # The frames behind must not go while the head is aborted
+            ctrl = TXB0CTRL + 16 * n
+            self.modify_reg(ctrl, TXREQ, 0)  # Abort transmisssion
+            status = self.read_reg(ctrl)
+            if status & TXREQ or not status & ABTF:
+                self.tx_hold(tx_class, n, TXREQ)
+                continue  # Still on the bus or sent, TXnIF will follow
+            sidh = self.read_reg(ctrl + 1)
+            if sidh & 0xC0 == 0:
+                if _TRACE & _TR_FAULTS: trace.record(TR_TX_TIMEOUT, n, sidh)
+                self.tx_done(n)
+                self.tx_failed += 1
+                self.tx_hold(tx_class, n, TXREQ)
+                continue
+            self.write_reg(ctrl + 1, sidh - 0x40)
+            self.tx_load_ms[n] = now
+            if self.tx_txp[n] < 3:
+                self.tx_txp[n] += 1
+            self.write_reg(ctrl, TXREQ | self.tx_txp[n])
+            self.tx_hold(tx_class, n, TXREQ)
+        self.tx_kick()
+        if not locked: self.unlock()
+
+    def tx_hold(self, tx_class, head, txreq):
+        """
+        Clears or sets TXREQ on the frames of a class behind its head
+        :param head: the head's buffer, left alone
+        :param txreq: 0 to hold them, TXREQ to let them go again
+        """
+        for n in range(3):
+            if n != head and self.tx_txp[n] >= 0 and self.tx_class[n] == tx_class:
+                self.write_reg(TXB0CTRL + 16 * n, txreq | self.tx_txp[n])
+
     def monitor(self):
         mon = self.read_regs(CNF3, 8)
         print()
@@ -0,0 +1,92 @@
+# Event variable driven actions
+#
+# A taught event's EVs are read as action records of three EVs each, starting
+# at EV1: action type, target and parameter, e.g. EV1 = ACTION_LED, EV2 = 0
+# (the first LED), EV3 = 8 (brightness). An action type of 0 ends the list.
+# The node registers a function for each action type it supports; records
+# with an unregistered type are dropped when the table is compiled.
+#
+# Compiling copies the valid records of every event into one bytearray, so
+# running an event is a loop over bytes calling the registered functions
+# with ints, with nothing allocated. The table is recompiled the next time
+# an event runs after events or EVs have changed.
+
+from micropython import const
+
+RECORD_LEN = const(3)
+
+# Action types, the node decides what each one drives
+ACTION_NONE = const(0)
+ACTION_OUTPUT = const(1)  # Target output on with the event, param 1 inverts
+ACTION_SERVO = const(2)  # Target servo to param with the event on, to its off position with it off
+ACTION_LED = const(3)  # Target LED on at level param with the event
+ACTION_PULSE = const(4)  # Target output pulsed for param * 10 ms when the event is on
+
+
+class ActionEngine():
+    def __init__(self, events):
+        """
+        :param events: the node's EventTable
+        """
+        self.events = events
+        self.slots = (events.width - 1) // RECORD_LEN
+        self.handlers = [None] * 256
+        self.records = bytearray(events.max_events * self.slots * RECORD_LEN)
+        self.counts = bytearray(events.max_events)
+        self.changes = -1
+
+    def register(self, action_type, func):
+        """
+        Registers the function that carries out an action type
+        :param action_type: 1 - 255
+        :param func: function(target, param, on) with on True for ACON/ASON
+        """
+        self.handlers[action_type] = func
+        self.changes = -1  # Records of this type are now valid
+
+    def compile(self):
+        """
+        Rebuilds the action records of every event from its EVs
+        """
+        events = self.events
+        handlers = self.handlers
+        records = self.records
+        width = events.width
+        slots = self.slots
+        evs = events.evs
+        for index in range(len(events)):
+            base = index * width + 1
+            out = index * slots * RECORD_LEN
+            count = 0
+            for slot in range(slots):
+                ev = base + slot * RECORD_LEN
+                action_type = evs[ev]
+                if action_type == ACTION_NONE:
+                    break
+                if handlers[action_type] is None:
+                    continue
+                records[out] = action_type
+                records[out + 1] = evs[ev + 1]
+                records[out + 2] = evs[ev + 2]
+                out += RECORD_LEN
+                count += 1
+            self.counts[index] = count
+        self.changes = events.changes
+
+    def run(self, index, on):
+        """
+        Runs the actions of a taught event
+        :param index: event index
+        :param on: True for ACON/ASON, False for ACOF/ASOF
+        :return: number of actions run, 0 if the event has none
+        """
+        if self.changes != self.events.changes:
+            self.compile()
+        count = self.counts[index]
+        records = self.records
+        handlers = self.handlers
+        record = index * self.slots * RECORD_LEN
+        for i in range(count):
+            handlers[records[record]](records[record + 1], records[record + 2], on)
+            record += RECORD_LEN
+        return count
@@ -0,0 +1,203 @@
+# CAN I/O on the second core
+#
+# With the dual_core config option can_pico hands its Cbus2515 to a CanWorker
+# running on core 1 under _thread. The worker owns the SPI bus: it services
+# the MCP2515 whenever INT is low, moves received frames into a ring for the
+# node, loads frames from the node's transmit rings into the driver queues,
+# retries stuck transmissions and answers enumeration. There is a transmit
+# ring for each of the driver's transmit classes, so a burst of replies in
+# TX_BULK never holds back a DCC frame. A slow handler on
+# core 0 then only fills the receive ring instead of leaving frames in the
+# MCP2515's two receive buffers to be overwritten.
+#
+# The rings are single producer single consumer: the producer only writes
+# head and the consumer only writes tail, each after the slot has been
+# copied, so neither side takes a lock. Pin interrupts are delivered to
+# core 0, so the worker polls the INT pin instead.
+
+import _thread
+from micropython import const
+from time import ticks_ms, ticks_diff, sleep_us
+import uasyncio
+from cbus_frame import CbusFrame
+from cbus2515 import TX_CLASSES, tx_class_of
+
+RX_RING_LEN = const(64)
+TX_RING_LEN = const(16)  # For each transmit class
+SERVICE_MS = const(20)  # Transmit retry interval, as the single core tx_task
+TX_WAIT_US = const(100)  # Pause between checks while send_frame waits for room in a transmit ring
+
+
+class FrameRing():
+    def __init__(self, depth):
+        """
+        :param depth: number of slots, the ring holds depth - 1 frames
+        """
+        self.depth = depth
+        self.ring = bytearray(13 * depth)
+        ring_mv = memoryview(self.ring)
+        self.slots = [ring_mv[i * 13:(i + 1) * 13] for i in range(depth)]
+        self.head = 0  # Written by the producer only
+        self.tail = 0  # Written by the consumer only
+        self.dropped = 0
+        self.high = 0
+
+    def __len__(self):
+        a = self.head - self.tail
+        if a < 0: a += self.depth
+        return a
+
+    def put(self, data):
+        """
+        Producer side: copies a frame in
+        :param data: 13 byte frame in register layout
+        :return: True, or False if the ring was full and the frame dropped
+        """
+        head = self.head
+        next_head = head + 1
+        if next_head == self.depth:
+            next_head = 0
+        if next_head == self.tail:
+            self.dropped += 1
+            return False
+        self.slots[head][:] = data
+        self.head = next_head
+        waiting = len(self)
+        if waiting > self.high:
+            self.high = waiting
+        return True
+
+    def get(self, frame):
+        """
+        Consumer side: copies the oldest frame out and decodes it
+        :param frame: CbusFrame to fill
+        :return: True if a frame was read, False if the ring was empty
+        """
+        tail = self.tail
+        if tail == self.head:
+            return False
+        frame.load(self.slots[tail])
+        tail += 1
+        self.tail = 0 if tail == self.depth else tail
+        return True
+
+
+class CanWorker():
+    def __init__(self, can, rx_len=RX_RING_LEN, tx_len=TX_RING_LEN, idle_us=0):
+        """
+        :param can: Cbus2515, not used from core 0 once the worker has started
+        :param rx_len: receive ring slots, frames for the node
+        :param tx_len: transmit ring slots for each transmit class, frames from the node
+        :param idle_us: sleep when there was nothing to do, 0 spins (core 1 has nothing else to run)
+        """
+        self.can = can
+        self.rx = FrameRing(rx_len)
+        self.tx = [FrameRing(tx_len) for tx_class in range(TX_CLASSES)]
+        self.rx_flag = uasyncio.ThreadSafeFlag()  # Set when frames are put in the receive ring
+        self.idle_us = idle_us
+        self.rx_frame = CbusFrame()
+        self.tx_frame = CbusFrame()
+        self.filters = None  # (node_numbers, opcodes) for the worker to program
+        self.filters_set = None
+        self.running = False
+        self.stopped = True
+        self.loops = 0
+
+    def start(self):
+        """
+        Takes the MCP2515 interrupt away from core 0 and starts the worker on core 1
+        """
+        self.can.irq_enable(False)
+        self.running = True
+        self.stopped = False
+        _thread.start_new_thread(self.run, ())
+
+    def stop(self):
+        """
+        Stops the worker and gives the interrupt back to core 0
+        """
+        self.running = False
+        while not self.stopped:
+            sleep_us(100)
+        self.can.irq_enable(True)
+
+    def set_filters(self, node_numbers, opcodes):
+        self.filters = (node_numbers, opcodes)
+
+    def send_frame(self, frame, wait_ms=0):
+        """
+        Core 0 side: queues a frame for the worker to transmit, in the ring of
+        its transmit class
+        :param frame: CbusFrame
+        :param wait_ms: time to wait for the worker to make room if the ring is full
+        :return: 0 if queued, 2 if the transmit ring is full
+        """
+        buf = frame.buf
+        ring = self.tx[tx_class_of(buf)]
+        if len(ring) < ring.depth - 1 or not wait_ms or not self.running:
+            return 0 if ring.put(buf) else 2
+        start = ticks_ms()
+        while len(ring) == ring.depth - 1 and ticks_diff(ticks_ms(), start) < wait_ms:
+            sleep_us(TX_WAIT_US)
+        return 0 if ring.put(buf) else 2
+
+    def read_frame(self, frame):
+        """
+        Core 0 side: the oldest received frame
+        :param frame: CbusFrame to fill
+        :return: True if a frame was read
+        """
+        return self.rx.get(frame)
+
+    def run(self):
+        serviced = ticks_ms()
+        try:
+            while self.running:
+                busy = self.poll()
+                now = ticks_ms()
+                if ticks_diff(now, serviced) >= SERVICE_MS:
+                    serviced = now
+                    self.can.tx_service()
+                if not busy and self.idle_us:
+                    sleep_us(self.idle_us)
+                self.loops += 1
+        finally:
+            self.stopped = True
+
+    def poll(self):
+        """
+        One pass of the worker loop
+        :return: True if anything was received, sent or programmed
+        """
+        can = self.can
+        busy = can.poll()
+        received = False
+        frame = self.rx_frame
+        while can.read_frame(frame):
+            self.rx.put(frame.buf)
+            received = True
+        if received:
+            self.rx_flag.set()
+            busy = True
+        frame = self.tx_frame
+        for tx_class in range(TX_CLASSES):
+            ring = self.tx[tx_class]
+            while can.tx_class_waiting(tx_class) < can.tx_depth - 1 and ring.get(frame):
+                can.send_frame(frame, tx_class)
+                busy = True
+        filters = self.filters
+        if filters is not self.filters_set:
+            self.filters_set = filters
+            can.set_filters(*filters)
+            busy = True
+        return busy
+
+    def stats(self):
+        return {'rx_waiting': len(self.rx),
+                'rx_dropped': self.rx.dropped,
+                'rx_high_water': self.rx.high,
+                'tx_waiting': sum(len(ring) for ring in self.tx),
+                'tx_dropped': sum(ring.dropped for ring in self.tx),
+                'tx_high_water': max(ring.high for ring in self.tx),
+                'tx_class_waiting': [len(ring) for ring in self.tx],
+                'loops': self.loops}
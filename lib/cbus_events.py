@@ -0,0 +1,163 @@
+# Compact table of taught CBUS events
+#
+# Events are held as packed 32-bit ids (node number << 16 | event number) with a
+# fixed width block of event variables per event. The index of an event is the
+# position it was taught at and is what NERD/ENRSP/REVAL/NEVAL use (1 based on
+# the bus). A second array keeps the indexes sorted by event id so a lookup is a
+# binary search rather than a scan.
+
+from array import array
+
+
+class EventTable():
+    def __init__(self, num_variables, max_events=255):
+        self.width = num_variables + 1  # EV 0 is kept so EV n is at offset n
+        self.max_events = max_events
+        self.count = 0
+        self.changes = 0  # Bumped whenever an event id, index or variable changes
+        self.owner = None  # Object whose events_dirty is set when an event id changes, see cbus_nodes
+        self.ids = array('I')  # 'I' is 32 bits on the Pico and on the host
+        self.evs = bytearray()
+        self.order = array('H')
+
+    def __len__(self):
+        return self.count
+
+    def _position(self, event_id):
+        ids = self.ids
+        order = self.order
+        lo = 0
+        hi = self.count
+        while lo < hi:
+            mid = (lo + hi) >> 1
+            if ids[order[mid]] < event_id:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def find(self, event_id):
+        """
+        Returns the index of a taught event
+        :param event_id: node number << 16 | event number
+        :return: index of the event or -1 if it has not been taught
+        """
+        pos = self._position(event_id)
+        if pos < self.count and self.ids[self.order[pos]] == event_id:
+            return self.order[pos]
+        return -1
+
+    def add(self, event_id):
+        """
+        Adds an event with all variables zero, returning the existing index if
+        the event is already known
+        :param event_id: node number << 16 | event number
+        :return: index of the event or -1 if the table is full
+        """
+        pos = self._position(event_id)
+        if pos < self.count and self.ids[self.order[pos]] == event_id:
+            return self.order[pos]
+        if self.count >= self.max_events:
+            return -1
+        index = self.count
+        if index == len(self.ids):
+            self.ids.append(event_id)
+            self.evs.extend(bytes(self.width))
+            self.order.append(0)
+        else:
+            self.ids[index] = event_id
+            start = index * self.width
+            for i in range(start, start + self.width):
+                self.evs[i] = 0
+        order = self.order
+        order[pos + 1:index + 1] = order[pos:index]
+        order[pos] = index
+        self.count += 1
+        self._ids_changed()
+        return index
+
+    def remove(self, event_id):
+        """
+        Removes an event. The last event is moved into the freed index so every
+        other event keeps its index.
+        :param event_id: node number << 16 | event number
+        :return: True if the event was removed
+        """
+        pos = self._position(event_id)
+        order = self.order
+        if pos >= self.count or self.ids[order[pos]] != event_id:
+            return False
+        index = order[pos]
+        last = self.count - 1
+        order[pos:last] = order[pos + 1:last + 1]
+        self.count = last
+        self._ids_changed()
+        if index != last:
+            self.ids[index] = self.ids[last]
+            width = self.width
+            self.evs[index * width:(index + 1) * width] = self.evs[last * width:(last + 1) * width]
+            order[self._position(self.ids[index])] = index
+        return True
+
+    def _ids_changed(self):
+        self.changes += 1
+        if self.owner is not None:
+            self.owner.events_dirty = True
+
+    def event_id(self, index):
+        return self.ids[index]
+
+    def get(self, index, ev_index):
+        return self.evs[index * self.width + ev_index]
+
+    def set(self, index, ev_index, value):
+        self.evs[index * self.width + ev_index] = value
+        self.changes += 1
+
+    def variables(self, index):
+        return memoryview(self.evs)[index * self.width:(index + 1) * self.width]
+
+    def clear(self):
+        self.count = 0
+        self._ids_changed()
+
+    def load(self, events):
+        """
+        Loads events from the data file
+        :param events: list of {'event_identifier': 'NNNNEEEE', 'variables': [...]},
+               the older dict keyed by event identifier or a tuple of load_blocks arguments
+        """
+        if isinstance(events, tuple):  # Blocks from the binary data file
+            self.load_blocks(*events)
+            return
+        self.clear()
+        if isinstance(events, dict):
+            events = events.values()
+        for event in events:
+            index = self.add(int(event['event_identifier'], 16))
+            if index < 0:
+                break
+            variables = event['variables']
+            for ev_index in range(min(len(variables), self.width)):
+                self.set(index, ev_index, variables[ev_index])
+
+    def load_blocks(self, count, ids, order, evs):
+        """
+        Takes over events read as blocks from the binary data file
+        :param count: number of events
+        :param ids: array('I') of event ids in index order
+        :param order: array('H') of indexes sorted by event id
+        :param evs: bytearray of count * width event variables
+        """
+        self.count = count
+        self._ids_changed()
+        self.ids = ids
+        self.order = order
+        self.evs = evs
+
+    def export(self):
+        """
+        Returns the events in index order in the data file layout
+        """
+        return [{'event_identifier': '%08X' % self.ids[i], 'variables': list(self.variables(i))}
+                for i in range(self.count)]
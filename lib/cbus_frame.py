@@ -0,0 +1,163 @@
+# CBUS frame held in the MCP2515 register layout
+#
+# A frame is 13 bytes: SIDH, SIDL, EID8, EID0, DLC, D0..D7 - the same layout
+# the Cbus2515 driver keeps in its receive stack, so a frame can be filled with
+# a single copy and decoded into ints without building a GridConnect string.
+
+from micropython import const
+from binascii import hexlify, unhexlify
+
+FRAME_LEN = const(13)
+
+# Bit definition masks
+IDE = const(8)
+SRR = const(16)
+RTR = const(64)
+DLC = const(15)
+PRIORITY_NORMAL = const(0x0B)  # Major priority 2, minor priority 3, as ":SB..."
+
+
+class CbusFrame():
+    def __init__(self):
+        self.buf = bytearray(FRAME_LEN)
+        self.mv = memoryview(self.buf)
+        self.opcode = -1
+        self.nn = 0
+        self.en = 0
+        self.dlc = 0
+
+    def load(self, src):
+        """
+        Copies a frame out of a receive stack slot and decodes it
+        :param src: 13 byte bytearray or memoryview in register layout
+        """
+        self.mv[:] = src
+        self.decode()
+
+    def decode(self):
+        buf = self.buf
+        self.dlc = buf[4] & DLC
+        if self.dlc:
+            self.opcode = buf[5]
+        else:
+            self.opcode = -1
+        self.nn = (buf[6] << 8) | buf[7]
+        self.en = (buf[8] << 8) | buf[9]
+
+    def extended(self):
+        return self.buf[1] & IDE != 0
+
+    def rtr(self):
+        if self.buf[1] & IDE:
+            return self.buf[4] & RTR != 0
+        return self.buf[1] & SRR != 0 or self.buf[4] & RTR != 0
+
+    def can_id(self):
+        return ((self.buf[0] << 3) | (self.buf[1] >> 5)) & 0x7F
+
+    def priority(self):
+        return self.buf[0] >> 4
+
+    def data(self, index):
+        return self.buf[5 + index]
+
+    def build(self, opcode, nn=0, en=0, priority=PRIORITY_NORMAL):
+        """
+        Fills the frame as a standard CBUS message without going through
+        GridConnect. The data length comes from the opcode, unused data bytes
+        are zero and the CAN ID is left for the driver to fill in.
+        :param opcode: CBUS opcode
+        :param nn: data bytes 1 and 2, normally a node number
+        :param en: data bytes 3 and 4, normally an event number
+        :param priority: major priority << 2 | minor priority
+        :return: the frame, so other data bytes can be set with put()
+        """
+        buf = self.buf
+        buf[0] = priority << 4
+        buf[1] = 0
+        buf[2] = 0
+        buf[3] = 0
+        buf[4] = (opcode >> 5) + 1
+        buf[5] = opcode
+        buf[6] = nn >> 8
+        buf[7] = nn & 0xFF
+        buf[8] = en >> 8
+        buf[9] = en & 0xFF
+        buf[10] = 0
+        buf[11] = 0
+        buf[12] = 0
+        self.dlc = buf[4]
+        self.opcode = opcode
+        self.nn = nn
+        self.en = en
+        return self
+
+    def put(self, index, value):
+        """
+        Sets a data byte of a built frame
+        :param index: data byte, 0 is the opcode
+        :param value: 0 - 255
+        """
+        self.buf[5 + index] = value
+
+    def from_gc(self, msg):
+        """
+        Fills the frame from a GridConnect string
+        :param msg: GridConnect message e.g. ":SB020N9000010002;"
+        :return: 0 if the message was parsed, otherwise the Cbus2515 send error code
+        """
+        buf = self.buf
+        if len(msg) < 8:
+            return 10
+        if msg[0] != ':' or msg[-1] != ';':
+            return 11
+        try:
+            if msg[1] == 'S':
+                header = int(msg[2:6], 16)
+                buf[0] = header >> 8
+                buf[1] = header & 0xFF
+                buf[2] = 0
+                buf[3] = 0
+                rtr = msg[6] == 'R'
+                data = unhexlify(msg[7:-1])
+            elif msg[1] == 'X':
+                header = int(msg[2:10], 16)
+                buf[0] = header >> 24
+                buf[1] = ((header >> 16) & 0xFF) | IDE
+                buf[2] = (header >> 8) & 0xFF
+                buf[3] = header & 0xFF
+                rtr = msg[10] == 'R'
+                data = unhexlify(msg[11:-1])
+            else:
+                return 3
+        except ValueError:
+            return 12
+        n = len(data)
+        if n > 8:
+            return 12
+        buf[4] = rtr * RTR + n
+        buf[5:5 + n] = data
+        self.decode()
+        return 0
+
+    def to_gc(self):
+        """
+        Returns the frame as an upper case GridConnect string. Only needed when a
+        transport or a log actually wants the text form.
+        """
+        buf = self.buf
+        if buf[1] & IDE:
+            msg = ':X' + hexlify(self.mv[0:4]).decode()
+            if buf[4] & RTR:
+                msg += 'R'
+            else:
+                msg += 'N'
+        else:
+            msg = ':S' + hexlify(self.mv[0:2]).decode()
+            if buf[1] & SRR or buf[4] & RTR:
+                msg += 'R'
+            else:
+                msg += 'N'
+        msg += hexlify(self.mv[5:5 + (buf[4] & DLC)]).decode()
+        msg += ';'
+        return msg.upper()
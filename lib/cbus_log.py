@@ -0,0 +1,101 @@
+# Trace ring for timing sensitive diagnostics
+#
+# Printing over USB from the receive path changes the timing enough to hide
+# the problem being looked for. Instead a module records fixed size binary
+# events, timestamp, event code and two ints, into a preallocated ring and the
+# ring is dumped afterwards from the REPL:
+#
+#   import cbus_log
+#   cbus_log.trace.dump()
+#
+# Each module that records events has its own level, and each record site
+# tests the bit of its level:
+#
+#   _TRACE = const(0)  # 0 off, 1 faults, 3 faults and every frame
+#   _TR_FAULTS = const(1)  # Frames dropped or rejected, transmit timeouts
+#   _TR_FRAMES = const(2)  # Every frame received, handled and queued
+#   ...
+#   if _TRACE & _TR_FRAMES: trace.record(TR_RX, opcode, nn)
+#
+# The MicroPython compiler folds & on consts defined in the same module, so
+# a disabled level leaves if 0, which it drops with the whole statement.
+# Tracing costs nothing until a module is deployed with a non zero _TRACE.
+# The level consts are defined in each module rather than imported, as an
+# imported name is looked up at run time and not folded.
+# Messages meant for a person stay behind the node's run time debug flag.
+
+from micropython import const
+from time import ticks_us, ticks_diff
+from array import array
+
+TRACE_LEN = const(256)
+RECORD_WORDS = const(4)  # ticks_us, code, a, b, signed 32 bit
+
+# Event codes
+TR_RX = const(1)  # Frame dispatched: a = opcode, b = node number
+TR_HANDLER = const(2)  # Handler returned: a = opcode, time since the TR_RX is the handler time
+TR_EVENT = const(3)  # Taught event consumed: a = event index, b = 1 on, 0 off
+TR_NO_HANDLER = const(4)  # a = opcode
+TR_BAD_LENGTH = const(5)  # a = opcode, b = DLC
+TR_TX = const(6)  # Frame queued: a = opcode, b = frames waiting
+TR_TX_FULL = const(7)  # Transmit queue full: a = opcode
+TR_TX_TIMEOUT = const(8)  # Frame aborted after TX_TIMEOUT: a = buffer, b = SIDH
+TR_RX_READ = const(9)  # Frame taken from the receive stack: a = opcode, b = frames left
+TR_ZERO_LENGTH = const(10)  # Zero length frame while enumerating: a = SIDH, b = SIDL
+
+NAMES = {TR_RX: 'rx', TR_HANDLER: 'handler', TR_EVENT: 'event', TR_NO_HANDLER: 'no handler',
+         TR_BAD_LENGTH: 'bad length', TR_TX: 'tx', TR_TX_FULL: 'tx full', TR_TX_TIMEOUT: 'tx timeout',
+         TR_RX_READ: 'rx read', TR_ZERO_LENGTH: 'zero length'}
+
+
+class Trace():
+    def __init__(self, length=TRACE_LEN):
+        self.length = length
+        self.records = array('i', bytes(4 * RECORD_WORDS * length))
+        self.index = 0
+        self.wrapped = False
+
+    def record(self, code, a=0, b=0):
+        """
+        Records an event, overwriting the oldest once the ring is full. Safe to
+        call from an interrupt handler, it does not allocate as long as a and
+        b are small ints, -1 for an unknown event index is fine.
+        """
+        records = self.records
+        i = self.index * RECORD_WORDS
+        records[i] = ticks_us()
+        records[i + 1] = code
+        records[i + 2] = a
+        records[i + 3] = b
+        self.index += 1
+        if self.index == self.length:
+            self.index = 0
+            self.wrapped = True
+
+    def clear(self):
+        self.index = 0
+        self.wrapped = False
+
+    def entries(self):
+        """
+        Returns the recorded events oldest first as (ticks_us, code, a, b)
+        """
+        order = list(range(self.index, self.length)) if self.wrapped else []
+        order += list(range(self.index))
+        records = self.records
+        return [tuple(records[i * RECORD_WORDS:(i + 1) * RECORD_WORDS]) for i in order]
+
+    def dump(self):
+        """
+        Prints the recorded events oldest first, times relative to the first
+        """
+        entries = self.entries()
+        if not entries:
+            print("Trace empty")
+            return
+        first = entries[0][0]
+        for ticks, code, a, b in entries:
+            print('%10d %-12s %5d %5d' % (ticks_diff(ticks, first), NAMES.get(code, str(code)), a, b))
+
+
+trace = Trace()
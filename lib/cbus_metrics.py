@@ -0,0 +1,154 @@
+# Node metrics
+#
+# Counts every received opcode, times each handler with ticks_us and keeps a
+# histogram of handler times per opcode, and counts send results by the
+# Cbus2515 return code. Counting a frame is a few array updates; histograms
+# are only allocated for opcodes that have a handler.
+#
+# snapshot() returns everything as a dictionary for the REPL, with the
+# driver's error state and counters under 'errors'. Over CBUS the
+# node variables from METRICS_NV up are reserved for metrics:
+#   NVSET 0xF0 n   selects opcode n for the per opcode values below
+#   NVRD  0xF0     selected opcode
+#   NVRD  0xF1-F4  frames received with the selected opcode, 32 bits big endian
+#   NVRD  0xF5-F6  mean handler time in us
+#   NVRD  0xF7-F8  longest handler time in us
+#   NVRD  0xF9-FA  frames the driver could not send (queue full or aborted)
+#   NVRD  0xFB-FC  frames dropped because the receive stack was full
+#   NVRD  0xFD     receive stack high water mark
+#   NVRD  0xFE     transmit queue high water mark
+#   NVSET 0xFF n   resets the metrics and the driver statistics
+# 16 bit values stop at 0xFFFF.
+
+from micropython import const
+from time import ticks_us, ticks_diff
+from array import array
+
+METRICS_NV = const(0xF0)
+METRICS_RESET_NV = const(0xFF)
+
+# Handler time histogram bucket upper limits in us, the last bucket has no limit
+BUCKETS = (50, 100, 200, 500, 1000, 2000, 5000)
+
+
+class Metrics():
+    def __init__(self, driver=None):
+        """
+        :param driver: Cbus2515 or None, for receive stack and transmit queue statistics
+        """
+        self.driver = driver
+        self.received = array('I', bytes(4 * 256))
+        self.handled = array('I', bytes(4 * 256))
+        self.time_total = array('I', bytes(4 * 256))
+        self.time_max = array('I', bytes(4 * 256))
+        self.histograms = {}
+        self.sent = array('I', bytes(4 * 16))  # By send() return code, 15 for anything higher
+        self.selected = 0
+        self.start = 0
+
+    def frame(self, opcode):
+        self.received[opcode] += 1
+
+    def handler_start(self):
+        self.start = ticks_us()
+
+    def handler_end(self, opcode):
+        elapsed = ticks_diff(ticks_us(), self.start)
+        total = self.time_total[opcode] + elapsed
+        if total > 0xFFFFFFFF:  # Halve both so the mean survives
+            total >>= 1
+            self.handled[opcode] >>= 1
+        self.handled[opcode] += 1
+        self.time_total[opcode] = total
+        if elapsed > self.time_max[opcode]:
+            self.time_max[opcode] = elapsed
+        histogram = self.histograms.get(opcode)
+        if histogram is None:
+            histogram = array('I', bytes(4 * (len(BUCKETS) + 1)))
+            self.histograms[opcode] = histogram
+        bucket = 0
+        for limit in BUCKETS:
+            if elapsed < limit:
+                break
+            bucket += 1
+        histogram[bucket] += 1
+
+    def send_result(self, result):
+        self.sent[result if result < 15 else 15] += 1
+
+    def reset(self):
+        for table in (self.received, self.handled, self.time_total, self.time_max, self.sent):
+            for i in range(len(table)):
+                table[i] = 0
+        self.histograms = {}
+        if self.driver is not None:
+            self.driver.reset_stats()
+
+    def mean_us(self, opcode):
+        handled = self.handled[opcode]
+        return self.time_total[opcode] // handled if handled else 0
+
+    def snapshot(self):
+        """
+        Returns the metrics as a dictionary, opcodes that have not been seen are left out
+        """
+        opcodes = {}
+        for opcode in range(256):
+            if self.received[opcode]:
+                entry = {'received': self.received[opcode]}
+                if self.handled[opcode]:
+                    entry['mean_us'] = self.mean_us(opcode)
+                    entry['max_us'] = self.time_max[opcode]
+                    entry['histogram'] = list(self.histograms[opcode])
+                opcodes['%02X' % opcode] = entry
+        sent = {}
+        for result in range(len(self.sent)):
+            if self.sent[result]:
+                sent[result] = self.sent[result]
+        data = {'opcodes': opcodes, 'buckets_us': BUCKETS, 'send_results': sent}
+        if self.driver is not None:
+            data['rx'] = self.driver.rx_stats()
+            data['tx'] = self.driver.tx_stats()
+            data['errors'] = self.driver.error_stats()
+        return data
+
+    def nv_read(self, nv_index):
+        """
+        Returns the value of a reserved metrics NV
+        :param nv_index: METRICS_NV - 0xFF
+        """
+        opcode = self.selected
+        offset = nv_index - METRICS_NV
+        if offset == 0:
+            return opcode
+        if offset <= 4:
+            return (self.received[opcode] >> (8 * (4 - offset))) & 0xFF
+        if offset <= 6:
+            value = self.mean_us(opcode)
+        elif offset <= 8:
+            value = self.time_max[opcode]
+        elif self.driver is None:
+            return 0
+        elif offset <= 10:
+            value = self.driver.tx_dropped + self.driver.tx_failed
+        elif offset <= 12:
+            value = self.driver.rx_dropped
+        elif offset == 13:
+            return min(self.driver.rx_high, 255)
+        elif offset == 14:
+            return min(self.driver.tx_high, 255)
+        else:
+            return 0
+        value = min(value, 0xFFFF)
+        return value >> 8 if offset & 1 else value & 0xFF
+
+    def nv_write(self, nv_index, value):
+        """
+        Selects an opcode or resets the metrics through a reserved NV
+        :param nv_index: METRICS_NV - 0xFF
+        :param value: 0 - 255
+        """
+        if nv_index == METRICS_NV:
+            self.selected = value
+        elif nv_index == METRICS_RESET_NV:
+            self.reset()
@@ -0,0 +1,252 @@
+# Several logical CBUS nodes on one board
+#
+# A NodeHost shares one Cbus2515, with its receive stack and transmit queue,
+# between HostedNode instances. Each hosted node has its own config, node
+# number, parameters, NVs, events and data file, and is set up on the bus
+# like a separate module (RQNN from its own button, SNN, NNLRN...).
+#
+#   can = cbus2515.Cbus2515(spi, Pin(13), Pin(14))
+#   host = NodeHost(can)
+#   points = host.add(PointsNode(points_config))
+#   signals = host.add(SignalsNode(signals_config))
+#   can.change_mode(0)
+#   host.start()
+#
+# Received frames are routed rather than offered to every node: opcodes
+# addressed to a node number go to the node with that number through a
+# dictionary, ACON/ACOF/ASON/ASOF go only to the nodes that were taught the
+# event, through a dictionary of event identifiers rebuilt when a node's event
+# table flags the host as changed, and everything else (QNN, SNN, EVLRN...)
+# goes to every node.
+# Frames a hosted node sends are delivered to the others as well, as the bus
+# never returns a controller's own frames.
+#
+# All the hosted nodes send with the board's CAN ID.
+
+from micropython import const
+import uasyncio
+from cbus_frame import CbusFrame
+from cbus_dual import CanWorker
+import CbusFlimNode
+
+# Opcodes whose handlers only act on frames carrying their node's number
+ADDRESSED = (0x53, 0x54, 0x57, 0x58, 0x71, 0x73, 0x96, 0x9C)
+
+ACON = const(0x90)
+ACOF = const(0x91)
+ASON = const(0x98)
+ASOF = const(0x99)
+LOCAL_DEPTH = const(4)  # Nested deliveries between hosted nodes, a handler sending while handling a sibling's frame
+
+
+class HostedNode(CbusFlimNode.CbusNode):
+    def __init__(self, config):
+        self.host = None  # Set by NodeHost.add
+        self.filters = (None, None)
+        CbusFlimNode.CbusNode.__init__(self, config)
+
+    def send(self, msg):
+        self.host.send(msg, self)
+
+    def send_frame(self, frame, wait_ms=0):
+        return self.host.send_frame(frame, self, wait_ms)
+
+    def set_filters(self, node_numbers, opcodes):
+        self.filters = (node_numbers, opcodes)
+        if self.host is not None:
+            self.host.update_filters()
+
+
+class NodeHost():
+    def __init__(self, can, dual_core=False, debug=False):
+        """
+        :param can: Cbus2515 shared by the hosted nodes
+        :param dual_core: True to run the CAN I/O on core 1, see cbus_dual
+        """
+        self.debug = debug
+        self.can = can
+        self.worker = CanWorker(can) if dual_core else None
+        self.nodes = []
+        self.node_ids = []
+        self.by_node = {}  # Node number: node
+        self.by_event = {}  # Event identifier: tuple of nodes that consume it
+        self.events_dirty = True  # Set by the hosted nodes' EventTables when an event id changes
+        self.addressed = bytearray(256)
+        for opcode in ADDRESSED:
+            self.addressed[opcode] = 1
+        self.rx_frame = CbusFrame()
+        self.gc_frame = CbusFrame()
+        self.local_frames = [CbusFrame() for i in range(LOCAL_DEPTH)]
+        self.local_depth = 0
+
+    def add(self, node):
+        """
+        Adds a hosted node
+        :param node: HostedNode
+        :return: the node
+        """
+        node.host = self
+        node.events.owner = self
+        self.nodes.append(node)
+        self.events_dirty = True
+        if self.worker is None:
+            node.metrics.driver = self.can
+        self.index_nodes()
+        node.update_filters()
+        self.update_filters()
+        return node
+
+    def index_nodes(self):
+        self.by_node = {}
+        self.node_ids = []
+        for node in self.nodes:
+            self.node_ids.append(node.nodeId)
+            if node.nodeId:
+                self.by_node[node.nodeId] = node
+
+    def nodes_changed(self):
+        for i in range(len(self.nodes)):
+            if self.nodes[i].nodeId != self.node_ids[i]:
+                return True
+        return False
+
+    def index_events(self):
+        self.events_dirty = False
+        by_event = {}
+        for node in self.nodes:
+            events = node.events
+            for index in range(len(events)):
+                event_identifier = events.event_id(index)
+                by_event[event_identifier] = by_event.get(event_identifier, ()) + (node,)
+        self.by_event = by_event
+
+    def update_filters(self):
+        """
+        Programs the controller with every frame any hosted node wants
+        """
+        node_numbers = []
+        opcodes = []
+        for node in self.nodes:
+            numbers, wanted = node.filters
+            if numbers is None or wanted is None:
+                node_numbers = None
+                break
+            for number in numbers:
+                if number not in node_numbers:
+                    node_numbers.append(number)
+            for opcode in wanted:
+                if opcode not in opcodes:
+                    opcodes.append(opcode)
+        if node_numbers is None:
+            opcodes = None
+        if self.worker:
+            self.worker.set_filters(node_numbers, opcodes)
+        else:
+            self.can.set_filters(node_numbers, opcodes)
+
+    def execute_frame(self, frame, sender=None):
+        """
+        Routes a frame to the hosted nodes that want it
+        :param frame: CbusFrame with opcode, nn and en decoded
+        :param sender: hosted node that sent the frame, it is not given its own frame
+        """
+        if not frame.dlc:
+            return
+        opcode = frame.opcode
+        if self.addressed[opcode]:
+            node = self.by_node.get(frame.nn)
+            if (node is None or node.nodeId != frame.nn) and self.nodes_changed():
+                self.index_nodes()
+                node = self.by_node.get(frame.nn)
+            if node is not None and node is not sender:
+                node.execute_frame(frame)
+            return
+        if opcode == ACON or opcode == ACOF:
+            event_identifier = (frame.nn << 16) | frame.en
+        elif opcode == ASON or opcode == ASOF:
+            event_identifier = frame.en
+        else:
+            for node in self.nodes:
+                if node is not sender:
+                    node.execute_frame(frame)
+            return
+        if self.events_dirty:
+            self.index_events()
+        for node in self.by_event.get(event_identifier, ()):
+            if node is not sender:
+                node.execute_frame(frame)
+
+    def send_frame(self, frame, sender=None, wait_ms=0):
+        """
+        Queues a frame for the bus and delivers it to the other hosted nodes
+        :param frame: CbusFrame
+        :param sender: hosted node sending it
+        :param wait_ms: time to wait for room if the transmit queue is full
+        """
+        result = self.worker.send_frame(frame, wait_ms) if self.worker else self.can.send_frame(frame, -1, wait_ms)
+        if sender is not None:
+            sender.metrics.send_result(result)
+        if len(self.nodes) > 1 and self.local_depth < LOCAL_DEPTH:
+            local = self.local_frames[self.local_depth]  # A sibling may send, reusing frame, while handling it
+            local.load(frame.buf)
+            self.local_depth += 1
+            try:
+                self.execute_frame(local, sender)
+            finally:
+                self.local_depth -= 1
+        return result
+
+    def send(self, msg, sender=None):
+        error = self.gc_frame.from_gc(msg)
+        if error:
+            if self.debug: print("Message not recognised!", error)
+            if sender is not None:
+                sender.metrics.send_result(error)
+            return
+        self.send_frame(self.gc_frame, sender)
+
+    async def rx_task(self):
+        source = self.worker or self.can
+        frame = self.rx_frame
+        while True:
+            await source.rx_flag.wait()
+            while source.read_frame(frame):
+                self.execute_frame(frame)
+
+    async def tx_task(self):
+        while True:
+            self.can.tx_service()
+            await uasyncio.sleep_ms(20)
+
+    async def periodic_task(self):
+        while True:
+            for node in self.nodes:
+                node.store.poll(node.learn)
+            await uasyncio.sleep_ms(100)
+
+    async def main(self):
+        if self.worker:
+            self.worker.start()
+        else:
+            uasyncio.create_task(self.tx_task())
+        uasyncio.create_task(self.periodic_task())
+        await self.rx_task()
+
+    def start(self):
+        uasyncio.run(self.main())
+
+    def process(self):
+        """
+        One pass of a polling loop, for boards that do not use start()
+        """
+        if self.worker:
+            if not self.worker.running:
+                self.worker.start()
+            while self.worker.read_frame(self.rx_frame):
+                self.execute_frame(self.rx_frame)
+        else:
+            while self.can.read_frame(self.rx_frame):
+                self.execute_frame(self.rx_frame)
+            self.can.tx_service()
+        for node in self.nodes:
+            node.store.poll(node.learn)
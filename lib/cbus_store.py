@@ -0,0 +1,292 @@
+# Journaled node data store
+#
+# The node data is kept as a binary snapshot plus an append only journal of
+# fixed size change records. A NVSET or EVLRN appends one 8 byte record instead
+# of rewriting the whole data file. When the journal grows past compact_at
+# records it is folded into a new snapshot.
+#
+# The snapshot is a fixed header followed by blocks at offsets known from the
+# header: parameters, node variables, event ids, the event id sort order, event
+# variables and any data keys the header has no field for as JSON. Each block
+# is read with a single read straight into the array the node uses, so boot
+# does no parsing per event. A node with only the older JSON data file is
+# migrated on its first boot, and export_json() writes the JSON layout back
+# out for reading by hand.
+#
+# Snapshots and journal resets are written to a temporary file and renamed
+# over the old one, so a power cut leaves either the old or the new file. The
+# snapshot carries a generation number and the journal starts with a record
+# holding the generation it applies to; a journal left over from before a
+# compaction is ignored because the snapshot already contains its changes.
+
+from micropython import const
+from time import ticks_ms, ticks_diff
+from array import array
+import json
+import os
+import struct
+
+REC_LEN = const(8)
+REC_FORMAT = '>BBHI'
+
+# Binary snapshot header, little endian to match the arrays on the Pico. The
+# node variable counts are 16 bit since CBN2, a node may have 255 NVs and
+# variables holds NV 0 as well. A CBN1 snapshot is still read.
+MAGIC = b'CBN2'
+HEADER_FORMAT = '<4sIHBBBBBBHBHBHBH8sH'
+HEADER_LEN = const(37)
+MAGIC_1 = b'CBN1'
+HEADER_FORMAT_1 = '<4sIHBBBBBBHBBBHBB8sH'
+HEADER_LEN_1 = const(35)
+HEADER_KEYS = ('nodeId', 'manufId', 'cpuManufId', 'moduleId', 'minorVersion', 'majorVersion', 'beta',
+               'numEvents', 'numEventVariables', 'numNodeVariables', 'name', 'parameters', 'variables')
+FLAG_KEYS = ('consumer', 'producer', 'flim', 'bootloader', 'coe')
+
+# Record kinds
+REC_GENERATION = const(0x47)  # G, id = generation
+REC_NV = const(0x4E)  # N, a = NV index, b = value
+REC_EV = const(0x45)  # E, a = EV index, b = value, id = event identifier
+REC_REMOVE = const(0x44)  # D, id = event identifier
+REC_NODE = const(0x49)  # I, b = node number
+
+# Flush policies
+FLUSH_IMMEDIATE = const(0)
+FLUSH_DEFERRED = const(1)
+FLUSH_LEARN = const(2)
+
+
+class NodeStore():
+    def __init__(self, data_file, snapshot, policy=FLUSH_IMMEDIATE, delay=500, compact_at=256, debug=False):
+        """
+        :param data_file: name of the JSON data file, the snapshot is the same name ending
+               .bin and the journal is data_file + '.jnl'
+        :param snapshot: function returning the complete node data dictionary
+        :param policy: FLUSH_IMMEDIATE, FLUSH_DEFERRED (delay ms after the first
+               change) or FLUSH_LEARN (when learn mode ends)
+        :param compact_at: journal records before the journal is folded into a snapshot
+        """
+        self.data_file = data_file
+        if data_file.endswith('.json'):
+            self.binary_file = data_file[:-5] + '.bin'
+        else:
+            self.binary_file = data_file + '.bin'
+        self.snapshot = snapshot
+        self.journal_file = data_file + '.jnl'
+        self.policy = policy
+        self.delay = delay
+        self.compact_at = compact_at
+        self.debug = debug
+        self.generation = 0
+        self.records = 0
+        self.pending = bytearray()
+        self.pending_since = 0
+        self.bytes_written = 0
+        self.migrated = False
+
+    def load(self):
+        """
+        Reads the snapshot, falling back to the JSON data file
+        :return: the data dictionary or None if there is no data file. data['events']
+                 is a tuple for EventTable.load_blocks, or the JSON event list
+        """
+        try:
+            f = open(self.binary_file, 'rb')
+        except OSError:
+            return self.load_json()
+        with f:
+            header = f.read(HEADER_LEN_1)
+            if header[:4] == MAGIC:
+                header += f.read(HEADER_LEN - HEADER_LEN_1)
+                header_format, header_len = HEADER_FORMAT, HEADER_LEN
+            else:
+                header_format, header_len = HEADER_FORMAT_1, HEADER_LEN_1
+            if len(header) < header_len or header[:4] not in (MAGIC, MAGIC_1):
+                if self.debug: print("Bad snapshot : " + self.binary_file)
+                return self.load_json()
+            (magic, generation, node_id, manuf_id, cpu_manuf_id, module_id, minor_version, major_version, beta,
+             num_events, num_event_variables, num_node_variables, flags, count, num_parameters, num_variables,
+             name, extra_len) = struct.unpack(header_format, header)
+            data = {'nodeId': node_id,
+                    'manufId': manuf_id,
+                    'cpuManufId': cpu_manuf_id,
+                    'moduleId': module_id,
+                    'minorVersion': chr(minor_version),
+                    'majorVersion': major_version,
+                    'beta': beta,
+                    'numEvents': num_events,
+                    'numEventVariables': num_event_variables,
+                    'numNodeVariables': num_node_variables,
+                    'name': name.rstrip(b'\x00').decode(),
+                    'parameters': bytearray(f.read(num_parameters)),
+                    'variables': bytearray(f.read(num_variables))}
+            for bit in range(len(FLAG_KEYS)):
+                data[FLAG_KEYS[bit]] = flags & (1 << bit) != 0
+            ids = array('I', f.read(4 * count))
+            order = array('H', f.read(2 * count))
+            evs = bytearray(f.read(count * (num_event_variables + 1)))
+            if len(ids) != count or len(order) != count:
+                if self.debug: print("Short snapshot : " + self.binary_file)
+                return self.load_json()
+            data['events'] = (count, ids, order, evs)
+            if extra_len:
+                data.update(json.loads(f.read(extra_len)))
+        self.generation = generation
+        return data
+
+    def load_json(self):
+        """
+        Reads the older JSON data file, the node then writes a binary snapshot
+        :return: the data dictionary or None if there is no data file
+        """
+        try:
+            with open(self.data_file) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return None
+        self.generation = data.pop('generation', 0)
+        data['parameters'] = bytearray(int(p, 16) for p in data['parameters'])
+        data['variables'] = bytearray(data['variables'])
+        self.migrated = True
+        return data
+
+    def replay(self, apply):
+        """
+        Applies the journal written since the last snapshot
+        :param apply: function(kind, a, b, event_identifier) called for each record
+        """
+        self.records = 0
+        try:
+            with open(self.journal_file, 'rb') as f:
+                journal = f.read()
+        except OSError:
+            return
+        if len(journal) < REC_LEN:
+            return
+        kind, a, b, generation = struct.unpack_from(REC_FORMAT, journal, 0)
+        if kind != REC_GENERATION or generation != self.generation:
+            if self.debug: print("Stale journal ignored")
+            return
+        whole = len(journal) - len(journal) % REC_LEN
+        for offset in range(REC_LEN, whole, REC_LEN):
+            kind, a, b, event_identifier = struct.unpack_from(REC_FORMAT, journal, offset)
+            apply(kind, a, b, event_identifier)
+            self.records += 1
+        if whole != len(journal):
+            # A torn record at the end of the file is cut off, or every later
+            # record would be appended after it at the wrong offset
+            if self.debug: print("Torn journal record removed")
+            self._write_atomic(self.journal_file, 'wb', journal[:whole])
+
+    def log(self, kind, a=0, b=0, event_identifier=0):
+        """
+        Records a change, writing it according to the flush policy
+        """
+        if not self.pending:
+            self.pending_since = ticks_ms()
+        self.pending.extend(struct.pack(REC_FORMAT, kind, a, b, event_identifier))
+        if self.policy == FLUSH_IMMEDIATE:
+            self.flush()
+
+    def poll(self, learn=False):
+        """
+        Writes deferred changes once they are due. Call regularly from the node's
+        process loop.
+        :param learn: True while the node is in learn mode
+        """
+        if not self.pending:
+            return
+        if self.policy == FLUSH_DEFERRED:
+            if ticks_diff(ticks_ms(), self.pending_since) >= self.delay:
+                self.flush()
+        elif self.policy == FLUSH_LEARN and not learn:
+            self.flush()
+
+    def flush(self):
+        """
+        Appends pending records to the journal, compacting it if it has grown too long
+        """
+        if not self.pending:
+            return
+        if self.records + len(self.pending) // REC_LEN >= self.compact_at:
+            self.compact()
+            return
+        if self.records == 0:
+            self._write_atomic(self.journal_file, 'wb', struct.pack(REC_FORMAT, REC_GENERATION, 0, 0, self.generation)
+                               + self.pending)
+        else:
+            with open(self.journal_file, 'ab') as f:
+                f.write(self.pending)
+            self.bytes_written += len(self.pending)
+        self.records += len(self.pending) // REC_LEN
+        self.pending = bytearray()
+
+    def compact(self):
+        """
+        Writes a complete snapshot and starts a new journal
+        """
+        if self.debug: print("Compact : " + self.binary_file)
+        self.generation += 1
+        self._write_atomic(self.binary_file, 'wb', self.pack(self.snapshot()))
+        self.migrated = False
+        try:
+            os.remove(self.journal_file)
+        except OSError:
+            pass
+        self.records = 0
+        self.pending = bytearray()
+
+    def pack(self, data):
+        """
+        Encodes the node data as a binary snapshot
+        :param data: data dictionary with data['events'] the node's EventTable
+        """
+        events = data['events']
+        count = len(events)
+        flags = 0
+        for bit in range(len(FLAG_KEYS)):
+            if data[FLAG_KEYS[bit]]:
+                flags |= 1 << bit
+        extra = {}
+        for key in data:
+            if key not in HEADER_KEYS and key not in FLAG_KEYS and key != 'events':
+                extra[key] = data[key]
+        name = data['name'].encode()
+        if len(name) > 8:
+            extra['name'] = data['name']
+        extra = json.dumps(extra).encode() if extra else b''
+        header = struct.pack(HEADER_FORMAT, MAGIC, self.generation, data['nodeId'], data['manufId'],
+                             data['cpuManufId'], data['moduleId'], ord(data['minorVersion']),
+                             data['majorVersion'], data['beta'], data['numEvents'],
+                             data['numEventVariables'], data['numNodeVariables'], flags, count,
+                             len(data['parameters']), len(data['variables']), name[:8], len(extra))
+        return b''.join((header, bytes(data['parameters']), bytes(data['variables']),
+                         bytes(events.ids[:count]), bytes(events.order[:count]),
+                         bytes(events.evs[:count * events.width]), extra))
+
+    def export_json(self, file_name=None):
+        """
+        Writes the node data in the JSON data file layout
+        :param file_name: defaults to the JSON data file, which is then only read
+               again if the binary snapshot is lost
+        """
+        data = self.snapshot()
+        data['events'] = data['events'].export()
+        data['parameters'] = ['%02x' % p for p in data['parameters']]
+        data['variables'] = list(data['variables'])
+        data['generation'] = self.generation
+        self._write_atomic(file_name or self.data_file, 'w', json.dumps(data))
+
+    def _write_atomic(self, file_name, mode, content):
+        temp_file = file_name + '.tmp'
+        with open(temp_file, mode) as f:
+            f.write(content)
+        try:
+            os.rename(temp_file, file_name)
+        except OSError:
+            # Filesystems that will not rename over an existing file
+            try:
+                os.remove(file_name)
+            except OSError:
+                pass
+            os.rename(temp_file, file_name)
+        self.bytes_written += len(content)
@@ -0,0 +1,489 @@
+# GridConnect over TCP
+#
+# The CBUS ethernet interfaces, and JMRI and FCU talking to them, carry
+# GridConnect messages (":SB020N9000010002;") over a TCP stream. A
+# GcTransport serves any number of clients, listening on GC_PORT, and can
+# also connect out to another server. Every frame received on one
+# connection is relayed to the others and passed to on_frame, and
+# send_frame() sends to them all:
+#
+#   transport = GcTransport()
+#   transport.on_frame = handler  # handler(frame, connection) returns a send result
+#   await transport.start()
+#   await transport.connect('canpi.local')
+#
+# Frames are encoded to GridConnect once, into one scratch buffer, and that
+# is copied as bytes into each connection's output buffer, so fanning out
+# builds no strings. A connection's writer task takes everything queued
+# since its last write in one socket write, so a burst of frames costs one
+# write, not one per frame. Each connection has two OUT_LEN byte output
+# buffers, one filling while the other is written; a client too slow to
+# keep up has frames dropped and counted rather than holding up the bus or
+# the other clients. In the other direction a connection stops reading
+# while on_frame reports the transmit queue full, so TCP flow control
+# pushes back on the client.
+#
+# TcpNode is a CbusNode on GridConnect instead of a CAN controller, and
+# GcBridge joins a Cbus2515, or a cbus_dual.CanWorker, to a transport.
+
+from micropython import const
+import uasyncio
+from cbus_frame import CbusFrame, IDE, SRR, RTR, DLC
+import CbusFlimNode
+
+GC_PORT = const(5550)
+MAX_CLIENTS = const(8)
+OUT_LEN = const(1024)  # Bytes in each of a connection's two output buffers, about 40 frames
+READ_LEN = const(512)
+GC_MAX_LEN = const(28)  # ":X" 8 digit header, "N", 16 data digits, ";"
+FULL_WAIT_MS = const(2)  # Read pause while on_frame reports the transmit queue full
+
+COLON = const(0x3A)
+SEMICOLON = const(0x3B)
+
+HEX = b'0123456789ABCDEF'
+HEX_VALUE = bytearray(b'\xff' * 256)  # Digit value of each character, 0xFF if not a hex digit
+for _digit in range(16):
+    HEX_VALUE[HEX[_digit]] = _digit
+for _digit in range(10, 16):
+    HEX_VALUE[HEX[_digit] + 32] = _digit  # Lower case
+
+
+def gc_encode(buf, out, pos=0):
+    """
+    Writes a frame as upper case GridConnect, the same text as CbusFrame.to_gc
+    :param buf: 13 byte frame in register layout
+    :param out: bytearray with GC_MAX_LEN bytes free from pos
+    :param pos: where to start
+    :return: the position after the ';'
+    """
+    out[pos] = COLON
+    if buf[1] & IDE:
+        out[pos + 1] = 0x58  # X
+        header = 4
+        remote = buf[4] & RTR
+    else:
+        out[pos + 1] = 0x53  # S
+        header = 2
+        remote = buf[1] & SRR or buf[4] & RTR
+    pos += 2
+    for i in range(header):
+        value = buf[i]
+        out[pos] = HEX[value >> 4]
+        out[pos + 1] = HEX[value & 15]
+        pos += 2
+    out[pos] = 0x52 if remote else 0x4E  # R or N
+    pos += 1
+    for i in range(5, 5 + (buf[4] & DLC)):
+        value = buf[i]
+        out[pos] = HEX[value >> 4]
+        out[pos + 1] = HEX[value & 15]
+        pos += 2
+    out[pos] = SEMICOLON
+    return pos + 1
+
+
+def gc_decode(data, start, end, frame):
+    """
+    Fills a frame from GridConnect bytes without building a string
+    :param data: bytes or bytearray holding the message
+    :param start: index of the ':'
+    :param end: index of the ';'
+    :param frame: CbusFrame to fill
+    :return: 0 if the message was parsed, otherwise the CbusFrame.from_gc error code
+    """
+    if end - start < 7:
+        return 10
+    buf = frame.buf
+    kind = data[start + 1]
+    if kind == 0x53:  # S
+        digits = 4
+    elif kind == 0x58:  # X
+        digits = 8
+    else:
+        return 3
+    pos = start + 2
+    header = 0
+    for pos in range(pos, pos + digits):
+        value = HEX_VALUE[data[pos]]
+        if value > 15:
+            return 12
+        header = (header << 4) | value
+    pos = start + 2 + digits
+    if pos >= end:
+        return 10
+    remote = data[pos]
+    if remote != 0x4E and remote != 0x52:  # N or R
+        return 12
+    n = end - pos - 1
+    if n & 1 or n > 16:
+        return 12
+    n >>= 1
+    pos += 1
+    for i in range(5, 5 + n):
+        high = HEX_VALUE[data[pos]]
+        low = HEX_VALUE[data[pos + 1]]
+        if high > 15 or low > 15:
+            return 12
+        buf[i] = (high << 4) | low
+        pos += 2
+    if digits == 4:
+        buf[0] = header >> 8
+        buf[1] = header & 0xFF
+        buf[2] = 0
+        buf[3] = 0
+    else:
+        buf[0] = header >> 24
+        buf[1] = ((header >> 16) & 0xFF) | IDE
+        buf[2] = (header >> 8) & 0xFF
+        buf[3] = header & 0xFF
+    buf[4] = (RTR if remote == 0x52 else 0) + n
+    frame.decode()
+    return 0
+
+
+class GcConnection():
+    def __init__(self, transport, reader, writer, out_len=OUT_LEN):
+        """
+        :param transport: GcTransport the connection belongs to
+        :param reader: stream to read GridConnect from
+        :param writer: stream to write GridConnect to
+        :param out_len: bytes in each output buffer
+        """
+        self.transport = transport
+        self.reader = reader
+        self.writer = writer
+        self.out = bytearray(out_len)  # Filled by put()
+        self.out_mv = memoryview(self.out)
+        self.spare = bytearray(out_len)  # Swapped with out for each write
+        self.spare_mv = memoryview(self.spare)
+        self.fill = 0
+        self.ready = uasyncio.Event()  # Set when put() starts filling an empty buffer
+        self.line = bytearray(GC_MAX_LEN)  # Message split across two reads
+        self.line_len = 0
+        self.frame = CbusFrame()
+        self.open = True
+        self.frames_in = 0
+        self.frames_out = 0
+        self.dropped = 0
+        self.bad = 0
+        self.writes = 0
+
+    def put(self, msg):
+        """
+        Queues encoded GridConnect for the writer task
+        :param msg: bytes of one or more messages
+        :return: True, or False if the output buffer was full and the message dropped
+        """
+        fill = self.fill
+        end = fill + len(msg)
+        if end > len(self.out):
+            self.dropped += 1
+            return False
+        self.out_mv[fill:end] = msg
+        self.fill = end
+        self.frames_out += 1
+        if not fill:
+            self.ready.set()
+        return True
+
+    async def write_task(self):
+        try:
+            while self.open:
+                await self.ready.wait()
+                self.ready.clear()
+                while self.fill and self.open:
+                    n = self.fill
+                    self.out, self.spare = self.spare, self.out
+                    self.out_mv, self.spare_mv = self.spare_mv, self.out_mv
+                    self.fill = 0
+                    self.writer.write(bytes(self.spare_mv[:n]))  # Streams may keep what they are given
+                    self.writes += 1
+                    await self.writer.drain()
+        except OSError:
+            pass
+        finally:
+            await self.close()
+
+    async def read_task(self):
+        try:
+            while self.open:
+                data = await self.reader.read(READ_LEN)
+                if not data:
+                    break
+                await self.received(data)
+        except OSError:
+            pass
+        finally:
+            await self.close()
+
+    async def received(self, data):
+        """
+        Parses the messages in a read, completing one split across reads
+        """
+        pos = 0
+        if self.line_len:
+            end = data.find(b';')
+            start = data.find(b':')
+            if start >= 0 and (end < 0 or start < end):  # The rest never came, a new message starts
+                self.bad += 1
+                self.line_len = 0
+            elif end < 0:
+                self.keep(data, 0, len(data))
+                return
+            else:
+                self.keep(data, 0, end)
+                if self.line_len < GC_MAX_LEN:
+                    self.line[self.line_len] = SEMICOLON
+                    await self.message(self.line, 0, self.line_len)
+                else:
+                    self.bad += 1
+                self.line_len = 0
+                pos = end + 1
+        while True:
+            start = data.find(b':', pos)
+            if start < 0:
+                return
+            end = data.find(b';', start)
+            if end < 0:
+                self.keep(data, start, len(data))
+                return
+            await self.message(data, start, end)
+            pos = end + 1
+
+    def keep(self, data, start, end):
+        """
+        Adds the start of a message to the line, which is marked full if it is too long
+        """
+        n = self.line_len + end - start
+        if n < GC_MAX_LEN:
+            self.line[self.line_len:n] = data[start:end]
+            self.line_len = n
+        else:
+            self.line_len = GC_MAX_LEN
+
+    async def message(self, data, start, end):
+        frame = self.frame
+        if gc_decode(data, start, end, frame):
+            self.bad += 1
+            return
+        self.frames_in += 1
+        result = self.transport.deliver(frame, self)
+        while result == 2:
+            await uasyncio.sleep_ms(FULL_WAIT_MS)
+            result = self.transport.take(frame, self)
+
+    async def close(self):
+        if not self.open:
+            return
+        self.open = False
+        self.ready.set()
+        self.transport.closed(self)
+        try:
+            self.writer.close()
+            await self.writer.wait_closed()
+        except OSError:
+            pass
+
+    def stats(self):
+        return {'frames_in': self.frames_in,
+                'frames_out': self.frames_out,
+                'dropped': self.dropped,
+                'bad': self.bad,
+                'writes': self.writes}
+
+
+class GcTransport():
+    def __init__(self, port=GC_PORT, host='0.0.0.0', max_clients=MAX_CLIENTS, out_len=OUT_LEN, debug=False):
+        """
+        :param port: TCP port to listen on, GC_PORT as the CBUS ethernet interfaces
+        :param host: address to listen on, '127.0.0.1' for this machine only
+        :param max_clients: further clients are disconnected straight away
+        :param out_len: bytes in each of a connection's two output buffers
+        """
+        self.debug = debug
+        self.port = port
+        self.host = host
+        self.max_clients = max_clients
+        self.out_len = out_len
+        self.connections = []
+        self.server = None
+        self.on_frame = None  # on_frame(frame, connection) for each frame received, returns a send result
+        self.scratch = bytearray(GC_MAX_LEN)
+        self.scratch_mv = memoryview(self.scratch)
+        self.refused = 0
+        self.dropped = 0
+
+    async def start(self):
+        """
+        Starts listening for clients
+        """
+        self.server = await uasyncio.start_server(self.client, self.host, self.port)
+        if self.debug: print("GridConnect server on port", self.port)
+
+    async def stop(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+        for connection in list(self.connections):
+            await connection.close()
+
+    async def client(self, reader, writer):
+        if len(self.connections) >= self.max_clients:
+            self.refused += 1
+            writer.close()
+            await writer.wait_closed()
+            return
+        connection = self.add(reader, writer)
+        if self.debug: print("GridConnect client", writer.get_extra_info('peername'))
+        await connection.read_task()
+
+    async def connect(self, host, port=GC_PORT):
+        """
+        Connects to another GridConnect server, which then relays like a client
+        :return: the GcConnection
+        """
+        reader, writer = await uasyncio.open_connection(host, port)
+        connection = self.add(reader, writer)
+        uasyncio.create_task(connection.read_task())
+        return connection
+
+    def add(self, reader, writer):
+        connection = GcConnection(self, reader, writer, self.out_len)
+        self.connections.append(connection)
+        uasyncio.create_task(connection.write_task())
+        return connection
+
+    def closed(self, connection):
+        if connection in self.connections:
+            self.connections.remove(connection)
+
+    def deliver(self, frame, source):
+        """
+        Relays a frame received on one connection to the others, then passes
+        it to on_frame. The relay goes first because on_frame may change the
+        frame, Cbus2515.send_frame puts its own CAN ID and priority in it.
+        :return: the on_frame result, 2 holds reading until take() takes the frame
+        """
+        self.send_frame(frame, source)
+        return self.take(frame, source)
+
+    def take(self, frame, source):
+        """
+        Passes a frame to on_frame, again after it reported the transmit queue full
+        :return: the on_frame result
+        """
+        if self.on_frame is None:
+            return 0
+        return self.on_frame(frame, source)
+
+    def send_frame(self, frame, exclude=None):
+        """
+        Sends a frame to every connection
+        :param frame: CbusFrame
+        :param exclude: connection not to send it to, the one it came from
+        :return: 0, or 2 if any connection's output buffer was full
+        """
+        msg = self.scratch_mv[:gc_encode(frame.buf, self.scratch)]
+        result = 0
+        for connection in self.connections:
+            if connection is not exclude and not connection.put(msg):
+                result = 2
+        if result:
+            self.dropped += 1
+        return result
+
+    def stats(self):
+        return {'connections': [connection.stats() for connection in self.connections],
+                'refused': self.refused,
+                'dropped': self.dropped}
+
+
+class TcpNode(CbusFlimNode.CbusNode):
+    def __init__(self, config):
+        """
+        config adds "gc_port", 0 not to listen, and "gc_server", a host to
+        connect to as well
+        """
+        CbusFlimNode.CbusNode.__init__(self, config)
+        self.interface = 2  # 1 can, 2 ethernet
+        self.gc_port = config.get("gc_port", GC_PORT)
+        self.gc_server = config.get("gc_server")
+        self.transport = GcTransport(self.gc_port or GC_PORT, debug=self.debug)
+        self.transport.on_frame = self.frame_received
+        self.gc_frame = CbusFrame()
+
+    def frame_received(self, frame, connection):
+        self.execute_frame(frame)
+        return 0
+
+    def send_frame(self, frame, wait_ms=0):
+        buf = frame.buf
+        if not buf[1] & IDE:
+            buf[0] = (buf[0] & 0xF0) | (self.canId >> 3)
+            buf[1] = (self.canId << 5) & 0xE0
+        result = self.transport.send_frame(frame)
+        self.metrics.send_result(result)
+        return result
+
+    def send(self, msg):
+        error = self.gc_frame.from_gc(msg)
+        if error:
+            self.metrics.send_result(error)
+            return
+        self.send_frame(self.gc_frame)
+
+    async def periodic_task(self):
+        while True:
+            self.store.poll(self.learn)
+            await uasyncio.sleep_ms(100)
+
+    async def main(self):
+        if self.gc_port:
+            await self.transport.start()
+        if self.gc_server:
+            await self.transport.connect(self.gc_server)
+        await self.periodic_task()
+
+    def start(self):
+        uasyncio.run(self.main())
+
+
+class GcBridge():
+    def __init__(self, can, transport):
+        """
+        Relays frames between a CAN controller and GridConnect clients
+        :param can: Cbus2515, or a started CanWorker
+        :param transport: GcTransport
+        """
+        self.can = can
+        self.transport = transport
+        self.frame = CbusFrame()
+        self.service = hasattr(can, 'tx_service')  # A CanWorker retries transmissions itself
+        transport.on_frame = self.frame_received
+
+    def frame_received(self, frame, connection):
+        return self.can.send_frame(frame)
+
+    async def rx_task(self):
+        can = self.can
+        frame = self.frame
+        while True:
+            await can.rx_flag.wait()
+            while can.read_frame(frame):
+                self.transport.send_frame(frame)
+
+    async def tx_task(self):
+        while True:
+            self.can.tx_service()
+            await uasyncio.sleep_ms(20)
+
+    async def main(self):
+        await self.transport.start()
+        if self.service:
+            uasyncio.create_task(self.tx_task())
+        await self.rx_task()
+
+    def start(self):
+        uasyncio.run(self.main())
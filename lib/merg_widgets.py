@@ -1,6 +1,113 @@
-from machine import Pin, PWM, Timer
-from time import sleep
-import time
+from machine import Pin, PWM
+from micropython import const
+from time import ticks_ms, ticks_diff, ticks_add
+import uasyncio
+
+WHEEL_MS = const(10)
+WHEEL_SLOTS = const(32)
+
+
+class TimerWheel():
+    """
+    Runs widget work from one tick source instead of a machine.Timer per
+    widget. Entries are the widgets themselves, linked through their
+    wheel_next, wheel_rounds and wheel_slot attributes, so scheduling does
+    not allocate. Each entry's fire() runs from task() or poll(), in the
+    main or uasyncio context, never in an interrupt.
+    """
+    def __init__(self, resolution_ms=WHEEL_MS, slots=WHEEL_SLOTS):
+        """
+        :param resolution_ms: tick length, delays are rounded up to whole ticks
+        :param slots: delays over slots ticks go round the wheel more than once
+        """
+        self.resolution = resolution_ms
+        self.slots = slots
+        self.heads = [None] * slots
+        self.current = 0
+        self.last = ticks_ms()
+        self.late = 0  # Ticks run late because poll() was not called in time
+
+    def schedule(self, entry, delay_ms):
+        """
+        Runs entry.fire() once after delay_ms, replacing any earlier schedule
+        """
+        if entry.wheel_slot >= 0:
+            self.cancel(entry)
+        ticks = (delay_ms + self.resolution - 1) // self.resolution
+        if ticks < 1:
+            ticks = 1
+        slot = (self.current + ticks) % self.slots
+        entry.wheel_rounds = (ticks - 1) // self.slots
+        entry.wheel_slot = slot
+        entry.wheel_next = self.heads[slot]
+        self.heads[slot] = entry
+
+    def cancel(self, entry):
+        slot = entry.wheel_slot
+        if slot < 0:
+            return
+        previous = None
+        item = self.heads[slot]
+        while item is not None:
+            if item is entry:
+                if previous is None:
+                    self.heads[slot] = item.wheel_next
+                else:
+                    previous.wheel_next = item.wheel_next
+                break
+            previous = item
+            item = item.wheel_next
+        entry.wheel_slot = -1
+        entry.wheel_next = None
+
+    def advance(self):
+        """
+        Moves on one tick and fires the entries that are due
+        """
+        current = self.current + 1
+        if current == self.slots:
+            current = 0
+        self.current = current
+        entry = self.heads[current]
+        self.heads[current] = None  # Entries fired below may schedule themselves into this slot again
+        while entry is not None:
+            next_entry = entry.wheel_next
+            if entry.wheel_rounds:
+                entry.wheel_rounds -= 1
+                entry.wheel_next = self.heads[current]
+                self.heads[current] = entry
+            else:
+                entry.wheel_slot = -1
+                entry.wheel_next = None
+                entry.fire()
+            entry = next_entry
+
+    def poll(self):
+        """
+        Runs the ticks that have passed since the last call, from a polling loop
+        """
+        ticks = ticks_diff(ticks_ms(), self.last) // self.resolution
+        if ticks <= 0:
+            return
+        if ticks > 1:
+            self.late += ticks - 1
+        self.last = ticks_add(self.last, ticks * self.resolution)
+        for i in range(ticks):
+            self.advance()
+
+    async def task(self):
+        """
+        Drives the wheel from a uasyncio task
+        """
+        self.last = ticks_ms()
+        while True:
+            self.poll()
+            await uasyncio.sleep_ms(self.resolution)
+
+
+# Shared by widgets created without a wheel of their own. can_pico drives it,
+# other programs run wheel.task() or call wheel.poll() from their loop.
+wheel = TimerWheel()
 
 
 class Button():
@@ -26,14 +133,22 @@ class Button():
 
 
 class MergInput():
-    def __init__(self, pin, on_function, off_function):
+    def __init__(self, pin, on_function, off_function, timer_wheel=None):
         self.button = Pin(pin, Pin.IN, Pin.PULL_DOWN)
         self.button_status = self.button.value()
         self.duration = 50
         self.on_function = on_function
         self.off_function = off_function
-        tim = Timer(period=self.duration, mode=Timer.ONE_SHOT, callback = self.check)
-        
+        self.wheel = timer_wheel or wheel
+        self.wheel_next = None
+        self.wheel_rounds = 0
+        self.wheel_slot = -1
+        self.wheel.schedule(self, self.duration)
+
+    def fire(self):
+        self.check(None)
+        self.wheel.schedule(self, self.duration)
+
     def check(self, t):
         # print('Check Button '+str(self.button.value()))
         if self.button_status != self.button.value():
@@ -45,11 +160,10 @@ class MergInput():
                 if self.on_function != None:
                     self.on_function()
             self.button_status = self.button.value()
-        tim = Timer(period=self.duration, mode=Timer.ONE_SHOT, callback = self.check)
 
 
 class MergLed():
-    def __init__(self, led_pin):
+    def __init__(self, led_pin, timer_wheel=None):
         self.led = PWM(Pin(led_pin))
         self.led.freq(50)
         self.gamma = [0,256,768,2304,5120,9216,15616,23808,34560,47616,65535]
@@ -60,11 +174,17 @@ class MergLed():
         self.flash_frequency = 5
         self.flash_duration = 500
         self.flash = False
-        self.tim = Timer(period=self.flash_duration, mode=Timer.ONE_SHOT, callback = self.check)
-#         timer = Timer()
-#         timer.init(freq=self.flash_frequency, mode=Timer.PERIODIC, callback=self.check())
+        self.wheel = timer_wheel or wheel
+        self.wheel_next = None
+        self.wheel_rounds = 0
+        self.wheel_slot = -1
+        self.wheel.schedule(self, self.flash_duration)
         #print('MERG_LED2 Initialised')
-        
+
+    def fire(self):
+        self.check(None)
+        self.wheel.schedule(self, self.flash_duration)
+
     def check(self, t):
         #print('MERG_LED2 Check')
         if self.flash:
@@ -79,8 +199,6 @@ class MergLed():
                 self.position(self.level)
             else:
                 self.position(0)
-        self.tim.deinit()
-        self.tim = Timer(period=self.flash_duration, mode=Timer.ONE_SHOT, callback = self.check)
         
     def position(self, value):
         self.value = value
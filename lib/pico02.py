@@ -1,20 +1,33 @@
-from machine import Pin, SPI, Timer
+from machine import Pin, SPI
 import time
+import uasyncio
 import CbusFlimNode
 import cbus2515
+import cbus_actions
+from cbus_dual import CanWorker, SERVICE_MS
+from cbus_frame import CbusFrame
+import merg_widgets
 from merg_widgets import MergInput, MergLed
 
 
 class can_pico(CbusFlimNode.CbusNode):
     def __init__(self, config):
         CbusFlimNode.CbusNode.__init__(self, config)
-        self.button = MergInput(22, self.button_on, self.button_off)
-        self.green_led = MergLed(9)
+        # Debounce and flashing for the widgets below and any a subclass creates
+        # without a wheel, driven from main() or process()
+        self.wheel = merg_widgets.wheel
+        if "wheel_ms" in config:
+            self.wheel.resolution = config["wheel_ms"]
+        self.button = MergInput(22, self.button_on, self.button_off, self.wheel)
+        self.green_led = MergLed(9, self.wheel)
         self.green_led.on = False
-        self.amber_led = MergLed(15)
+        self.amber_led = MergLed(15, self.wheel)
         self.amber_led.on = True
-        self.red_led = MergLed(8)
+        self.red_led = MergLed(8, self.wheel)
         self.red_led.on = False
+        self.leds = (self.green_led, self.amber_led, self.red_led)
+        if config.get("led_actions", False):  # Events taught with EV1 = 3 drive the LEDs instead of my_function
+            self.register_action(cbus_actions.ACTION_LED, self.led_action)
         self.debug = True
         self.interface = 1  # 1 can, 2 ethernet
         
@@ -31,6 +44,7 @@ class can_pico(CbusFlimNode.CbusNode):
         # self.spi = SPI(self.SPI_ID, sck=self.SPI_CLK, mosi=self.SPI_MOSI, miso=self.SPI_MISO)
         self.spi = SPI(self.SPI_ID, sck=self.SPI_CLK, mosi=self.SPI_MOSI, miso=self.SPI_MISO, baudrate=10000000)
         self.can = cbus2515.Cbus2515(self.spi, self.SPI_CS, self.SPI_INT, osc=self.OSC_2515, debug=self.debug)
+        self.metrics.driver = self.can
         time.sleep(0.2)
         if self.debug:
             print("SPI Configuration: " + str(self.spi) + '\n')  # Display SPI config
@@ -41,12 +55,25 @@ class can_pico(CbusFlimNode.CbusNode):
                 print('CAN NOT Initialised')
         
         self.can.change_mode(0)  # 0-Normal, 1-Sleep, 2-Loopback, 3-Listen Only, 4-Configuration
+        self.worker = CanWorker(self.can) if config.get("dual_core", False) else None
+        self.serviced = time.ticks_ms()  # Last tx_service() from process()
+        self.gc_frame = CbusFrame()
+        self.update_filters()
         if self.nodeId == 0:
             self.rqnn()
         
     def my_function(self, event_variables):
         print('CanPico my_function ' + str(self.data['variables']) + ' : ' + str(event_variables))
     
+    def led_action(self, target, level, on):
+        """
+        ACTION_LED: target 0 green, 1 amber, 2 red, at level 0 - 10
+        """
+        if target < len(self.leds):
+            led = self.leds[target]
+            led.level = level
+            led.on = on
+
     def button_on(self):
         self.acon(2)
         self.green_led.on = True
@@ -59,14 +86,84 @@ class can_pico(CbusFlimNode.CbusNode):
         self.green_led.on = False
         self.red_led.flash = False
         self.amber_led.level = 5
-        
+
+    async def rx_task(self):
+        """
+        Executes received frames as soon as the CAN interrupt, or the worker
+        on core 1, stacks them
+        """
+        source = self.worker or self.can
+        frame = self.rx_frame
+        while True:
+            await source.rx_flag.wait()
+            while source.read_frame(frame):
+                self.execute_frame(frame)
+
+    async def tx_task(self):
+        """
+        Aborts and retries frames stuck in the transmit buffers
+        """
+        while True:
+            self.can.tx_service()
+            await uasyncio.sleep_ms(SERVICE_MS)
+
+    async def periodic_task(self):
+        """
+        Writes node data as the flush policy allows
+        """
+        while True:
+            self.store.poll(self.learn)
+            await uasyncio.sleep_ms(100)
+
+    async def main(self):
+        uasyncio.create_task(self.wheel.task())
+        if self.worker:
+            self.worker.start()  # Retries transmissions itself
+        else:
+            uasyncio.create_task(self.tx_task())
+        uasyncio.create_task(self.periodic_task())
+        await self.rx_task()
+
+    def start(self):
+        """
+        Runs the node under uasyncio, run() and process() remain for polling loops
+        """
+        uasyncio.run(self.main())
+
+    def set_filters(self, node_numbers, opcodes):
+        if self.worker:
+            self.worker.set_filters(node_numbers, opcodes)
+        else:
+            self.can.set_filters(node_numbers, opcodes)
+
+    def send_frame(self, frame, wait_ms=0):
+        if self.worker:
+            result = self.worker.send_frame(frame, wait_ms)
+        else:
+            result = self.can.send_frame(frame, -1, wait_ms)
+        self.metrics.send_result(result)
+        return result
+
     def send(self, msg):
         # print("Pico Node Send : " + msg)
-        self.can.send(msg)
-        
+        if self.worker:
+            error = self.gc_frame.from_gc(msg)
+            self.metrics.send_result(error or self.worker.send_frame(self.gc_frame))
+        else:
+            self.metrics.send_result(self.can.send(msg))
+
     def process(self):
-        while self.can.in_waiting():
-                # print(self.can.receive())
-                self.execute(self.can.receive())
-                # print("Check")
-                time.sleep(0.01)
\ No newline at end of file
+        if self.worker:
+            if not self.worker.running:
+                self.worker.start()
+            while self.worker.read_frame(self.rx_frame):
+                self.execute_frame(self.rx_frame)
+        else:
+            while self.can.read_frame(self.rx_frame):
+                self.execute_frame(self.rx_frame)
+            now = time.ticks_ms()
+            if time.ticks_diff(now, self.serviced) >= SERVICE_MS:  # Retries, error counters and bus-off recovery
+                self.serviced = now
+                self.can.tx_service()
+        self.wheel.poll()
+        self.store.poll(self.learn)